@@ -0,0 +1,319 @@
+# async_runtime.py
+#
+# Runs the bot on one asyncio event loop: the Zulip event queue is long-polled with register/get_events,
+# every message is a task and paper handlers and Notion use async HTTP clients.
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import metrics
+from rate_limiter import RATE_LIMIT_STATUSES, retry_after_seconds
+from zulip_handler import zulipHandler
+from reply_aggregator import AsyncReplyAggregator
+
+DEFAULT_ASYNC_CONFIG = {
+    'max_messages': 500,  # messages processed at the same time, further events wait in Zulip's queue
+    'blocking_workers': 8,  # threads for handlers without an async client, like Zotero
+}
+
+
+class AsyncZulipClient:
+    # The parts of zulip.Client the bot uses, as coroutines on top of httpx
+
+    def __init__(self, email, api_key, site, long_poll_timeout=90, retry_interval=5):
+        if httpx is None:
+            raise RuntimeError("The asyncio runtime needs httpx: pip install httpx")
+        self.base_url = site.rstrip('/') + '/api/v1'
+        self.long_poll_timeout = long_poll_timeout
+        self.retry_interval = retry_interval
+        self.client = httpx.AsyncClient(auth=(email, api_key), timeout=httpx.Timeout(30, connect=10))
+        self._closed = asyncio.Event()
+
+    async def _request(self, method, path, max_retries=3, **kwargs):
+        for attempt in range(max_retries + 1):
+            response = await self.client.request(method, f"{self.base_url}{path}", **kwargs)
+            if response.status_code not in RATE_LIMIT_STATUSES or attempt == max_retries:
+                return response.json()
+            delay = retry_after_seconds(response.headers, default=2 ** attempt)
+            print(f"Warning: Zulip rate limited us, retrying in {delay:.1f}s.")
+            metrics.inc('rate_limited_total', service='zulip')
+            await asyncio.sleep(delay)
+
+    async def register(self):
+        response = await self._request('POST', '/register', data={'event_types': json.dumps(['message'])})
+        if response.get('result') != 'success':
+            raise RuntimeError(f"Could not register a Zulip event queue: {response.get('msg')}")
+        metrics.startup.mark('listening')
+        return response['queue_id'], response['last_event_id']
+
+    async def get_events(self, queue_id, last_event_id):
+        timeout = httpx.Timeout(self.long_poll_timeout + 30, connect=10)
+        return await self._request('GET', '/events', params={'queue_id': queue_id, 'last_event_id': last_event_id},
+                                   timeout=timeout)
+
+    async def message_events(self):
+        # Yields message events until close(), re-registering when the server dropped our queue
+        queue_id = last_event_id = None
+        while not self._closed.is_set():
+            try:
+                if queue_id is None:
+                    queue_id, last_event_id = await self.register()
+                response = await self.get_events(queue_id, last_event_id)
+            except Exception as e:
+                print(f"Warning: Failed to get Zulip events. Exception: {e}")
+                await asyncio.sleep(self.retry_interval)
+                continue
+            if response.get('result') != 'success':
+                if response.get('code') == 'BAD_EVENT_QUEUE_ID':
+                    queue_id = None
+                else:
+                    print(f"Warning: Zulip event queue returned an error: {response.get('msg')}")
+                    await asyncio.sleep(self.retry_interval)
+                continue
+            for event in response.get('events', []):
+                last_event_id = max(last_event_id, event['id'])
+                if event['type'] == 'message':
+                    yield event['message']
+
+    async def send_message(self, request):
+        return await self._request('POST', '/messages', data=request)
+
+    async def update_message(self, request):
+        request = dict(request)
+        message_id = request.pop('message_id')
+        return await self._request('PATCH', f'/messages/{message_id}', data=request)
+
+    async def get_raw_message(self, message_id):
+        return await self._request('GET', f'/messages/{message_id}')
+
+    async def close(self):
+        self._closed.set()
+        await self.client.aclose()
+
+
+class FetchBatcher:
+    # Collects paper IDs of concurrent messages for up to batch_window seconds, then looks them up in one call
+
+    def __init__(self, paper_handler, batch_size=50, batch_window=0.5):
+        self.paper_handler = paper_handler
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.pending = {}  # paper_id -> futures of the callers waiting for it
+        self.trace_ids = set()
+        self.timer = None
+        self.tasks = set()
+
+    async def get(self, paper_id):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(paper_id, []).append(future)
+        self.trace_ids.add(metrics.current_trace_id())
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        trace_ids, self.trace_ids = self.trace_ids, set()
+        if pending:
+            task = asyncio.get_running_loop().create_task(self._fetch(pending, trace_ids))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _fetch(self, pending, trace_ids):
+        # A batch can span several messages, so its spans are only tied to a trace if it does not
+        with metrics.trace(trace_ids.pop() if len(trace_ids) == 1 else None):
+            try:
+                with metrics.timer('metadata_fetch', source=self.paper_handler.source):
+                    infos = await self.paper_handler.get_info_many_async(list(pending))
+            except Exception as e:
+                for futures in pending.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                return
+        for paper_id, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(infos.get(paper_id))
+
+
+class AsyncZulipHandler(zulipHandler):
+    # Same replies and database writes as zulipHandler, but as tasks on one event loop instead of stage threads
+
+    def __init__(self, email, api_key, site, paper_handlers=None, database_handlers=None, pipeline_config=None,
+                 client=None, async_config=None, reply_config=None, repositories=None):
+        client = client if client is not None else AsyncZulipClient(email=email, api_key=api_key, site=site)
+        super().__init__(email, api_key, site, paper_handlers=paper_handlers, database_handlers=database_handlers,
+                         pipeline_config=pipeline_config, client=client, reply_config=reply_config,
+                         repositories=repositories)
+        self.async_config = dict(DEFAULT_ASYNC_CONFIG, **(async_config or {}))
+        self.tasks = set()
+        self.in_flight = 0
+        metrics.register_gauge('async_messages_in_flight', lambda: self.in_flight)
+
+    def build_runtime(self, stage_config):
+        # Instead of the stage threads: replies edited by timers of the loop, metadata batched like the fetch stage
+        self.replies = AsyncReplyAggregator(self.client, **self.reply_config)
+        fetch_config = stage_config['fetch']
+        self.batchers = {paper_handler: FetchBatcher(paper_handler, fetch_config['batch_size'], fetch_config['batch_window'])
+                         for paper_handler in self.paper_handlers}
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def process_message(self, message):
+        self.in_flight += 1
+        try:
+            with metrics.trace(message.get('id')):
+                fetch_jobs = self.extract_jobs(message)
+                if fetch_jobs:
+                    reply_ids = await self.replies.open(message, [self.reply_key(job) for job in fetch_jobs],
+                                                        self.reply_request, self.placeholder)
+                    for job in fetch_jobs:
+                        job['status_message_id'] = reply_ids[self.reply_key(job)]
+                await asyncio.gather(*(self.process_paper(job) for job in fetch_jobs))
+        except Exception as e:
+            print(f"Warning: Failed to handle message {message.get('id')}. Exception: {e}")
+        finally:
+            self.in_flight -= 1
+
+    def paper_repository(self, job, timeout=0):
+        # Tasks cannot be waited for here, process_paper does that before the write
+        task = job.get('repository')
+        if task is None or not task.done() or task.cancelled() or task.exception() is not None:
+            return None
+        return task.result()
+
+    async def process_paper(self, job):
+        reply_id, reply_key = job['status_message_id'], self.reply_key(job)
+        if self.repositories is not None:
+            job['repository'] = self._spawn(self.repositories.lookup_async(reply_key))
+        try:
+            paper_info = await self.batchers[job['paper_handler']].get(job['paper_id'])
+        except Exception as e:
+            error_feedback = f"Failed to retrieve info for paper ID {job['paper_id']}. Error: {e}"
+            self.replies.update(reply_id, reply_key, card=error_feedback, done=True)
+            return
+        if not paper_info:
+            no_info_feedback = f"No info returned for ID {job['paper_id']}."
+            self.replies.update(reply_id, reply_key, card=no_info_feedback, done=True)
+            return
+        self.show_card(job, paper_info)
+
+        info, job_key = self.prepare_write({"message": job['message'], "info": dict(paper_info)})
+        if self.repositories is not None:
+            await asyncio.wait({job['repository']}, timeout=self.repositories.timeout)
+            info['github_repo'] = self.paper_repository(job)
+        update_result = await self.try_update_databases_async(
+            info, job_key=job_key, status_message_id=reply_id,
+            on_progress=lambda content: self.replies.update(reply_id, reply_key, databases=content)
+        )
+        self.replies.update(reply_id, reply_key, databases=update_result, done=True)
+
+    async def try_update_databases_async(self, paper_info, job_key=None, status_message_id=None, on_progress=None):
+        # Same deadlines as try_update_databases; a write past its deadline keeps running as a task of the bot
+        loop_time = asyncio.get_running_loop().time
+        start = loop_time()
+        pending = {self._spawn(handler_wrapper.update_db_async(paper_info, job_key=job_key,
+                                                               status_message_id=status_message_id)): handler_wrapper
+                   for handler_wrapper in self.database_handlers}
+        results = {}
+        while pending:
+            timeout = min(start + handler_wrapper.deadline for handler_wrapper in pending.values()) - loop_time()
+            done, _ = await asyncio.wait(pending, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                handler_wrapper = pending.pop(task)
+                results[handler_wrapper] = self.write_result(handler_wrapper, task)
+            for task, handler_wrapper in list(pending.items()):
+                if loop_time() - start >= handler_wrapper.deadline:
+                    del pending[task]
+                    results[handler_wrapper] = self.deadline_exceeded(handler_wrapper, job_key)
+                    task.add_done_callback(lambda task, handler_wrapper=handler_wrapper: self._spawn(
+                        self.finished_late_async(handler_wrapper, paper_info, status_message_id, task)))
+            if pending and on_progress is not None:
+                on_progress(self.database_status(results))
+        return self.database_status(results)
+
+    async def finished_late_async(self, handler_wrapper, paper_info, status_message_id, task):
+        result = self.write_result(handler_wrapper, task)
+        if status_message_id is None or result == handler_wrapper.pending_text():
+            return
+        try:
+            await self.replay_finished_async(handler_wrapper, {'status_message_id': status_message_id, 'info': paper_info}, result)
+        except Exception as e:
+            print(f"Warning: Failed to report the late {handler_wrapper.name} result. Exception: {e}")
+
+    async def replay_finished_async(self, handler_wrapper, job, result):
+        if job['status_message_id'] is None:
+            return
+        link = job.get('info', {}).get('link')
+        if self.replies.replace(job['status_message_id'], link, handler_wrapper.pending_text(), result):
+            return
+        response = await self.client.get_raw_message(job['status_message_id'])
+        content = self.replayed_content(response, handler_wrapper, result, link)
+        if content is not None:
+            await self.client.update_message({"message_id": job['status_message_id'], "content": content})
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        # Bounded pool for the remaining blocking calls, instead of a thread per job
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.async_config['blocking_workers'],
+                                                     thread_name_prefix='blocking'))
+        maintenance = []
+        for handler_wrapper in self.database_handlers:
+            handler_wrapper.on_replay = self.replay_finished_async
+            maintenance.append(loop.create_task(handler_wrapper.maintain_async()))
+        slots = asyncio.Semaphore(self.async_config['max_messages'])
+
+        async def bounded(message):
+            try:
+                await self.process_message(message)
+            finally:
+                slots.release()
+
+        try:
+            async for message in self.client.message_events():
+                if message['sender_email'] == self.email:
+                    continue
+                # Stop reading events while too many messages are in flight
+                await slots.acquire()
+                self._spawn(bounded(message))
+            await asyncio.gather(*self.tasks)
+            await self.replies.drain()
+        finally:
+            for handler_wrapper in self.database_handlers:
+                handler_wrapper.stop_periodic_reinitialization()
+            # Sends the edits still waiting for their debounce while the client is open
+            await self.replies.flush_all()
+            for task in maintenance + list(self.tasks):
+                task.cancel()
+            await self.close_async()
+
+    async def close_async(self):
+        await self.client.close()
+        if self.repositories is not None:
+            self.repositories.close()
+        for transport in {paper_handler.async_http for paper_handler in self.paper_handlers} - {None}:
+            await transport.aclose()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    def stop(self):
+        # run_async already flushed the replies and closed the clients on its loop, which is gone by now
+        if self.repositories is not None:
+            self.repositories.close()
@@ -0,0 +1,172 @@
+# backfill.py
+#
+# Feeds Zulip history that was posted while the bot was not running into Notion and Zotero.
+# Run from the src folder: python backfill.py --stream papers --since 2022-01-01 [--reply]
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from zulip_handler import zulipHandler
+from job_journal import JobJournal
+from local_store import get_store, SharedLocks
+from http_transport import HttpTransport, set_default_transport
+from rate_limiter import configure_rate_limits
+from main import (
+    ZULIP_EMAIL, ZULIP_API_KEY, ZULIP_SITE, STATE_DB_PATH, HTTP_HOST_SETTINGS, HTTP2, RATE_LIMITS,
+    create_paper_handlers, create_database_handlers, create_repository_lookup
+)
+import metrics
+
+ZULIP_MAX_MESSAGES_PER_REQUEST = 5000
+
+
+class BackfillCheckpoint:
+    # Id of the last fully ingested message per stream, so an interrupted backfill continues where it stopped
+    def __init__(self, path=STATE_DB_PATH):
+        self.store = get_store(path)
+        self.store.execute("CREATE TABLE IF NOT EXISTS backfill_checkpoint (stream TEXT PRIMARY KEY, message_id INTEGER)")
+
+    def get(self, stream):
+        rows = self.store.execute("SELECT message_id FROM backfill_checkpoint WHERE stream = ?", (stream,))
+        return rows[0][0] if rows else None
+
+    def set(self, stream, message_id):
+        self.store.execute("INSERT OR REPLACE INTO backfill_checkpoint (stream, message_id) VALUES (?, ?)",
+                           (stream, message_id))
+
+
+class Backfill:
+    def __init__(self, bot, checkpoint, page_size=1000, workers=4, reply=False):
+        self.bot = bot
+        self.checkpoint = checkpoint
+        self.page_size = min(page_size, ZULIP_MAX_MESSAGES_PER_REQUEST)
+        self.workers = workers
+        self.reply = reply
+
+    def pages(self, stream, since=None, until=None):
+        # Anchor-based paging from the checkpoint (or the oldest message) towards the newest
+        anchor = self.checkpoint.get(stream)
+        while True:
+            response = self.bot.client.get_messages({
+                'anchor': anchor if anchor is not None else 'oldest',
+                'include_anchor': anchor is None,
+                'num_before': 0,
+                'num_after': self.page_size,
+                'narrow': [{'operator': 'stream', 'operand': stream}],
+                'apply_markdown': False,
+            })
+            if response.get('result') != 'success':
+                raise RuntimeError(f"Could not read the history of {stream}: {response.get('msg')}")
+            messages = response['messages']
+            if not messages:
+                return
+            # The API cannot narrow by date, so the window is applied here
+            covered = [message for message in messages if until is None or message['timestamp'] < until]
+            if covered:
+                yield [message for message in covered if since is None or message['timestamp'] >= since], covered[-1]['id']
+            if response.get('found_newest') or len(covered) < len(messages):
+                return
+            anchor = messages[-1]['id']
+
+    def run(self, stream, since=None, until=None):
+        ingested = 0
+        failed = 0
+        for messages, last_id in self.pages(stream, since, until):
+            written, page_failed = self.ingest(messages)
+            ingested += written
+            failed += page_failed
+            # After a failed lookup the checkpoint stays before its page, so the next run retries those papers.
+            # The pages after it are still ingested; the journal keeps a second run from writing them twice.
+            if not failed:
+                self.checkpoint.set(stream, last_id)
+            print(f"{stream}: ingested {ingested} paper(s), up to message {last_id}.")
+        if failed:
+            print(f"Warning: {stream}: {failed} paper lookup(s) failed, run the backfill again to retry them.")
+        return ingested
+
+    def ingest(self, messages):
+        # Returns the number of papers written and of papers whose metadata lookup failed
+        fetch_jobs = [job for message in messages if message['sender_email'] != self.bot.email
+                      for job in self.bot.extract_jobs(message)]
+
+        # One batched metadata lookup per paper handler for the whole page of history
+        jobs_by_handler = {}
+        for job in fetch_jobs:
+            jobs_by_handler.setdefault(job['paper_handler'], []).append(job)
+        write_jobs = []
+        failed = set()
+        if self.bot.repositories is not None:
+            for job in fetch_jobs:
+                job['repository'] = self.bot.repositories.submit(self.bot.reply_key(job))
+        for paper_handler, jobs in jobs_by_handler.items():
+            with metrics.timer('metadata_fetch', source=paper_handler.source):
+                failed_ids = set()
+                paper_infos = paper_handler.get_info_many([job['paper_id'] for job in jobs], failed=failed_ids)
+            for job in jobs:
+                paper_info = paper_infos.get(job['paper_id'])
+                if paper_info:
+                    write_jobs.append({"message": job['message'], "info": dict(paper_info),
+                                       "repository": job.get('repository')})
+                elif job['paper_id'] in failed_ids:
+                    print(f"Warning: Lookup of ID {job['paper_id']} in message {job['message']['id']} failed.")
+                    failed.add((paper_handler.source, job['paper_id']))
+                else:
+                    print(f"Warning: No info returned for ID {job['paper_id']} in message {job['message']['id']}.")
+
+        # The journal keys writes by message and paper, so re-running a page does not write anything twice
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.write, write_jobs))
+        return len(write_jobs), len(failed)
+
+    def write(self, job):
+        with metrics.trace(job['message'].get('id')):
+            info, job_key = self.bot.prepare_write(job)
+            if self.bot.repositories is not None:
+                info['github_repo'] = self.bot.paper_repository(job, timeout=self.bot.repositories.timeout)
+            update_result = self.bot.try_update_databases(info, job_key=job_key)
+            if self.reply:
+                card = self.bot.paper_card(job['message'], info)
+                self.bot.client.send_message(self.bot.reply_request(job['message'], card + update_result))
+
+
+def parse_date(value):
+    return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest papers shared in past Zulip messages.")
+    parser.add_argument('--stream', action='append', required=True, help="stream to backfill, can be repeated")
+    parser.add_argument('--since', type=parse_date, help="first day to include, YYYY-MM-DD")
+    parser.add_argument('--until', type=parse_date, help="first day to leave out, YYYY-MM-DD")
+    parser.add_argument('--page-size', type=int, default=1000, help="messages per get_messages request")
+    parser.add_argument('--workers', type=int, default=4, help="parallel database writes")
+    parser.add_argument('--reply', action='store_true', help="post the paper cards and results to Zulip")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the oldest message")
+    args = parser.parse_args()
+
+    configure_rate_limits(RATE_LIMITS)
+    transport = HttpTransport(host_settings=HTTP_HOST_SETTINGS, http2=HTTP2)
+    set_default_transport(transport)
+    journal = JobJournal(path=STATE_DB_PATH)
+    # The bot may be writing to the same databases meanwhile
+    database_handlers = create_database_handlers(journal, start_thread=False, locks=SharedLocks(path=STATE_DB_PATH))
+    bot = zulipHandler(
+        email=ZULIP_EMAIL,
+        api_key=ZULIP_API_KEY,
+        site=ZULIP_SITE,
+        paper_handlers=create_paper_handlers(transport),
+        database_handlers=database_handlers,
+        # Uses the repository index as it is, the bot keeps it fresh
+        repositories=create_repository_lookup(transport, start_thread=False)
+    )
+    checkpoint = BackfillCheckpoint(path=STATE_DB_PATH)
+    backfill = Backfill(bot, checkpoint, page_size=args.page_size, workers=args.workers, reply=args.reply)
+    try:
+        for stream in args.stream:
+            if args.restart:
+                checkpoint.set(stream, None)
+            total = backfill.run(stream, since=args.since, until=args.until)
+            print(f"{stream}: done, {total} paper(s).")
+    finally:
+        transport.close()
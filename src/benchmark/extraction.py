@@ -0,0 +1,113 @@
+# extraction.py
+#
+# Compares the old link extraction (quote filtering, then one findall per paper handler) with LinkExtractor
+# on large pasted messages. Run from the src folder: python -m benchmark.extraction --lines 2000
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+
+from link_extractor import LinkExtractor
+from paper_handlers import arxiveHandler, openreviewHandler, strip_arxiv_version
+
+LEGACY_ARXIV_REGEX = r'\b(?:arXiv:)?(\d{4}\.\d{5})\b|https?://arxiv\.org/abs/(\d{4}\.\d{5})'
+LEGACY_OPENREVIEW_REGEX = r'https?://openreview\.net/(forum|pdf)\?id=([A-Za-z0-9_]+)'
+LEGACY_QUOTE_START_REGEX = re.compile(r'^(`+)(quote)')
+
+
+def count_backticks_in_quote(line):
+    match = LEGACY_QUOTE_START_REGEX.match(line)
+    return len(match.group(1)) if match else 0
+
+
+def filter_zulip_quotes(content):
+    # The quote filter the bot used before LinkExtractor: drops quote blocks and the "... said:" line before them
+    lines = content.split('\n')
+    out = []
+    n_lines = len(lines)
+    i = 0
+    while i < n_lines:
+        ticks = count_backticks_in_quote(lines[i])
+        if ticks:
+            if out:
+                out.pop(-1)
+            i += 1
+            while i < n_lines and '`'*ticks not in lines[i]:
+                i += 1
+        else:
+            out.append(lines[i])
+        i += 1
+    return "\n".join(out)
+
+
+def legacy_extract(content):
+    content = filter_zulip_quotes(content)
+    arxiv_ids = [arxiv_id for match in re.findall(LEGACY_ARXIV_REGEX, content) for arxiv_id in match if arxiv_id]
+    openreview_ids = [match[1] for match in re.findall(LEGACY_OPENREVIEW_REGEX, content)]
+    return ([('arxiv', strip_arxiv_version(arxiv_id)) for arxiv_id in dict.fromkeys(arxiv_ids)]
+            + [('openreview', openreview_id) for openreview_id in dict.fromkeys(openreview_ids)])
+
+
+def synthetic_message(lines, link_share, quote_share, rng):
+    out = []
+    while len(out) < lines:
+        roll = rng.random()
+        if roll < quote_share:
+            out += ["@_**Someone|1** [said](https://zulip.example/#narrow/near/1):", "```quote"]
+            out += [f"quoted https://arxiv.org/abs/2301.{rng.randrange(10000, 99999)}" for _ in range(rng.randrange(1, 5))]
+            out.append("```")
+        elif roll < quote_share + link_share:
+            if rng.random() < 0.2:
+                out.append(f"see https://openreview.net/forum?id=bench{rng.randrange(1000)} for the reviews")
+            else:
+                out.append(f"also arXiv:{rng.randrange(2000, 2400)}.{rng.randrange(10000, 99999)} is related")
+        else:
+            out.append("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor 12.5 % "
+                       "incididunt ut labore et dolore magna aliqua.")
+    return "\n".join(out)
+
+
+def measure(extract, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for content in messages:
+            extract(content)
+    return (time.perf_counter() - start) / (repeat * len(messages))
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    messages = [synthetic_message(args.lines, args.link_share, args.quote_share, rng) for _ in range(args.messages)]
+    extractor = LinkExtractor.for_handlers([arxiveHandler(), openreviewHandler()])
+    extractor.compile()
+
+    mismatches = sum(sorted(legacy_extract(content)) != sorted(extractor.extract(content)) for content in messages)
+    legacy = measure(legacy_extract, messages, args.repeat)
+    single_pass = measure(extractor.extract, messages, args.repeat)
+    return {
+        'messages': len(messages),
+        'lines_per_message': args.lines,
+        'papers_per_message': sum(len(extractor.extract(content)) for content in messages) / len(messages),
+        'legacy_ms_per_message': round(legacy * 1000, 3),
+        'single_pass_ms_per_message': round(single_pass * 1000, 3),
+        'speedup': round(legacy / single_pass, 2),
+        'mismatched_messages': mismatches,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark link extraction on large messages.")
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=2000, help="lines per message")
+    parser.add_argument('--link-share', type=float, default=0.05, help="share of lines with a paper link")
+    parser.add_argument('--quote-share', type=float, default=0.02, help="share of lines that start a quote block")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    json.dump(run(parse_args()), sys.stdout, indent=2)
@@ -0,0 +1,428 @@
+# fake_services.py
+
+import asyncio
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+MARKER_REGEX = re.compile(r'bench-msg-\d+')
+
+
+class FakeService:
+    # Local HTTP stand-in with configurable latency, error and 429 injection
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.throttle_count = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, headers, payload = service.handle(self.command, self.path, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, method, path, body):
+        with self.lock:
+            self.request_count += 1
+            roll = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        time.sleep(delay)
+        if roll < self.throttle_rate:
+            with self.lock:
+                self.throttle_count += 1
+            return 429, {'Retry-After': str(self.retry_after), 'Content-Type': 'application/json'}, b'{"code": "rate_limited"}'
+        if roll < self.throttle_rate + self.error_rate:
+            with self.lock:
+                self.error_count += 1
+            return 500, {'Content-Type': 'application/json'}, b'{"error": "injected"}'
+        parts = urlsplit(path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        with self.state_lock:
+            status, headers, payload = self.route(method, parts.path, query, json.loads(body) if body else None)
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+            headers = dict({'Content-Type': 'application/json'}, **headers)
+        return status, headers, payload
+
+    def route(self, method, path, query, body):
+        return 404, {}, {'error': 'not found'}
+
+    def stats(self):
+        return {'requests': self.request_count, 'errors': self.error_count, 'throttled': self.throttle_count}
+
+
+class WriteRecorder:
+    # Remembers when a benchmark marker first reached a database
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first_seen = {}
+
+    def record(self, payload):
+        now = time.perf_counter()
+        with self.lock:
+            for marker in MARKER_REGEX.findall(json.dumps(payload)):
+                self.first_seen.setdefault(marker, now)
+
+
+def fake_paper(paper_id):
+    rng = random.Random(paper_id)
+    first = rng.choice(['Ada', 'Alan', 'Grace', 'Edsger', 'Barbara', 'Donald'])
+    last = rng.choice(['Lovelace', 'Turing', 'Hopper', 'Dijkstra', 'Liskov', 'Knuth'])
+    return {
+        'title': f"Benchmark paper {paper_id}",
+        'authors': [f"{first} {last}", "Bench Mark"],
+        'abstract': f"Synthetic abstract for {paper_id}. " * 5,
+        'published': '2021-01-01T00:00:00Z',
+    }
+
+
+class FakeArxiv(FakeService):
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api/query"
+
+    def route(self, method, path, query, body):
+        if path != '/api/query':
+            return 404, {}, {}
+        entries = []
+        for arxiv_id in query.get('id_list', '').split(','):
+            if not arxiv_id:
+                continue
+            paper = fake_paper(arxiv_id)
+            authors = ''.join(f"<author><name>{author}</name></author>" for author in paper['authors'])
+            entries.append(f"<entry><id>http://arxiv.org/abs/{arxiv_id}v1</id><title>{paper['title']}</title>"
+                           f"<summary>{paper['abstract']}</summary><published>{paper['published']}</published>"
+                           f"{authors}<category term=\"cs.LG\"/></entry>")
+        feed = f'<feed xmlns="http://www.w3.org/2005/Atom">{"".join(entries)}</feed>'
+        return 200, {'Content-Type': 'application/atom+xml'}, feed.encode()
+
+
+class FakePapersWithCode(FakeService):
+    # Every paper has one official repository; dump_links are the paper links listed in the links dump
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.dump_links = []
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api/v1"
+
+    @property
+    def dump_url(self):
+        return f"{self.url}/links-between-papers-and-code.json.gz"
+
+    def dump(self):
+        papers = []
+        for link in self.dump_links:
+            arxiv_match = re.search(r'arxiv\.org/abs/(\d{4}\.\d{5})', link)
+            paper_id = arxiv_match.group(1) if arxiv_match else link.rpartition('id=')[2]
+            papers.append({'paper_url_abs': link, 'paper_arxiv_id': arxiv_match.group(1) if arxiv_match else None,
+                           'is_official': True, 'repo_url': f"https://github.com/bench/{paper_id}"})
+        return gzip.compress(json.dumps(papers).encode())
+
+    def route(self, method, path, query, body):
+        if path == '/api/v1/papers/':
+            paper_id = query.get('arxiv_id') or query.get('url_abs', '').rpartition('id=')[2]
+            return 200, {}, {'results': [{'id': f"paper-{paper_id}"}]}
+        if path == '/links-between-papers-and-code.json.gz':
+            return 200, {'Content-Type': 'application/gzip'}, self.dump()
+        match = re.match(r'^/api/v1/papers/paper-([^/]+)/repositories/$', path)
+        if match:
+            repo = {'url': f"https://github.com/bench/{match.group(1)}", 'is_official': True}
+            return 200, {}, {'results': [repo], 'next': None}
+        return 404, {}, {}
+
+
+class FakeOpenReview(FakeService):
+
+    def route(self, method, path, query, body):
+        if path != '/notes':
+            return 404, {}, {}
+        paper = fake_paper(query.get('id', ''))
+        note = {
+            'content': {
+                'title': {'value': paper['title']},
+                'authors': {'value': paper['authors']},
+                'abstract': {'value': paper['abstract']},
+            },
+            'cdate': 1609459200000,
+        }
+        return 200, {}, {'notes': [note]}
+
+
+def rich_text_plain(items):
+    return [dict(item, plain_text=item.get('text', {}).get('content', '')) for item in items]
+
+
+class FakeNotion(FakeService):
+    # Just enough of the Notion API for notionHandler
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = {}
+        self.blocks = {}
+        self.recorder = WriteRecorder()
+
+    def _store_properties(self, page, properties):
+        for name, value in properties.items():
+            if 'rich_text' in value:
+                value = {'rich_text': rich_text_plain(value['rich_text'])}
+            if 'title' in value:
+                value = {'title': rich_text_plain(value['title'])}
+            page['properties'][name] = value
+        page['last_edited_time'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _append_blocks(self, block_id, blocks):
+        children = self.blocks.setdefault(block_id, [])
+        for block in blocks:
+            block = dict(block, id=f"block-{len(children) + 1}", object='block')
+            if 'paragraph' in block:
+                block['paragraph'] = {'rich_text': rich_text_plain(block['paragraph']['rich_text'])}
+            children.append(block)
+
+    def route(self, method, path, query, body):
+        if method == 'POST' and re.match(r'^/v1/databases/[^/]+/query$', path):
+            results = list(self.pages.values())
+            link_filter = (body or {}).get('filter', {})
+            if link_filter.get('property') == 'Link':
+                results = [page for page in results
+                           if page['properties'].get('Link', {}).get('url') == link_filter['url']['equals']]
+            if link_filter.get('timestamp') == 'last_edited_time':
+                since = link_filter['last_edited_time']['on_or_after']
+                results = [page for page in results if page['last_edited_time'] >= since]
+            return 200, {}, {'object': 'list', 'results': results, 'has_more': False, 'next_cursor': None}
+        match = re.match(r'^/v1/databases/([^/]+)$', path)
+        if method == 'GET' and match:
+            return 200, {}, {'object': 'database', 'id': match.group(1), 'properties': {}}
+        if method == 'POST' and path == '/v1/pages':
+            self.recorder.record(body)
+            page_id = f"page-{len(self.pages) + 1}"
+            page = {'object': 'page', 'id': page_id, 'properties': {}}
+            self._store_properties(page, body['properties'])
+            self.pages[page_id] = page
+            self._append_blocks(page_id, body.get('children', []))
+            return 200, {}, page
+        match = re.match(r'^/v1/pages/([^/]+)$', path)
+        if match and match.group(1) in self.pages:
+            page = self.pages[match.group(1)]
+            if method == 'PATCH':
+                self.recorder.record(body)
+                self._store_properties(page, body.get('properties', {}))
+            return 200, {}, page
+        match = re.match(r'^/v1/blocks/([^/]+)/children$', path)
+        if match:
+            children = self.blocks.setdefault(match.group(1), [])
+            if method == 'PATCH':
+                self.recorder.record(body)
+                self._append_blocks(match.group(1), body.get('children', []))
+            return 200, {}, {'object': 'list', 'results': children, 'has_more': False, 'next_cursor': None}
+        return 404, {}, {'object': 'error', 'status': 404, 'code': 'object_not_found', 'message': path}
+
+
+ZOTERO_KEY_CHARS = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+ZOTERO_FIELDS = ['title', 'abstractNote', 'date', 'url', 'note', 'linkMode', 'itemType', 'creators', 'tags',
+                 'collections', 'parentItem', 'accessDate', 'extra']
+
+
+class FakeZotero(FakeService):
+    # Just enough of the Zotero web API for zoteroHandler (through pyzotero)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.version = 1
+        self.items = {}
+        self.collections = {}
+        self.recorder = WriteRecorder()
+
+    def _new_key(self):
+        return ''.join(self.random.choice(ZOTERO_KEY_CHARS) for _ in range(8))
+
+    def _headers(self):
+        return {'Last-Modified-Version': str(self.version)}
+
+    def _write_objects(self, store, objects):
+        self.version += 1
+        response = {'successful': {}, 'success': {}, 'unchanged': {}, 'failed': {}}
+        for index, data in enumerate(objects):
+            data = dict(data)
+            key = data.get('key') or self._new_key()
+            data.update(key=key, version=self.version)
+            if data.get('parentItem') and data['parentItem'] not in self.items:
+                response['failed'][str(index)] = {'key': key, 'code': 400, 'message': 'Parent item not found'}
+                continue
+            obj = {'key': key, 'version': self.version, 'library': {}, 'links': {}, 'meta': {},
+                   'data': dict(store.get(key, {}).get('data', {}), **data)}
+            store[key] = obj
+            response['successful'][str(index)] = obj
+            response['success'][str(index)] = key
+        return response
+
+    def route(self, method, path, query, body):
+        match = re.match(r'^/(?:groups|users)/[^/]+(/.*)?$', path)
+        if not match:
+            if path.endswith('/itemFields'):
+                return 200, {}, [{'field': field, 'localized': field} for field in ZOTERO_FIELDS]
+            return 404, {}, {}
+        rest = match.group(1) or '/'
+        since = int(query.get('since', 0))
+        if rest == '/collections':
+            if method == 'POST':
+                return 200, self._headers(), self._write_objects(self.collections, body)
+            return 200, self._headers(), list(self.collections.values())
+        if rest in ('/items', '/items/top'):
+            if method == 'POST':
+                self.recorder.record(body)
+                return 200, self._headers(), self._write_objects(self.items, body)
+            items = [item for item in self.items.values() if item['version'] > since]
+            if query.get('itemKey'):
+                items = [self.items[key] for key in query['itemKey'].split(',') if key in self.items]
+            if rest == '/items/top':
+                items = [item for item in items if not item['data'].get('parentItem')]
+            if query.get('limit') == '1':
+                items = items[:1]
+            return 200, self._headers(), items
+        if rest == '/deleted':
+            return 200, self._headers(), {'collections': [], 'items': [], 'searches': [], 'tags': [], 'settings': []}
+        match = re.match(r'^/items/([^/]+)(/children)?$', rest)
+        if match and match.group(1) in self.items:
+            key = match.group(1)
+            if match.group(2):
+                children = [item for item in self.items.values() if item['data'].get('parentItem') == key]
+                if query.get('itemType'):
+                    children = [item for item in children if item['data'].get('itemType') == query['itemType']]
+                return 200, self._headers(), children
+            if method == 'PATCH':
+                self.recorder.record(body)
+                self._write_objects(self.items, [dict(body, key=key)])
+                return 204, self._headers(), b''
+            return 200, self._headers(), self.items[key]
+        return 404, {}, {}
+
+
+class FakeZulipClient:
+    # In-process stand-in for zulip.Client that timestamps every reply
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.messages = {}
+        self.sent = []  # (time, request)
+        self.updated = []  # (time, request)
+        self.call_count = 0
+
+    def send_message(self, request):
+        now = time.perf_counter()
+        with self.lock:
+            self.call_count += 1
+            message_id = self.next_id
+            self.next_id += 1
+            self.messages[message_id] = dict(request)
+            self.sent.append((now, dict(request, id=message_id)))
+        return {'result': 'success', 'id': message_id}
+
+    def update_message(self, request):
+        now = time.perf_counter()
+        with self.lock:
+            self.call_count += 1
+            message = self.messages.get(request['message_id'])
+            if message is not None and 'content' in request:
+                message['content'] = request['content']
+            self.updated.append((now, dict(request)))
+        return {'result': 'success'}
+
+    def get_raw_message(self, message_id):
+        with self.lock:
+            self.call_count += 1
+            message = self.messages.get(message_id)
+        if message is None:
+            return {'result': 'error'}
+        return {'result': 'success', 'raw_content': message['content']}
+
+
+class FakeAsyncZulipClient(FakeZulipClient):
+    # Coroutine version for the asyncio runtime; messages are fed in from another thread
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.queue = None
+        self.ready = threading.Event()
+
+    async def message_events(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.ready.set()
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            yield message
+
+    def feed(self, message):
+        # None ends the event stream
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    async def send_message(self, request):
+        return FakeZulipClient.send_message(self, request)
+
+    async def update_message(self, request):
+        return FakeZulipClient.update_message(self, request)
+
+    async def get_raw_message(self, message_id):
+        return FakeZulipClient.get_raw_message(self, message_id)
+
+    async def close(self):
+        pass
@@ -0,0 +1,283 @@
+# replay.py
+#
+# Feeds recorded or synthetic Zulip messages through zulipHandler against local fake services.
+# Run from the src folder: python -m benchmark.replay --messages 200 --ids-per-message 5
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark.fake_services import (
+    FakeArxiv, FakePapersWithCode, FakeOpenReview, FakeNotion, FakeZotero, FakeZulipClient, FakeAsyncZulipClient
+)
+from async_runtime import AsyncZulipHandler
+from database_handlers import notionHandler, zoteroHandler, merge_infos
+from handler_wrapper import HandlerWrapper
+from http_transport import HttpTransport, AsyncHttpTransport, set_default_transport
+from job_journal import JobJournal
+from paper_handlers import arxiveHandler, openreviewHandler, MetadataCache
+from rate_limiter import configure_rate_limits
+from repository_lookup import RepositoryIndex, RepositoryLookup
+import metrics
+from zulip_handler import zulipHandler
+
+
+def synthetic_messages(count, ids_per_message, pool_size, openreview_share, streams, seed):
+    rng = random.Random(seed)
+    arxiv_pool = [f"{2100 + i // 90000}.{10000 + i % 90000:05d}" for i in range(pool_size)]
+    messages = []
+    for i in range(count):
+        links = []
+        for _ in range(ids_per_message):
+            if rng.random() < openreview_share:
+                links.append(f"https://openreview.net/forum?id=bench{rng.randrange(pool_size)}")
+            else:
+                links.append(f"https://arxiv.org/abs/{rng.choice(arxiv_pool)}")
+        stream = f"stream-{rng.randrange(streams)}"
+        messages.append({
+            'id': i + 1,
+            'type': 'stream',
+            'sender_email': f"user{i % 17}@example.com",
+            'sender_full_name': f"User {i % 17}",
+            'display_recipient': stream,
+            'subject': 'papers',
+            'content': "Have a look:\n" + "\n".join(links),
+        })
+    return messages
+
+
+def recorded_messages(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def latency_summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p95_ms': round(percentile(values, 95) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+    }
+
+
+class ThreadSampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(threading.active_count())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return {'max': max(self.samples, default=0), 'mean': round(statistics.mean(self.samples), 1) if self.samples else 0}
+
+
+def service_kwargs(args, name):
+    return {
+        'latency': getattr(args, f"{name}_latency"),
+        'jitter': args.jitter,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+        'seed': args.seed,
+    }
+
+
+def run(args):
+    if args.trace_file:
+        metrics.set_span_exporter(metrics.SpanExporter(args.trace_file))
+    arxiv = FakeArxiv(**service_kwargs(args, 'arxiv')).start()
+    paperswithcode = FakePapersWithCode(**service_kwargs(args, 'paperswithcode')).start()
+    openreview = FakeOpenReview(**service_kwargs(args, 'openreview')).start()
+    notion = FakeNotion(**service_kwargs(args, 'notion')).start()
+    zotero = FakeZotero(**service_kwargs(args, 'zotero')).start()
+    fakes = {'arxiv': arxiv, 'paperswithcode': paperswithcode, 'openreview': openreview, 'notion': notion, 'zotero': zotero}
+
+    state_dir = tempfile.mkdtemp(prefix='paperbot-bench-')
+    state_db = os.path.join(state_dir, 'state.sqlite')
+
+    # All fakes share one host; the real per-service limits still apply to the Notion and Zotero clients
+    configure_rate_limits({'127.0.0.1': (args.http_rate, args.http_rate), 'notion': (args.notion_rate, args.notion_rate),
+                           'zotero': (args.zotero_rate, args.zotero_rate)})
+    transport = HttpTransport()
+    set_default_transport(transport)
+    use_asyncio = args.runtime == 'asyncio'
+    async_transport = AsyncHttpTransport() if use_asyncio else None
+    cache = MetadataCache(path=state_db) if args.cache else None
+
+    arxiv_handler = arxiveHandler(cache=cache, transport=transport, async_transport=async_transport)
+    arxiv_handler.api_url = arxiv.api_url
+    openreview_handler = openreviewHandler(cache=cache, transport=transport, async_transport=async_transport)
+    openreview_handler.api2_url = openreview.url
+    openreview_handler.api_url = openreview.url
+
+    journal = JobJournal(path=state_db)
+    database_handlers = [
+        HandlerWrapper(notionHandler, init_kwargs={'auth_token': 'bench', 'database_id': 'bench', 'base_url': notion.url,
+                                                   'index_path': state_db},
+                       breaker_config={'base_delay': args.breaker_delay},
+                       deadline=args.write_deadline, journal=journal, merge=merge_infos, start_thread=not use_asyncio),
+        HandlerWrapper(zoteroHandler, init_kwargs={'group_id': '1', 'api_key': 'bench', 'index_path': state_db,
+                                                   'endpoint': zotero.url},
+                       breaker_config={'base_delay': args.breaker_delay},
+                       deadline=args.write_deadline, journal=journal, merge=merge_infos, start_thread=not use_asyncio),
+    ]
+
+    if args.messages_file:
+        messages = recorded_messages(args.messages_file)
+    else:
+        messages = synthetic_messages(args.messages, args.ids_per_message, args.pool_size, args.openreview_share,
+                                      args.streams, args.seed)
+
+    index = None
+    if args.repository_index:
+        # The snapshot is downloaded before the replay, like a bot that has been running for a while
+        paperswithcode.dump_links = sorted({link for message in messages for link in
+                                            re.findall(r'https?://(?:arxiv\.org|openreview\.net)/\S+', message['content'])})
+        index = RepositoryIndex(path=state_db, dump_url=paperswithcode.dump_url, transport=transport)
+        index.refresh()
+    repositories = RepositoryLookup(transport=transport, async_transport=async_transport, index=index, cache=cache,
+                                    api_url=paperswithcode.api_url)
+
+    bot_class = AsyncZulipHandler if use_asyncio else zulipHandler
+    zulip_client = FakeAsyncZulipClient() if use_asyncio else FakeZulipClient()
+    bot = bot_class(email='bot@example.com', api_key='bench', site='http://127.0.0.1', client=zulip_client,
+                    paper_handlers=[arxiv_handler, openreview_handler], database_handlers=database_handlers,
+                    pipeline_config=json.loads(args.pipeline_config) if args.pipeline_config else None,
+                    repositories=repositories)
+    # Tag every message so replies and database writes can be traced back to it
+    for i, message in enumerate(messages):
+        message['subject'] = f"bench-msg-{i}"
+        message['content'] = f"{message['content']}\n[bench-msg-{i}]"
+
+    sampler = ThreadSampler()
+    sampler.start()
+    if use_asyncio:
+        runner = threading.Thread(target=bot.run, daemon=True)
+        runner.start()
+        submit = zulip_client.feed
+    else:
+        bot.pipeline.start()
+        for handler_wrapper in database_handlers:
+            handler_wrapper.on_replay = bot.replay_finished
+        submit = bot.handle_message
+
+    submitted = {}
+    start = time.perf_counter()
+    for i, message in enumerate(messages):
+        if args.rate > 0:
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submitted[f"bench-msg-{i}"] = time.perf_counter()
+        submit(message)
+
+    # Wait until every marker reached both databases, or give up
+    expected = set(submitted)
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        written = set(notion.recorder.first_seen) & set(zotero.recorder.first_seen)
+        if expected <= written:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    threads = sampler.stop()
+
+    first_reply = {}
+    with zulip_client.lock:
+        for sent_at, request in zulip_client.sent:
+            first_reply.setdefault(request['subject'], sent_at)
+
+    report = {
+        'messages': len(messages),
+        'elapsed_s': round(elapsed, 2),
+        'messages_per_s': round(len(messages) / elapsed, 2),
+        'time_to_first_reply': latency_summary([first_reply[key] - submitted[key] for key in submitted if key in first_reply]),
+        'time_to_notion_write': latency_summary([notion.recorder.first_seen[key] - submitted[key]
+                                                 for key in submitted if key in notion.recorder.first_seen]),
+        'time_to_zotero_write': latency_summary([zotero.recorder.first_seen[key] - submitted[key]
+                                                 for key in submitted if key in zotero.recorder.first_seen]),
+        'threads': threads,
+        'zulip_api_calls': None,
+        'services': {name: fake.stats() for name, fake in fakes.items()},
+    }
+
+    if use_asyncio:
+        zulip_client.feed(None)
+        runner.join()
+    else:
+        bot.stop()
+        for handler_wrapper in database_handlers:
+            handler_wrapper.stop_periodic_reinitialization()
+    # Counted after shutdown, so the last debounced reply edits are included
+    with zulip_client.lock:
+        report['zulip_api_calls'] = zulip_client.call_count
+    transport.close()
+    for fake in fakes.values():
+        fake.stop()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay Zulip messages through the bot against local fake services.")
+    parser.add_argument('--messages', type=int, default=100, help="number of synthetic messages")
+    parser.add_argument('--messages-file', help="JSON lines file with recorded Zulip message events")
+    parser.add_argument('--ids-per-message', type=int, default=3)
+    parser.add_argument('--pool-size', type=int, default=200, help="distinct papers to draw links from")
+    parser.add_argument('--openreview-share', type=float, default=0.2)
+    parser.add_argument('--streams', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=0, help="messages per second, 0 sends them all at once")
+    for name, latency in [('arxiv', 0.3), ('paperswithcode', 0.2), ('openreview', 0.2), ('notion', 0.15), ('zotero', 0.15)]:
+        parser.add_argument(f'--{name}-latency', type=float, default=latency, help="seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.05, help="extra uniform random latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After sent with injected 429s")
+    parser.add_argument('--http-rate', type=float, default=1000, help="token bucket rate for the fake paper APIs")
+    parser.add_argument('--notion-rate', type=float, default=3)
+    parser.add_argument('--zotero-rate', type=float, default=5)
+    parser.add_argument('--breaker-delay', type=float, default=1, help="first circuit breaker backoff before a health probe")
+    parser.add_argument('--write-deadline', type=float, default=30, help="seconds per database write before it is reported as pending")
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help="disable the metadata cache")
+    parser.add_argument('--repository-index', action='store_true',
+                        help="look up repositories in a local links dump instead of the paperswithcode API")
+    parser.add_argument('--pipeline-config', help="JSON with per-stage overrides, like PIPELINE_CONFIG")
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads', help="like RUNTIME in config.py")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait for all database writes")
+    parser.add_argument('--metrics', action='store_true', help="print the Prometheus metrics after the run")
+    parser.add_argument('--trace-file', help="write per-message spans as JSON lines to this file")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run(args)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if args.metrics:
+        print(metrics.registry.render_prometheus())
@@ -0,0 +1,110 @@
+# circuit_breaker.py
+
+import random
+import threading
+import time
+from collections import deque
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_BREAKER_CONFIG = {
+    'failure_rate': 0.5,  # share of failed writes in the window that opens the circuit
+    'min_calls': 4,  # writes in the window before the failure rate counts, so one timeout does not open it
+    'window': 120,  # in seconds
+    'base_delay': 5,  # first wait before a health probe, in seconds
+    'max_delay': 300,  # the wait doubles per failed probe up to this
+    'jitter': 0.3,  # waits are shortened by up to this share, so restarted bots do not probe in lockstep
+}
+
+
+class CircuitBreaker:
+    # closed: writes go through and outcomes are counted.
+    # open: writes are deferred to the journal until the backoff has passed.
+    # half_open: one health probe decides between closed and open (with a longer backoff).
+
+    def __init__(self, name, failure_rate=0.5, min_calls=4, window=120, base_delay=5, max_delay=300, jitter=0.3):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.outcomes = deque()  # (time, exception or None)
+        self.state = CLOSED
+        self.failed_probes = 0
+        self.open_until = 0
+        metrics.register_gauge('circuit_open', lambda: int(self.state != CLOSED), handler=name)
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"{self.name} circuit {self.state} -> {state}.")
+            metrics.inc('circuit_transitions_total', handler=self.name, state=state)
+            self.state = state
+
+    def _open(self):
+        delay = min(self.base_delay * 2 ** self.failed_probes, self.max_delay)
+        delay *= 1 - self.jitter * random.random()
+        self.open_until = time.time() + delay
+        self.outcomes.clear()
+        self._set_state(OPEN)
+
+    def _count(self, error):
+        now = time.time()
+        self.outcomes.append((now, error))
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def allow(self):
+        with self.lock:
+            return self.state == CLOSED
+
+    def record_success(self):
+        with self.lock:
+            if self.state == CLOSED:
+                self._count(None)
+
+    def record_failure(self, error):
+        with self.lock:
+            # A batched or coalesced write fails all its callers with the same exception, that is one failure
+            if self.state != CLOSED or any(seen is error for _, seen in self.outcomes):
+                return
+            self._count(error)
+            failures = sum(seen is not None for _, seen in self.outcomes)
+            if len(self.outcomes) >= self.min_calls and failures >= self.failure_rate * len(self.outcomes):
+                self._open()
+
+    def trip(self):
+        # Open right away, e.g. when the handler could not be constructed at all
+        with self.lock:
+            if self.state == CLOSED:
+                self._open()
+
+    def start_probe(self):
+        # True if the backoff has passed and the caller should now run the health probe
+        with self.lock:
+            if self.state != OPEN or time.time() < self.open_until:
+                return False
+            self._set_state(HALF_OPEN)
+            return True
+
+    def probe_succeeded(self):
+        with self.lock:
+            self.failed_probes = 0
+            self.outcomes.clear()
+            self._set_state(CLOSED)
+
+    def probe_failed(self):
+        with self.lock:
+            self.failed_probes += 1
+            self._open()
+
+    def seconds_until_probe(self):
+        with self.lock:
+            if self.state != OPEN:
+                return None
+            return max(self.open_until - time.time(), 0)
@@ -1,133 +1,441 @@
+import re
+import html
+import time
+import asyncio
+import secrets
+import threading
 from datetime import datetime
-from pyzotero import zotero
-from notion_client import Client
+from link_index import LinkIndex, PageIndex, DEFAULT_STORE_PATH, normalize_link
+from single_flight import WriteBuffer
+from rate_limiter import call_with_rate_limit, call_with_rate_limit_async, get_bucket, retry_after_seconds, error_status
+
+COMMENT_SEPARATOR = "\n-----------------------\n"
+ZOTERO_MAX_WRITE_OBJECTS = 50
+ZOTERO_KEY_CHARS = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+NOTION_MERGED_PROPERTIES = ('Zulip stream(s) source', 'Shared on Zulip by', 'Source', 'Comments')
+NOTION_TEXT_LIMIT = 2000  # characters per rich text object
+NOTION_MAX_BLOCKS = 100  # children per create or append request
+
+
+def get_shares(info):
+    # Coalesced writes carry several shares; a plain info is a single share
+    if info.get('shares'):
+        return info['shares']
+    return [{'sender': info['sender'], 'stream': info['stream'], 'message_content': info['message_content']}]
+
+
+def merge_infos(infos):
+    merged = dict(infos[0])
+    if len(infos) > 1:
+        merged['shares'] = [share for info in infos for share in get_shares(info)]
+        merged['replay'] = any(info.get('replay') for info in infos)
+    return merged
+
+
+def share_to_comment(share):
+    return f"{share['sender']} [{share['stream']}]: {share['message_content']}"
+
+
+def comment_blocks(comments):
+    # One paragraph per comment; long Zulip messages are split over several rich text objects
+    return [{"object": "block", "type": "paragraph", "paragraph": {"rich_text": [
+        {"type": "text", "text": {"content": comment[start:start + NOTION_TEXT_LIMIT]}}
+        for start in range(0, max(len(comment), 1), NOTION_TEXT_LIMIT)]}} for comment in comments]
+
+
+def chunked(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def zotero_key():
+    return ''.join(secrets.choice(ZOTERO_KEY_CHARS) for _ in range(8))
 
 class zoteroHandler:
 
-    def __init__(self, group_id, api_key, zotero_type='group'):
+    def __init__(self, group_id, api_key, zotero_type='group', index_path=DEFAULT_STORE_PATH, endpoint=None,
+                 write_window=0.2, write_batch_size=20):
+        # The client libraries are imported with the first handler, so importing this module stays cheap
+        from pyzotero import zotero
         self.client = zotero.Zotero(group_id, zotero_type, api_key)
-        col = self.client.collections()
+        self.write_buffer = WriteBuffer(self.flush_writes, window=write_window, max_items=write_batch_size)
+        if endpoint is not None:
+            self.client.endpoint = endpoint
+        col = self._call(self.client.collections)
         self.collections = {c['data']['name']: c['key'] for c in col}
+        self.index = LinkIndex(f"zotero:{zotero_type}:{group_id}", path=index_path)
+        self.sync_index()
 
-    def update_db(self, info):
+    def _last_headers(self):
+        request = getattr(self.client, 'request', None)
+        return request.headers if request is not None else None
+
+    def _call(self, func, *args, **kwargs):
+        result = call_with_rate_limit('zotero', func, *args, headers=self._last_headers, **kwargs)
+        # Zotero may ask for a pause on successful responses as well
+        backoff = retry_after_seconds(self._last_headers(), default=None)
+        if backoff:
+            get_bucket('zotero').block_for(backoff)
+        return result
 
-        if info['stream'] not in self.collections:
-            response = self.client.create_collections([{'name': info['stream']}])
-            self.collections[info['stream']] = response['successful']['0']['key']
+    def _library_version(self):
+        # pyzotero keeps the last response around; its Last-Modified-Version saves a round trip
+        headers = self._last_headers()
+        version = headers.get('Last-Modified-Version') if headers is not None else None
+        if version is None:
+            return self._call(self.client.last_modified_version)
+        return int(version)
 
-        items = self.client.everything(self.client.items())
-        items = [item for item in items if 'data' in item and 'url' in item['data'] and info['link'] in item['data']['url']]
-        if items:
-            item = items[0]
-            item_id = item['key']
-            
-            existing_tags = item['data'].get('tags', [])
-            new_tags = [{'tag': info['sender']}]
+    def sync_index(self):
+        since = self.index.get_version()
+        if since is None:
+            items = self._call(lambda: self.client.everything(self.client.top()))
+        else:
+            items = self._call(lambda: self.client.everything(self.client.top(since=since)))
+        version = self._library_version()
+        if since is not None and version != since:
+            deleted = self._call(self.client.deleted, since=since).get('items', [])
+            if deleted:
+                self.index.remove_keys(deleted)
+        self.index.set_many([(item['data']['url'], item['key']) for item in items
+                             if 'data' in item and item['data'].get('url')])
+        self.index.set_version(version)
 
-            for new_tag in new_tags:
-                if new_tag not in existing_tags:
-                    existing_tags.append(new_tag)
+    def health_check(self):
+        # One small request instead of constructing the handler again, which refetches all collections
+        self._call(self.client.last_modified_version)
 
-            item['data']['tags'] = existing_tags
+    def update_db(self, info):
+        # Concurrent writes are collected and sent as multi-object requests, see flush_writes
+        return self.write_buffer.submit(info)
 
-            existing_collections = item['data'].get('collections', [])
-            new_collection = self.collections[info['stream']]
+    def flush_writes(self, infos):
+        # The same paper twice in one batch becomes one merged write
+        groups = {}
+        for index, info in enumerate(infos):
+            groups.setdefault(normalize_link(info['link']), []).append(index)
+        papers = [merge_infos([infos[i] for i in indices]) for indices in groups.values()]
 
-            if new_collection not in existing_collections:
-                existing_collections.append(new_collection)
+        new_streams = list(dict.fromkeys(share['stream'] for info in papers for share in get_shares(info)
+                                         if share['stream'] not in self.collections))
+        if new_streams:
+            response = self._call(self.client.create_collections, [{'name': stream} for stream in new_streams])
+            for index, stream in enumerate(new_streams):
+                if str(index) in response['successful']:
+                    self.collections[stream] = response['successful'][str(index)]['key']
 
-            item['data']['collections'] = existing_collections
+        self.sync_index()
+        item_ids = [self.index.get(info['link']) for info in papers]
+        existing = self._items_by_key([item_id for item_id in item_ids if item_id is not None])
 
-            self.client.update_item(item)
-            return_text = f"The item already existed in Zotero. I updated it."
-        else:
-            new_item = {
-                'itemType': 'journalArticle',
-                'title': info['title'],
-                'creators': [{'creatorType': 'author', 'firstName': ' '.join(author.split(' ')[:-1]), 'lastName': author.split(' ')[-1]} for author in info['authors']],  # Adjust as needed
-                'url': info['link'],
-                'date': str(info['year']),
-                'tags': [{'tag': info['sender']}],
-                'abstractNote': info['abstract'],
-                'collections': [self.collections[info['stream']]],
-            }
-            created_items = self.client.create_items([new_item])
-            if created_items and '0' in created_items['successful']:
-                item_id = created_items['successful']['0']['key']
-                action_note_content = "This item was newly added to Zotero."
-                action = "added"
-                return_text = "I added the item to Zotero."
+        objects = []  # (paper index, role, object) in write order, parents before their children
+        results = []
+        for paper_index, (info, item_id) in enumerate(zip(papers, item_ids)):
+            shares = get_shares(info)
+            missing = [share['stream'] for share in shares if share['stream'] not in self.collections]
+            if missing:
+                results.append(RuntimeError(f"Could not create the Zotero collection(s) {', '.join(missing)}."))
+                continue
+            if item_id is not None and item_id in existing:
+                item = existing[item_id]['data']
+                for new_tag in [{'tag': share['sender']} for share in shares]:
+                    if new_tag not in item.setdefault('tags', []):
+                        item['tags'].append(new_tag)
+                for share in shares:
+                    if self.collections[share['stream']] not in item.setdefault('collections', []):
+                        item['collections'].append(self.collections[share['stream']])
+                objects.append((paper_index, 'item', item))
+                results.append("The item already existed in Zotero. I updated it.")
             else:
-                return "I Failed to add the paper to Zotero."
-            if info.get('github_repo') is not None:
-                linked_url = {
-                    'itemType': 'attachment',
-                    'linkMode': 'linked_url',
-                    'title': 'Official GitHub',
-                    'url': info['github_repo'],
-                    'parentItem': item_id,
-                }
-                self.client.create_items([linked_url])
-         
-        additional_note = {
-            'itemType': 'note',
-            'parentItem': item_id,
-            'note': f"{info['sender']} [{info['stream']}]: {info['message_content']}",
-        }
-        self.client.create_items([additional_note])
-           
-        return return_text
+                # Our own key lets the attachment and notes point at the item within the same request
+                item_id = zotero_key()
+                objects.append((paper_index, 'item', {
+                    'key': item_id,
+                    'itemType': 'journalArticle',
+                    'title': info['title'],
+                    'creators': [{'creatorType': 'author', 'firstName': ' '.join(author.split(' ')[:-1]), 'lastName': author.split(' ')[-1]} for author in info['authors']],  # Adjust as needed
+                    'url': info['link'],
+                    'date': str(info['year']),
+                    'tags': [{'tag': sender} for sender in dict.fromkeys(share['sender'] for share in shares)],
+                    'abstractNote': info['abstract'],
+                    'collections': list(dict.fromkeys(self.collections[share['stream']] for share in shares)),
+                }))
+                if info.get('github_repo') is not None:
+                    objects.append((paper_index, 'attachment', {
+                        'itemType': 'attachment',
+                        'linkMode': 'linked_url',
+                        'title': 'Official GitHub',
+                        'url': info['github_repo'],
+                        'parentItem': item_id,
+                    }))
+                results.append("I added the item to Zotero.")
+
+            note_texts = [share_to_comment(share) for share in shares]
+            if info.get('replay') and item_id in existing:
+                # Skip notes of a replayed job that made it in before the bot went down
+                note_texts = [note_text for note_text in note_texts if not self.has_note(item_id, note_text)]
+            objects.extend((paper_index, 'note', {'itemType': 'note', 'parentItem': item_id, 'note': note_text})
+                           for note_text in note_texts)
+
+        added = []
+        for start in range(0, len(objects), ZOTERO_MAX_WRITE_OBJECTS):
+            chunk = objects[start:start + ZOTERO_MAX_WRITE_OBJECTS]
+            try:
+                response = self._call(self.client.create_items, [obj for _, _, obj in chunk])
+            except Exception as e:
+                # Nothing after a failed request can be trusted to have a parent, so fail the rest too
+                for paper_index, _, _ in objects[start:]:
+                    if not isinstance(results[paper_index], Exception):
+                        results[paper_index] = e
+                break
+            for index, (paper_index, role, obj) in enumerate(chunk):
+                failure = response.get('failed', {}).get(str(index))
+                if failure is not None and not isinstance(results[paper_index], Exception):
+                    results[paper_index] = RuntimeError(f"Zotero rejected the {role}: {failure.get('message')}")
+                elif failure is None and role == 'item' and obj['key'] not in existing:
+                    added.append((papers[paper_index]['link'], obj['key']))
+        self.index.set_many(added)
+
+        out = [None] * len(infos)
+        for paper_index, indices in enumerate(groups.values()):
+            for index in indices:
+                out[index] = results[paper_index]
+        return out
+
+    def _items_by_key(self, item_ids):
+        items = {}
+        for start in range(0, len(item_ids), ZOTERO_MAX_WRITE_OBJECTS):
+            chunk = item_ids[start:start + ZOTERO_MAX_WRITE_OBJECTS]
+            for item in self._call(self.client.items, itemKey=','.join(chunk), limit=len(chunk)):
+                items[item['key']] = item
+        return items
+
+    def has_note(self, item_id, note_text):
+        for child in self._call(self.client.children, item_id, itemType='note'):
+            note = html.unescape(re.sub(r'<[^>]+>', ' ', child['data'].get('note', '')))
+            if ' '.join(note.split()) == ' '.join(note_text.split()):
+                return True
+        return False
 
 
 
 class notionHandler:
 
-    def __init__(self, auth_token, database_id):
-        self.client = Client(auth=auth_token)
+    def __init__(self, auth_token, database_id, base_url=None, index_path=DEFAULT_STORE_PATH, refresh_interval=60):
+        from notion_client import Client
+        self.client = Client(auth=auth_token, base_url=base_url) if base_url else Client(auth=auth_token)
         self.database_id = database_id
+        self.auth_token = auth_token
+        self.base_url = base_url
+        self.async_client = None
+        self.refresh_interval = refresh_interval  # in seconds
+        self.index = PageIndex(f"notion:{database_id}", path=index_path)
+        self.sync_lock = threading.Lock()
+        self.last_sync = 0
+        self.sync_index()
+
+    def _call(self, func, *args, **kwargs):
+        return call_with_rate_limit('notion', func, *args, **kwargs)
+
+    async def _call_async(self, func, *args, **kwargs):
+        return await call_with_rate_limit_async('notion', func, *args, **kwargs)
+
+    def health_check(self):
+        self._call(self.client.databases.retrieve, database_id=self.database_id)
+
+    def sync_index(self):
+        # The first run scans the whole database, later runs only pages edited since the last one
+        with self.sync_lock:
+            cursor = self.index.get_cursor()
+            query = {"database_id": self.database_id, "page_size": 100}
+            if cursor is not None:
+                query["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": cursor}}
+            latest = cursor
+            while True:
+                response = self._call(self.client.databases.query, **query)
+                self._remember(response['results'])
+                for page in response['results']:
+                    latest = max(latest or page['last_edited_time'], page['last_edited_time'])
+                if not response.get('has_more'):
+                    break
+                query["start_cursor"] = response['next_cursor']
+            if latest is not None:
+                self.index.set_cursor(latest)
+            self.last_sync = time.time()
+
+    def _remember(self, pages):
+        self.index.set_many([(page['properties'].get('Link', {}).get('url'), page['id'], page.get('last_edited_time'),
+                              {name: page['properties'][name] for name in NOTION_MERGED_PROPERTIES if name in page['properties']})
+                             for page in pages])
+
+    def _cached_page(self, info):
+        if time.time() - self.last_sync >= self.refresh_interval:
+            self.sync_index()
+        return self.index.get(info['link'])
+
+    def _forget_on_stale(self, e, info):
+        # The indexed page was deleted or archived in Notion, so look the link up again
+        if error_status(e) in (400, 404):
+            self.index.remove(info['link'])
+            return True
+        return False
+
+    def _query_args(self, info):
+        return {"database_id": self.database_id, "filter": {"property": "Link", "url": {"equals": info['link']}}}
+
+    def _update_properties(self, current_page, info):
+        # Returns None for the properties when the page already lists every sender and stream
+        shares = get_shares(info)
+        existing_streams = [tag['name'] for tag in current_page['properties']['Zulip stream(s) source']['multi_select']]
+        existing_people = [tag['name'] for tag in current_page['properties']['Shared on Zulip by']['multi_select']]
+        existing_sources = [tag['name'] for tag in current_page['properties']['Source']['multi_select']]
+
+        combined_streams = list(dict.fromkeys(existing_streams + [share['stream'] for share in shares]))
+        combined_people = list(dict.fromkeys(existing_people + [share['sender'] for share in shares]))
+        combined_sources = list(dict.fromkeys(existing_sources + ['Zulip']))
+        result = f"The paper already existed in Notion from the following streams: {', '.join(f'`{s}`' for s in existing_streams)}. I updated it."
+        if (combined_streams, combined_people, combined_sources) == (existing_streams, existing_people, existing_sources):
+            return None, result
+        properties = {
+            "Zulip stream(s) source": {"multi_select": [{"name": tag} for tag in combined_streams]},
+            "Shared on Zulip by": {"multi_select": [{"name": tag} for tag in combined_people]},
+            "Source": {"multi_select": [{"name": tag} for tag in combined_sources]},
+        }
+        return properties, result
+
+    def _create_properties(self, info):
+        shares = get_shares(info)
+        return {
+            "Name": {"title": [{"text": {"content": info['title']}}]},
+            "Link": {"url": info['link']},
+            "Code": {"url": info.get('github_repo')},
+            "Authors": {"rich_text": [{"type": "text", "text": {"content": " & ".join(info['authors'])}}]},
+            "Shared on Zulip by": {"multi_select": [{"name": sender} for sender in dict.fromkeys(share['sender'] for share in shares)]},
+            "Published": {"number": info['year']},
+            "Zulip stream(s) source": {"multi_select": [{"name": stream} for stream in dict.fromkeys(share['stream'] for share in shares)]},
+            "BibTeX": {"rich_text": [{"type": "text", "text": {"content": info['bibtex']}}]},
+            "Source": {"multi_select": [{"name": "Zulip"}]},
+        }
+
+    def _new_comments(self, page, info):
+        comments = [share_to_comment(share) for share in get_shares(info)]
+        if info.get('replay'):
+            # Skip comments of a replayed job that made it in before the bot went down
+            existing = self.existing_comments(page)
+            comments = [comment for comment in comments if comment not in existing]
+        return comments
+
+    def existing_comments(self, page):
+        # Comment blocks of the page, plus what is left in the Comments property from before they existed
+        comments = []
+        legacy = page['properties'].get('Comments', {}).get('rich_text', [])
+        if legacy:
+            comments.extend("".join(rt['plain_text'] for rt in legacy).split(COMMENT_SEPARATOR))
+        query = {"block_id": page['id'], "page_size": 100}
+        while True:
+            response = self._call(self.client.blocks.children.list, **query)
+            comments.extend("".join(rt['plain_text'] for rt in block['paragraph']['rich_text'])
+                            for block in response['results'] if block.get('type') == 'paragraph')
+            if not response.get('has_more'):
+                return comments
+            query["start_cursor"] = response['next_cursor']
+
+    def _write_page(self, page, info):
+        comments = self._new_comments(page, info)
+        properties, result = self._update_properties(page, info)
+        if properties is not None:
+            self._remember([self._call(self.client.pages.update, page_id=page['id'], properties=properties)])
+        # Every share adds its own blocks, the existing comments are never sent again
+        for blocks in chunked(comment_blocks(comments), NOTION_MAX_BLOCKS):
+            self._call(self.client.blocks.children.append, block_id=page['id'], children=blocks)
+        return result
+
+    async def _write_page_async(self, page, info):
+        client = self.async_client
+        comments = await asyncio.to_thread(self._new_comments, page, info) if info.get('replay') else self._new_comments(page, info)
+        properties, result = self._update_properties(page, info)
+        if properties is not None:
+            self._remember([await self._call_async(client.pages.update, page_id=page['id'], properties=properties)])
+        for blocks in chunked(comment_blocks(comments), NOTION_MAX_BLOCKS):
+            await self._call_async(client.blocks.children.append, block_id=page['id'], children=blocks)
+        return result
 
     def update_db(self, info):
-        query_response = self.client.databases.query(**{"database_id": self.database_id, "filter": {"property": "Link", "url": {"equals": info['link']}}})
+        page = self._cached_page(info)
+        if page is not None:
+            try:
+                return self._write_page(page, info)
+            except Exception as e:
+                if not self._forget_on_stale(e, info):
+                    raise
+        # Not indexed yet, e.g. added in Notion since the last sync
+        query_response = self._call(self.client.databases.query, **self._query_args(info))
         if query_response['results']:
-            page_id = query_response['results'][0]['id']
-            current_page = self.client.pages.retrieve(page_id=page_id)
-            existing_streams = [tag['name'] for tag in current_page['properties']['Zulip stream(s) source']['multi_select']]
-            existing_people = [tag['name'] for tag in current_page['properties']['Shared on Zulip by']['multi_select']]
-            existing_sources = [tag['name'] for tag in current_page['properties']['Source']['multi_select']]
-            
-            existing_comments = ""
-            if 'Comments' in current_page['properties'] and 'rich_text' in current_page['properties']['Comments']:
-                existing_comments = "".join([rt['plain_text'] for rt in current_page['properties']['Comments']['rich_text']])
-            
-            combined_streams = list(set(existing_streams + [info['stream']]))
-            combined_people = list(set(existing_people + [info['sender']]))
-            combined_sources = list(set(existing_sources + ['Zulip']))
-            combined_comments = existing_comments + ("\n-----------------------\n" if existing_comments else '') + f"{info['sender']} [{info['stream']}]: {info['message_content']}"
-            
-            self.client.pages.update(
-                page_id=page_id,
-                properties={
-                    "Zulip stream(s) source": {"multi_select": [{"name": tag} for tag in combined_streams]},
-                    "Shared on Zulip by": {"multi_select": [{"name": tag} for tag in combined_people]},
-                    "Source": {"multi_select": [{"name": tag} for tag in combined_sources]},
-                    "Comments": {"rich_text": [{"text": {"content": combined_comments}}]},
-                }
-            )
-            return f"The paper already existed in Notion from the following streams: {', '.join(f'`{s}`' for s in existing_streams)}. I updated it."
+            page = query_response['results'][0]
+            self._remember([page])
+            return self._write_page(page, info)
         else:
-            self.client.pages.create(
-                parent={"database_id": self.database_id},
-                properties={
-                    "Name": {"title": [{"text": {"content": info['title']}}]},
-                    "Link": {"url": info['link']},
-                    "Code": {"url": info.get('github_repo')},
-                    "Authors": {"rich_text": [{"type": "text", "text": {"content": " & ".join(info['authors'])}}]},
-                    "Shared on Zulip by": {"multi_select": [{"name": info['sender']}]},
-                    "Published": {"number": info['year']},
-                    "Zulip stream(s) source": {"multi_select": [{"name": info['stream']}]},
-                    "BibTeX": {"rich_text": [{"type": "text", "text": {"content": info['bibtex']}}]},
-                    "Source": {"multi_select": [{"name": "Zulip"}]},
-                    "Comments": {"rich_text": [{"text": {"content": f"{info['sender']} [{info['stream']}]: {info['message_content']}"}}]},
-                }
-            )
+            blocks = comment_blocks([share_to_comment(share) for share in get_shares(info)])
+            page = self._call(self.client.pages.create, parent={"database_id": self.database_id},
+                              properties=self._create_properties(info), children=blocks[:NOTION_MAX_BLOCKS])
+            self._remember([page])
+            for more_blocks in chunked(blocks[NOTION_MAX_BLOCKS:], NOTION_MAX_BLOCKS):
+                self._call(self.client.blocks.children.append, block_id=page['id'], children=more_blocks)
             return "I added the paper to Notion."
+
+    async def update_db_async(self, info):
+        if self.async_client is None:
+            # Created on first use so it binds to the running event loop
+            from notion_client import AsyncClient
+            self.async_client = AsyncClient(auth=self.auth_token, base_url=self.base_url) if self.base_url else AsyncClient(auth=self.auth_token)
+        client = self.async_client
+        if time.time() - self.last_sync >= self.refresh_interval:
+            await asyncio.to_thread(self.sync_index)
+        page = self.index.get(info['link'])
+        if page is not None:
+            try:
+                return await self._write_page_async(page, info)
+            except Exception as e:
+                if not self._forget_on_stale(e, info):
+                    raise
+        query_response = await self._call_async(client.databases.query, **self._query_args(info))
+        if query_response['results']:
+            page = query_response['results'][0]
+            self._remember([page])
+            return await self._write_page_async(page, info)
+        else:
+            blocks = comment_blocks([share_to_comment(share) for share in get_shares(info)])
+            page = await self._call_async(client.pages.create, parent={"database_id": self.database_id},
+                                          properties=self._create_properties(info), children=blocks[:NOTION_MAX_BLOCKS])
+            self._remember([page])
+            for more_blocks in chunked(blocks[NOTION_MAX_BLOCKS:], NOTION_MAX_BLOCKS):
+                await self._call_async(client.blocks.children.append, block_id=page['id'], children=more_blocks)
+            return "I added the paper to Notion."
+
+    def migrate_comments(self, dry_run=False):
+        # Moves the comments of the old single Comments property into comment blocks and empties the property
+        pages = []
+        query = {"database_id": self.database_id, "page_size": 100,
+                 "filter": {"property": "Comments", "rich_text": {"is_not_empty": True}}}
+        while True:
+            response = self._call(self.client.databases.query, **query)
+            pages.extend(response['results'])
+            if not response.get('has_more'):
+                break
+            query["start_cursor"] = response['next_cursor']
+
+        migrated = 0
+        for page in pages:
+            legacy = page['properties'].get('Comments', {}).get('rich_text', [])
+            comments = [comment for comment in "".join(rt['plain_text'] for rt in legacy).split(COMMENT_SEPARATOR) if comment.strip()]
+            if not comments:
+                continue
+            migrated += 1
+            print(f"{page['properties'].get('Link', {}).get('url')}: {len(comments)} comment(s)")
+            if dry_run:
+                continue
+            # An interrupted run is safe to repeat, comments already moved are not added twice
+            moved = self.existing_comments(dict(page, properties={}))
+            for blocks in chunked(comment_blocks([comment for comment in comments if comment not in moved]), NOTION_MAX_BLOCKS):
+                self._call(self.client.blocks.children.append, block_id=page['id'], children=blocks)
+            self._remember([self._call(self.client.pages.update, page_id=page['id'], properties={"Comments": {"rich_text": []}})])
+        return migrated
@@ -1,63 +1,334 @@
 # handler_wrapper.py
 
-import time
+import asyncio
+import inspect
 import threading
+import time
+from rate_limiter import is_rate_limit_error
+from circuit_breaker import CircuitBreaker, DEFAULT_BREAKER_CONFIG
+from single_flight import WriteCoalescer, AsyncWriteCoalescer
+from link_index import normalize_link
+import metrics
 
 class HandlerWrapper:
-    def __init__(self, handler_class, init_args=None, init_kwargs=None, retry_interval=300):
+    def __init__(self, handler_class, init_args=None, init_kwargs=None, breaker_config=None, journal=None, replay_interval=30,
+                 merge=None, start_thread=True, deadline=30, locks=None, lazy=False, init_wait=60):
         self.handler_class = handler_class
         self.init_args = init_args if init_args is not None else ()
         self.init_kwargs = init_kwargs if init_kwargs is not None else {}
-        self.retry_interval = retry_interval  # in seconds
+        self.replay_interval = replay_interval  # in seconds
+        self.deadline = deadline  # seconds a write may take before its result is reported as pending
+        self.breaker = CircuitBreaker(handler_class.__name__, **dict(DEFAULT_BREAKER_CONFIG, **(breaker_config or {})))
+        self.journal = journal
+        # With a merge function, concurrent writes for the same paper become one merged write
+        self.coalescer = WriteCoalescer(merge) if merge is not None else None
+        self.async_coalescer = AsyncWriteCoalescer(merge) if merge is not None else None
+        # local_store.SharedLocks when several bot processes write to the same databases, see sharding.py
+        self.locks = locks
+        self.on_replay = None  # called with (wrapper, job, result) after a journaled job went through
         self.handler = None
         self.initialized = False
         self.last_exception = None
         self._stop_reinit_thread = threading.Event()
+        self._replay_lock = threading.Lock()
+        self._replayed_startup = False
+        self._reinit_thread = None
+        # Set once the first initialisation attempt finished. With lazy, that attempt runs in the maintenance
+        # loop, so the bot can listen right away. Writes arriving before it are deferred to the journal, which the
+        # loop replays right after the attempt; the asyncio runtime first waits up to init_wait seconds for it.
+        self.ready = threading.Event()
+        self.init_wait = init_wait
 
-        self.attempt_initialization()
+        if not lazy:
+            self.attempt_initialization()
 
-        # Start the background thread for periodic re-initialization
-        self.start_periodic_reinitialization()
+        # Start the background thread for health probes and replays; the asyncio runtime runs maintain_async instead
+        if start_thread:
+            self.start_periodic_reinitialization()
+
+    @property
+    def name(self):
+        return self.handler_class.__name__
 
     def attempt_initialization(self):
+        metrics.inc('reinit_attempts_total', handler=self.name)
         try:
-            self.handler = self.handler_class(*self.init_args, **self.init_kwargs)
+            with metrics.timer('handler_init', handler=self.name):
+                self.handler = self.handler_class(*self.init_args, **self.init_kwargs)
             self.initialized = True
             self.last_exception = None
             print(f"{self.handler_class.__name__} initialized successfully.")
+            metrics.startup.mark(f"{self.name} ready")
         except Exception as e:
             self.handler = None
             self.initialized = False
             self.last_exception = e
             print(f"Warning: Failed to initialize {self.handler_class.__name__}. Exception: {e}")
+            self.breaker.trip()
+        self.ready.set()
+        return self.initialized
 
     def is_initialized(self):
         return self.initialized
 
-    def update_db(self, info):
+    def is_available(self):
+        return self.initialized and self.breaker.allow()
+
+    def probe(self):
+        # Runs when the breaker's backoff has passed. A handler that never came up is constructed again,
+        # otherwise its cheap health check decides, so e.g. Zotero does not refetch all collections
+        if not self.breaker.start_probe():
+            return
+        metrics.inc('health_probes_total', handler=self.name)
         if not self.initialized:
-            print(f"{self.handler_class.__name__} is not initialized. Skipping update.")
-            return f"{self.handler_class.__name__} update skipped due to initialization failure."
+            healthy = self.attempt_initialization()
+        else:
+            try:
+                with metrics.timer('health_probe', handler=self.name):
+                    self.handler.health_check()
+                healthy = True
+            except Exception as e:
+                print(f"Warning: Health check of {self.handler_class.__name__} failed. Exception: {e}")
+                self.last_exception = e
+                healthy = False
+        if healthy:
+            self.breaker.probe_succeeded()
+        else:
+            self.breaker.probe_failed()
+
+    def _next_wakeup(self):
+        until_probe = self.breaker.seconds_until_probe()
+        if until_probe is None:
+            # Closed or half-open: look again soon in case a burst of failures opens the circuit
+            return min(self.breaker.base_delay, self.replay_interval)
+        return max(min(until_probe, self.replay_interval), 0.1)
+
+    def pending_text(self):
+        return f"{self.handler_class.__name__} update pending, will retry."
+
+    def _open_job(self, info, job_key, status_message_id):
+        # Returns the journal key (or None) and a result to answer with right away (or None)
+        if self.journal is not None and job_key is not None:
+            job_key = f"{self.name}:{job_key}"
+            if not self.journal.add(job_key, self.name, info, status_message_id):
+                return job_key, f"{self.handler_class.__name__} already handled this message."
+        else:
+            job_key = None
+        return job_key, None
+
+    def _waiting_for_init(self):
+        if self.ready.is_set():
+            return False
+        metrics.inc('writes_waiting_for_init_total', handler=self.name)
+        return True
+
+    def _not_ready(self, job_key):
+        if job_key is not None:
+            self.journal.defer(job_key)
+            return self.pending_text()
+        return f"{self.handler_class.__name__} update skipped, it is still starting up."
+
+    def _check_available(self, job_key):
+        # Returns a result to answer with right away if the write cannot go through now, otherwise None
+        if not self.is_available():
+            print(f"{self.handler_class.__name__} is unavailable. Skipping update.")
+            metrics.inc('circuit_rejected_total', handler=self.name)
+            if job_key is not None:
+                self.journal.defer(job_key)
+                return self.pending_text()
+            if not self.initialized:
+                return f"{self.handler_class.__name__} update skipped due to initialization failure."
+            return f"{self.handler_class.__name__} update skipped, the service is failing."
+
+    def _write_failed(self, e, job_key):
+        print(f"Warning: Failed to update database {self.handler_class.__name__}. Exception: {e}")
+        # Being throttled says nothing about the handler's health, so only retry this one write
+        if not is_rate_limit_error(e):
+            self.breaker.record_failure(e)
+        self.last_exception = e
+        if job_key is not None:
+            self.journal.fail(job_key, e)
+            return self.pending_text()
+        return f"Failed to update {self.handler_class.__name__} due to an error."
+
+    def update_db(self, info, job_key=None, status_message_id=None):
+        job_key, result = self._open_job(info, job_key, status_message_id)
+        if result is not None:
+            return result
+        # Waiting here would hold a thread of the backend's write pool, so the maintenance loop writes it later
+        if self._waiting_for_init():
+            return self._not_ready(job_key)
+        result = self._check_available(job_key)
+        if result is not None:
+            return result
         try:
-            return self.handler.update_db(info)
+            result = self._write(info)
         except Exception as e:
-            print(f"Warning: Failed to update database {self.handler_class.__name__}. Exception: {e}")
-            # Optionally, reset initialized flag to retry initialization
-            self.initialized = False
-            self.last_exception = e
-            return f"Failed to update {self.handler_class.__name__} due to an error."
+            return self._write_failed(e, job_key)
+        if job_key is not None:
+            self.journal.complete(job_key)
+        return result
+
+    async def update_db_async(self, info, job_key=None, status_message_id=None):
+        job_key, result = self._open_job(info, job_key, status_message_id)
+        if result is not None:
+            return result
+        if self._waiting_for_init():
+            # Polled, so waiting writes do not hold threads of the bounded executor
+            wait_until = time.monotonic() + self.init_wait
+            while not self.ready.is_set() and time.monotonic() < wait_until:
+                await asyncio.sleep(0.1)
+        result = self._check_available(job_key)
+        if result is not None:
+            return result
+        try:
+            result = await self._write_async(info)
+        except Exception as e:
+            return self._write_failed(e, job_key)
+        if job_key is not None:
+            self.journal.complete(job_key)
+        return result
+
+    def _locked(self, write):
+        # Another process may be writing the same paper; it has to finish (and index its page or item) first
+        if self.locks is None:
+            return write
+
+        def locked_write(info):
+            with self.locks.hold(f"{self.name}:{normalize_link(info['link'])}"):
+                return write(info)
+        return locked_write
+
+    def _locked_async(self, write):
+        if self.locks is None:
+            return write
+
+        async def locked_write(info):
+            async with self.locks.hold_async(f"{self.name}:{normalize_link(info['link'])}"):
+                return await write(info)
+        return locked_write
+
+    def _write(self, info):
+        write = self._locked(self.handler.update_db)
+        try:
+            with metrics.timer('database_update', handler=self.name):
+                if self.coalescer is None:
+                    result = write(info)
+                else:
+                    result = self.coalescer.submit(normalize_link(info['link']), info, write)
+        except Exception:
+            metrics.inc('database_update_failures_total', handler=self.name)
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _write_async(self, info):
+        handler = self.handler
+        write = getattr(handler, 'update_db_async', None)
+        if write is None:
+            # Handlers without an async client (pyzotero is sync only) run in the loop's bounded executor
+            async def write(info):
+                return await asyncio.to_thread(handler.update_db, info)
+        write = self._locked_async(write)
+        try:
+            with metrics.timer('database_update', handler=self.name):
+                if self.async_coalescer is None:
+                    result = await write(info)
+                else:
+                    result = await self.async_coalescer.submit(normalize_link(info['link']), info, write)
+        except Exception:
+            metrics.inc('database_update_failures_total', handler=self.name)
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _replay_failed(self, job, e):
+        print(f"Warning: Failed to replay {job['key']}. Exception: {e}")
+        self.journal.fail(job['key'], e)
+        if not is_rate_limit_error(e):
+            self.breaker.record_failure(e)
+        self.last_exception = e
+
+    def replay_pending(self):
+        # Re-run journaled jobs that are due; after a restart every pending job is due
+        if self.journal is None or not self.is_available():
+            return
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            jobs = self.journal.due(self.name, ignore_schedule=not self._replayed_startup)
+            self._replayed_startup = True
+            for job in jobs:
+                if not self.breaker.allow():
+                    break
+                if not self.journal.claim(job['key']):
+                    continue
+                info = dict(job['info'], replay=True)
+                try:
+                    result = self._write(info)
+                except Exception as e:
+                    self._replay_failed(job, e)
+                    break
+                self.journal.complete(job['key'])
+                metrics.inc('journal_replays_total', handler=self.name)
+                if self.on_replay is not None:
+                    self.on_replay(self, job, result)
+        finally:
+            self._replay_lock.release()
+
+    async def replay_pending_async(self):
+        if self.journal is None or not self.is_available():
+            return
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            jobs = self.journal.due(self.name, ignore_schedule=not self._replayed_startup)
+            self._replayed_startup = True
+            for job in jobs:
+                if not self.breaker.allow():
+                    break
+                if not self.journal.claim(job['key']):
+                    continue
+                info = dict(job['info'], replay=True)
+                try:
+                    result = await self._write_async(info)
+                except Exception as e:
+                    self._replay_failed(job, e)
+                    break
+                self.journal.complete(job['key'])
+                metrics.inc('journal_replays_total', handler=self.name)
+                if self.on_replay is not None:
+                    replayed = self.on_replay(self, job, result)
+                    if inspect.isawaitable(replayed):
+                        await replayed
+        finally:
+            self._replay_lock.release()
+
+    async def maintain_async(self):
+        # The maintenance loop as a task of the asyncio runtime, so no thread per database is needed
+        if not self.ready.is_set():
+            await asyncio.to_thread(self.attempt_initialization)
+        while not self._stop_reinit_thread.is_set():
+            if self.breaker.seconds_until_probe() == 0:
+                await asyncio.to_thread(self.probe)
+            if self.on_replay is not None:
+                await self.replay_pending_async()
+            await asyncio.sleep(self._next_wakeup())
 
     def start_periodic_reinitialization(self):
         def reinit_loop():
+            if not self.ready.is_set():
+                self.attempt_initialization()
             while not self._stop_reinit_thread.is_set():
-                if not self.initialized:
-                    print(f"Attempting to re-initialize {self.handler_class.__name__}...")
-                    self.attempt_initialization()
-                # Sleep for the retry interval or until the event is set
-                self._stop_reinit_thread.wait(self.retry_interval)
+                self.probe()
+                if self.on_replay is not None:
+                    self.replay_pending()
+                # Sleep until the next probe or replay check or until the event is set
+                self._stop_reinit_thread.wait(self._next_wakeup())
         self._reinit_thread = threading.Thread(target=reinit_loop, daemon=True)
         self._reinit_thread.start()
 
     def stop_periodic_reinitialization(self):
         self._stop_reinit_thread.set()
-        self._reinit_thread.join()
+        if self._reinit_thread is not None:
+            self._reinit_thread.join()
@@ -0,0 +1,216 @@
+# http_transport.py
+
+import asyncio
+import importlib.util
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+from rate_limiter import get_bucket, retry_after_seconds, RATE_LIMIT_STATUSES
+
+try:
+    import httpx
+except ImportError:  # HTTP/2 is optional
+    httpx = None
+
+# httpx only speaks HTTP/2 with the h2 package (httpx[http2]) installed
+HTTP2_AVAILABLE = httpx is not None and importlib.util.find_spec('h2') is not None
+
+# Retried with backoff up to the host's retries. urllib3 does this for the requests sessions; httpx only retries
+# failed connections, so get() does it for the httpx clients. 503 is retried by get() with the rate limits.
+SERVER_ERROR_STATUSES = (500, 502, 504)
+
+DEFAULT_HOST_SETTINGS = {
+    'timeout': (5, 30),  # (connect, read) in seconds
+    'retries': 2,
+    'rate_limit_retries': 3,
+    'backoff_factor': 0.5,
+    'pool_size': 10,
+}
+
+HOST_SETTINGS = {
+    'export.arxiv.org': {'timeout': (5, 60)},
+    'paperswithcode.com': {'timeout': (5, 15)},
+    'api.openreview.net': {'timeout': (5, 20)},
+    'api2.openreview.net': {'timeout': (5, 20)},
+}
+
+
+def pool_limits(settings):
+    return httpx.Limits(max_connections=settings['pool_size'], max_keepalive_connections=settings['pool_size'])
+
+
+class HttpTransport:
+    # One keep-alive pool per host, shared by all paper handlers
+
+    def __init__(self, host_settings=None, default_settings=None, http2=False):
+        self.default_settings = dict(DEFAULT_HOST_SETTINGS, **(default_settings or {}))
+        self.host_settings = {host: dict(settings) for host, settings in HOST_SETTINGS.items()}
+        for host, settings in (host_settings or {}).items():
+            self.host_settings.setdefault(host, {}).update(settings)
+        if http2 and not HTTP2_AVAILABLE:
+            print("Warning: httpx[http2] is not installed, falling back to HTTP/1.1.")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def settings_for(self, host):
+        return dict(self.default_settings, **self.host_settings.get(host, {}))
+
+    def client_for(self, host):
+        with self._lock:
+            client = self._clients.get(host)
+            if client is None:
+                client = self._create_client(self.settings_for(host))
+                self._clients[host] = client
+            return client
+
+    def _create_client(self, settings):
+        if self.http2:
+            connect, read = settings['timeout']
+            # httpx ignores the client's limits when a transport is passed, so they go on the transport
+            return httpx.Client(
+                timeout=httpx.Timeout(read, connect=connect),
+                transport=httpx.HTTPTransport(http2=True, retries=settings['retries'], limits=pool_limits(settings)),
+                follow_redirects=True,
+            )
+        retry = Retry(
+            total=settings['retries'],
+            backoff_factor=settings['backoff_factor'],
+            # 503 is left to get(), which honours Retry-After, so the two retry layers do not multiply
+            status_forcelist=SERVER_ERROR_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        host = urlsplit(url).hostname
+        settings = self.settings_for(host)
+        if not self.http2:
+            # httpx clients carry their timeouts already
+            kwargs.setdefault('timeout', settings['timeout'])
+        bucket = get_bucket(host)
+        max_retries = settings['rate_limit_retries']
+        attempt = server_errors = 0
+        while True:
+            bucket.acquire()
+            with metrics.timer('http_request', host=host):
+                response = self.client_for(host).get(url, **kwargs)
+            metrics.inc('http_responses_total', host=host, status=response.status_code)
+            delay = self.server_error_delay(host, settings, response, server_errors) if self.http2 else None
+            if delay is not None:
+                server_errors += 1
+                time.sleep(delay)
+                continue
+            if response.status_code not in RATE_LIMIT_STATUSES or attempt == max_retries:
+                return response
+            delay = retry_after_seconds(response.headers, default=2 ** attempt)
+            attempt += 1
+            print(f"Warning: {host} rate limited us, retrying in {delay:.1f}s.")
+            metrics.inc('rate_limited_total', service=host)
+            metrics.inc('retries_total', service=host)
+            bucket.block_for(delay)
+
+    def server_error_delay(self, host, settings, response, retried):
+        if response.status_code not in SERVER_ERROR_STATUSES or retried >= settings['retries']:
+            return None
+        metrics.inc('retries_total', service=host)
+        return settings['backoff_factor'] * 2 ** retried
+
+    @contextmanager
+    def stream(self, url, chunk_size=1 << 20):
+        # Yields the response and an iterator over its body, for downloads that should not be held in memory.
+        # Rate limited like get(), but not retried; the caller has to start the download over anyway.
+        host = urlsplit(url).hostname
+        get_bucket(host).acquire()
+        with metrics.timer('http_request', host=host):
+            if self.http2:
+                with self.client_for(host).stream('GET', url) as response:
+                    metrics.inc('http_responses_total', host=host, status=response.status_code)
+                    yield response, response.iter_bytes(chunk_size)
+            else:
+                with self.client_for(host).get(url, stream=True, timeout=self.settings_for(host)['timeout']) as response:
+                    metrics.inc('http_responses_total', host=host, status=response.status_code)
+                    yield response, response.iter_content(chunk_size=chunk_size)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+class AsyncHttpTransport(HttpTransport):
+    # Same per-host settings and rate limits, backed by httpx.AsyncClient for the asyncio runtime
+
+    def __init__(self, host_settings=None, default_settings=None, http2=False):
+        if httpx is None:
+            raise RuntimeError("The asyncio runtime needs httpx: pip install httpx")
+        super().__init__(host_settings=host_settings, default_settings=default_settings, http2=http2)
+
+    def _create_client(self, settings):
+        connect, read = settings['timeout']
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            transport=httpx.AsyncHTTPTransport(http2=self.http2, retries=settings['retries'], limits=pool_limits(settings)),
+            follow_redirects=True,
+        )
+
+    async def get(self, url, **kwargs):
+        host = urlsplit(url).hostname
+        bucket = get_bucket(host)
+        settings = self.settings_for(host)
+        max_retries = settings['rate_limit_retries']
+        attempt = server_errors = 0
+        while True:
+            await bucket.acquire_async()
+            with metrics.timer('http_request', host=host):
+                response = await self.client_for(host).get(url, **kwargs)
+            metrics.inc('http_responses_total', host=host, status=response.status_code)
+            delay = self.server_error_delay(host, settings, response, server_errors)
+            if delay is not None:
+                server_errors += 1
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code not in RATE_LIMIT_STATUSES or attempt == max_retries:
+                return response
+            delay = retry_after_seconds(response.headers, default=2 ** attempt)
+            attempt += 1
+            print(f"Warning: {host} rate limited us, retrying in {delay:.1f}s.")
+            metrics.inc('rate_limited_total', service=host)
+            metrics.inc('retries_total', service=host)
+            bucket.block_for(delay)
+
+    async def aclose(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.aclose()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport()
+        return _default_transport
+
+
+def set_default_transport(transport):
+    global _default_transport
+    with _default_transport_lock:
+        _default_transport = transport
@@ -0,0 +1,79 @@
+# job_journal.py
+
+import json
+import sqlite3
+import time
+from local_store import get_store, DEFAULT_STORE_PATH
+
+
+class JobJournal:
+    # Durable record of pending database writes, keyed by an idempotency key
+
+    def __init__(self, path=DEFAULT_STORE_PATH, retry_base=30, retry_max=3600, lease=600):
+        self.store = get_store(path)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease  # how long a freshly added or claimed job belongs to the writer that took it
+        self.store.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                           "key TEXT PRIMARY KEY, handler TEXT, info TEXT, status_message_id INTEGER, "
+                           "status TEXT, attempts INTEGER, next_attempt REAL, created REAL, last_error TEXT, "
+                           "claimed_until REAL)")
+        if 'claimed_until' not in [row[1] for row in self.store.execute("PRAGMA table_info(jobs)")]:
+            try:
+                self.store.execute("ALTER TABLE jobs ADD COLUMN claimed_until REAL")
+            except sqlite3.OperationalError:
+                pass  # added by another bot process in the meantime
+        self.store.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (handler, status, next_attempt)")
+
+    def add(self, key, handler, info, status_message_id=None):
+        # Returns False if the job is already known, e.g. because the message was delivered twice
+        now = time.time()
+        # One statement, so it also holds when several bot processes share the journal
+        with self.store.transaction() as conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO jobs (key, handler, info, status_message_id, status, attempts, "
+                                  "next_attempt, created, last_error, claimed_until) "
+                                  "VALUES (?, ?, ?, ?, 'pending', 0, ?, ?, NULL, ?)",
+                                  (key, handler, json.dumps(info, default=str), status_message_id, now + self.lease, now,
+                                   now + self.lease))
+            return cursor.rowcount == 1
+
+    def claim(self, key):
+        # Takes a due job for one lease; False if another writer, e.g. the replay of another bot process, has it
+        now = time.time()
+        with self.store.transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET claimed_until = ? WHERE key = ? AND status = 'pending' "
+                                  "AND (claimed_until IS NULL OR claimed_until < ?)", (now + self.lease, key, now))
+            return cursor.rowcount == 1
+
+    def release_claims(self):
+        # On startup, before any writer runs, the claims left over from the last run are stale
+        self.store.execute("UPDATE jobs SET claimed_until = NULL WHERE status = 'pending'")
+
+    def complete(self, key):
+        self.store.execute("UPDATE jobs SET status = 'done', last_error = NULL WHERE key = ?", (key,))
+
+    def fail(self, key, error):
+        rows = self.store.execute("SELECT attempts FROM jobs WHERE key = ?", (key,))
+        attempts = rows[0][0] + 1 if rows else 1
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+        self.store.execute("UPDATE jobs SET attempts = ?, next_attempt = ?, last_error = ?, claimed_until = NULL "
+                           "WHERE key = ?", (attempts, time.time() + delay, str(error), key))
+
+    def defer(self, key):
+        # Handler is down, try again as soon as it comes back
+        self.store.execute("UPDATE jobs SET next_attempt = ?, claimed_until = NULL WHERE key = ?", (time.time(), key))
+
+    def due(self, handler, ignore_schedule=False, limit=100):
+        if ignore_schedule:
+            rows = self.store.execute("SELECT key, info, status_message_id, attempts FROM jobs "
+                                      "WHERE handler = ? AND status = 'pending' ORDER BY created LIMIT ?",
+                                      (handler, limit))
+        else:
+            rows = self.store.execute("SELECT key, info, status_message_id, attempts FROM jobs "
+                                      "WHERE handler = ? AND status = 'pending' AND next_attempt <= ? "
+                                      "ORDER BY created LIMIT ?", (handler, time.time(), limit))
+        return [{"key": key, "info": json.loads(info), "status_message_id": status_message_id, "attempts": attempts}
+                for key, info, status_message_id, attempts in rows]
+
+    def purge_done(self, older_than=7 * 24 * 3600):
+        self.store.execute("DELETE FROM jobs WHERE status = 'done' AND created <= ?", (time.time() - older_than,))
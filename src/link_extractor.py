@@ -0,0 +1,91 @@
+# link_extractor.py
+
+import re
+
+# A quote block opens with a line like ```quote and ends at the next line containing the same backticks
+QUOTE_PATTERN = r'^(?P<ticks>`+)quote'
+QUOTE_HINT = r'quote'
+
+
+class LinkExtractor:
+    # All paper ID patterns compiled into one scanner that also skips quoted text, in a single pass.
+    # Each pattern must capture the ID in a group named "id" and have no other capturing groups.
+    # A hint is a cheap regex found in every match of the pattern, ideally starting with a literal. When all
+    # patterns have one, the scanner only runs on the lines the hints were found on, which skips most of a pasted text.
+
+    def __init__(self):
+        self.sources = []  # (source, pattern, normalize, hint)
+        self.scanner = None
+        self.hints = None
+
+    @classmethod
+    def for_handlers(cls, paper_handlers):
+        extractor = cls()
+        for paper_handler in paper_handlers:
+            for pattern in paper_handler.id_patterns:
+                extractor.register(paper_handler.source, pattern, paper_handler.normalize_id, paper_handler.id_hint)
+        return extractor
+
+    def register(self, source, pattern, normalize=None, hint=None):
+        compiled = re.compile(pattern)
+        if set(compiled.groupindex) != {'id'} or compiled.groups != 1:
+            raise ValueError(f"Pattern for {source} must have exactly one capturing group, named id: {pattern}")
+        self.sources.append((source, pattern, normalize, hint))
+        self.scanner = None
+
+    def compile(self):
+        alternatives = [f"(?P<quote>{QUOTE_PATTERN})"]
+        for index, (_, pattern, _, _) in enumerate(self.sources):
+            alternatives.append(pattern.replace('(?P<id>', f'(?P<p{index}>', 1))
+        self.scanner = re.compile('|'.join(alternatives), re.MULTILINE)
+        hints = [hint for _, _, _, hint in self.sources]
+        self.hints = None if None in hints else [re.compile(hint) for hint in dict.fromkeys(hints + [QUOTE_HINT])]
+        return self.scanner
+
+    def candidate_lines(self, content):
+        # (start, end) of the lines a hint was found on, in order
+        if self.hints is None:
+            return [(0, len(content))]
+        starts = set()
+        for hint in self.hints:
+            for match in hint.finditer(content):
+                starts.add(content.rfind('\n', 0, match.start()) + 1)
+        lines = []
+        for start in sorted(starts):
+            end = content.find('\n', start)
+            lines.append((start, len(content) if end < 0 else end))
+        return lines
+
+    def extract(self, content, strip_quotes=True):
+        # Returns [(source, normalised id)] in order of appearance, without duplicates
+        scanner = self.scanner or self.compile()
+        found = {}  # (source, id) -> position
+        pos = 0
+        for start, end in self.candidate_lines(content):
+            pos = max(pos, start)
+            while pos <= end:
+                match = scanner.search(content, pos, end)
+                if match is None:
+                    break
+                if match.lastgroup == 'quote':
+                    if not strip_quotes:
+                        pos = match.end()
+                        continue
+                    # The line before the quote is Zulip's "... said:" header, drop what was found on it
+                    header_start = content.rfind('\n', 0, match.start() - 1) + 1 if match.start() > 0 else 0
+                    for key in [key for key, position in found.items() if position >= header_start]:
+                        del found[key]
+                    next_line = content.find('\n', match.end())
+                    closing = content.find(match.group('ticks'), next_line + 1) if next_line >= 0 else -1
+                    if closing < 0:
+                        return list(found)
+                    line_end = content.find('\n', closing)
+                    pos = len(content) + 1 if line_end < 0 else line_end + 1
+                    break
+                source, _, normalize, _ = self.sources[int(match.lastgroup[1:])]
+                paper_id = match.group(match.lastgroup)
+                if normalize is not None:
+                    paper_id = normalize(paper_id)
+                found.setdefault((source, paper_id), match.start())
+                pos = match.end()
+        return list(found)
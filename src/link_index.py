@@ -0,0 +1,94 @@
+# link_index.py
+
+import re
+import json
+from local_store import get_store, DEFAULT_STORE_PATH
+
+ARXIV_LINK_REGEX = re.compile(r'arxiv\.org/(?:abs|pdf)/(\d{4}\.\d{4,5})(?:v\d+)?', re.IGNORECASE)
+OPENREVIEW_LINK_REGEX = re.compile(r'openreview\.net/(?:forum|pdf)\?id=([A-Za-z0-9_\-]+)')
+
+
+def normalize_link(url):
+    if not url:
+        return None
+    match = ARXIV_LINK_REGEX.search(url)
+    if match:
+        return f"arxiv:{match.group(1)}"
+    match = OPENREVIEW_LINK_REGEX.search(url)
+    if match:
+        return f"openreview:{match.group(1)}"
+    return url.strip().rstrip('/')
+
+
+class LinkIndex:
+    # normalised link -> remote item key, plus the remote library version the mapping reflects
+    def __init__(self, namespace, path=DEFAULT_STORE_PATH):
+        self.namespace = namespace
+        self.store = get_store(path)
+        self.store.execute("CREATE TABLE IF NOT EXISTS link_index ("
+                           "namespace TEXT, link TEXT, key TEXT, PRIMARY KEY (namespace, link))")
+        self.store.execute("CREATE INDEX IF NOT EXISTS link_index_key ON link_index (namespace, key)")
+        self.store.execute("CREATE TABLE IF NOT EXISTS link_index_version ("
+                           "namespace TEXT PRIMARY KEY, version INTEGER)")
+
+    def get(self, link):
+        rows = self.store.execute("SELECT key FROM link_index WHERE namespace = ? AND link = ?",
+                                  (self.namespace, normalize_link(link)))
+        return rows[0][0] if rows else None
+
+    def set(self, link, key):
+        self.set_many([(link, key)])
+
+    def set_many(self, pairs):
+        self.store.executemany("INSERT OR REPLACE INTO link_index (namespace, link, key) VALUES (?, ?, ?)",
+                               [(self.namespace, normalize_link(link), key) for link, key in pairs if link])
+
+    def remove_keys(self, keys):
+        self.store.executemany("DELETE FROM link_index WHERE namespace = ? AND key = ?",
+                               [(self.namespace, key) for key in keys])
+
+    def get_version(self):
+        rows = self.store.execute("SELECT version FROM link_index_version WHERE namespace = ?", (self.namespace,))
+        return rows[0][0] if rows else None
+
+    def set_version(self, version):
+        self.store.execute("INSERT OR REPLACE INTO link_index_version (namespace, version) VALUES (?, ?)",
+                           (self.namespace, version))
+
+
+class PageIndex:
+    # normalised link -> (page id, last_edited_time, snapshot of the properties we merge into), plus a sync cursor
+    def __init__(self, namespace, path=DEFAULT_STORE_PATH):
+        self.namespace = namespace
+        self.store = get_store(path)
+        self.store.execute("CREATE TABLE IF NOT EXISTS page_index ("
+                           "namespace TEXT, link TEXT, page_id TEXT, last_edited TEXT, properties TEXT, "
+                           "PRIMARY KEY (namespace, link))")
+        self.store.execute("CREATE TABLE IF NOT EXISTS page_index_cursor ("
+                           "namespace TEXT PRIMARY KEY, cursor TEXT)")
+
+    def get(self, link):
+        rows = self.store.execute("SELECT page_id, last_edited, properties FROM page_index WHERE namespace = ? AND link = ?",
+                                  (self.namespace, normalize_link(link)))
+        if not rows:
+            return None
+        page_id, last_edited, properties = rows[0]
+        return {'id': page_id, 'last_edited_time': last_edited, 'properties': json.loads(properties)}
+
+    def set_many(self, entries):
+        # entries: (link, page id, last_edited_time, properties)
+        self.store.executemany("INSERT OR REPLACE INTO page_index (namespace, link, page_id, last_edited, properties) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               [(self.namespace, normalize_link(link), page_id, last_edited, json.dumps(properties))
+                                for link, page_id, last_edited, properties in entries if link])
+
+    def remove(self, link):
+        self.store.execute("DELETE FROM page_index WHERE namespace = ? AND link = ?", (self.namespace, normalize_link(link)))
+
+    def get_cursor(self):
+        rows = self.store.execute("SELECT cursor FROM page_index_cursor WHERE namespace = ?", (self.namespace,))
+        return rows[0][0] if rows else None
+
+    def set_cursor(self, cursor):
+        self.store.execute("INSERT OR REPLACE INTO page_index_cursor (namespace, cursor) VALUES (?, ?)",
+                           (self.namespace, cursor))
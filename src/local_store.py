@@ -0,0 +1,136 @@
+# local_store.py
+
+import asyncio
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager, asynccontextmanager
+import metrics
+
+DEFAULT_STORE_PATH = 'paperbot_state.sqlite'
+
+
+class LocalStore:
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL lets several readers (and later several bot processes) share the file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            rows = cursor.fetchall()
+            self.conn.commit()
+            return rows
+
+    def executemany(self, sql, seq_of_params):
+        with self.lock:
+            self.conn.executemany(sql, seq_of_params)
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        # Statements run on the yielded connection commit together, towards other processes sharing the file too
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SharedLocks:
+    # Named locks kept in the store, so bot processes sharing it do not work on the same key at the same time.
+    # Held locks are renewed every ttl / 3 seconds, however long the work takes, e.g. a Zotero write waiting out
+    # a Backoff. A lock whose holder died stops being renewed and is taken over after ttl seconds.
+
+    def __init__(self, path=DEFAULT_STORE_PATH, ttl=120, poll_interval=0.05):
+        self.store = get_store(path)
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.held = {}  # name -> owner, of the locks held by this process
+        self.held_lock = threading.Lock()
+        self._renew_thread = None
+        self.store.execute("CREATE TABLE IF NOT EXISTS shared_locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def try_acquire(self, name, owner):
+        now = time.time()
+        with self.store.transaction() as conn:
+            cursor = conn.execute("INSERT INTO shared_locks (name, owner, expires) VALUES (?, ?, ?) "
+                                  "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                                  "WHERE shared_locks.expires < ?", (name, owner, now + self.ttl, now))
+            acquired = cursor.rowcount == 1
+        if acquired:
+            with self.held_lock:
+                self.held[name] = owner
+                if self._renew_thread is None:
+                    self._renew_thread = threading.Thread(target=self._renew_loop, name='shared-locks', daemon=True)
+                    self._renew_thread.start()
+        return acquired
+
+    def release(self, name, owner):
+        with self.held_lock:
+            if self.held.get(name) == owner:
+                del self.held[name]
+        self.store.execute("DELETE FROM shared_locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def renew(self):
+        with self.held_lock:
+            held = list(self.held.items())
+        if held:
+            expires = time.time() + self.ttl
+            self.store.executemany("UPDATE shared_locks SET expires = ? WHERE name = ? AND owner = ?",
+                                   [(expires, name, owner) for name, owner in held])
+
+    def _renew_loop(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception as e:
+                print(f"Warning: Failed to renew the shared locks. Exception: {e}")
+
+    @contextmanager
+    def hold(self, name):
+        owner = uuid.uuid4().hex
+        if not self.try_acquire(name, owner):
+            metrics.inc('shared_lock_waits_total')
+            while not self.try_acquire(name, owner):
+                time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self.release(name, owner)
+
+    @asynccontextmanager
+    async def hold_async(self, name):
+        owner = uuid.uuid4().hex
+        if not self.try_acquire(name, owner):
+            metrics.inc('shared_lock_waits_total')
+            while not self.try_acquire(name, owner):
+                await asyncio.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self.release(name, owner)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path=DEFAULT_STORE_PATH):
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = LocalStore(path)
+        return _stores[path]
@@ -1,47 +1,229 @@
 from zulip_handler import zulipHandler
-from database_handlers import notionHandler, zoteroHandler
-from paper_handlers import arxiveHandler, openreviewHandler
+from database_handlers import notionHandler, zoteroHandler, merge_infos
+from paper_handlers import arxiveHandler, openreviewHandler, MetadataCache
 from config import (
     ZULIP_EMAIL, ZULIP_API_KEY, ZULIP_SITE,
     NOTION_TOKEN, NOTION_DATABASE_ID,
     ZOTERO_API_KEY, ZOTERO_GROUP_ID
 )
 from handler_wrapper import HandlerWrapper
+from repository_lookup import RepositoryIndex, RepositoryLookup, PAPERSWITHCODE_LINKS_DUMP_URL
+from job_journal import JobJournal
+from local_store import DEFAULT_STORE_PATH, SharedLocks
+from http_transport import HttpTransport, AsyncHttpTransport, set_default_transport
+from rate_limiter import configure_rate_limits, share_rate_limits
+from sharding import Coordinator, ShardClient
+import config
+import metrics
 import atexit
 
-if __name__ == "__main__":
-    paper_handlers = [arxiveHandler(), openreviewHandler()]
+# Optional settings, fall back to defaults when missing from config.py
+STATE_DB_PATH = getattr(config, 'STATE_DB_PATH', DEFAULT_STORE_PATH)
+METADATA_CACHE_SIZE = getattr(config, 'METADATA_CACHE_SIZE', 1024)
+METADATA_CACHE_TTL = getattr(config, 'METADATA_CACHE_TTL', 7 * 24 * 3600)
+METADATA_CACHE_NEGATIVE_TTL = getattr(config, 'METADATA_CACHE_NEGATIVE_TTL', 6 * 3600)
+PIPELINE_CONFIG = getattr(config, 'PIPELINE_CONFIG', {})
+HTTP_HOST_SETTINGS = getattr(config, 'HTTP_HOST_SETTINGS', {})
+HTTP2 = getattr(config, 'HTTP2', False)
+RATE_LIMITS = getattr(config, 'RATE_LIMITS', {})
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+TRACE_FILE = getattr(config, 'TRACE_FILE', None)
+NOTION_INDEX_REFRESH_INTERVAL = getattr(config, 'NOTION_INDEX_REFRESH_INTERVAL', 60)
+ZOTERO_WRITE_WINDOW = getattr(config, 'ZOTERO_WRITE_WINDOW', 0.2)
+ZOTERO_WRITE_BATCH_SIZE = getattr(config, 'ZOTERO_WRITE_BATCH_SIZE', 20)
+RUNTIME = getattr(config, 'RUNTIME', 'threads')
+ASYNC_CONFIG = getattr(config, 'ASYNC_CONFIG', {})
+REPLY_CONFIG = getattr(config, 'REPLY_CONFIG', {})
+CIRCUIT_BREAKER = getattr(config, 'CIRCUIT_BREAKER', {})
+NOTION_WRITE_DEADLINE = getattr(config, 'NOTION_WRITE_DEADLINE', 20)
+ZOTERO_WRITE_DEADLINE = getattr(config, 'ZOTERO_WRITE_DEADLINE', 30)
+REPOSITORY_INDEX = getattr(config, 'REPOSITORY_INDEX', False)
+REPOSITORY_INDEX_URL = getattr(config, 'REPOSITORY_INDEX_URL', PAPERSWITHCODE_LINKS_DUMP_URL)
+REPOSITORY_INDEX_REFRESH_INTERVAL = getattr(config, 'REPOSITORY_INDEX_REFRESH_INTERVAL', 7 * 24 * 3600)
+REPOSITORY_API_FALLBACK = getattr(config, 'REPOSITORY_API_FALLBACK', True)
+REPOSITORY_LOOKUP_TIMEOUT = getattr(config, 'REPOSITORY_LOOKUP_TIMEOUT', 10)
+WORKERS = getattr(config, 'WORKERS', 1)
+WORKER_QUEUE_SIZE = getattr(config, 'WORKER_QUEUE_SIZE', 1000)
+FAST_START = getattr(config, 'FAST_START', False)
+
+
+def create_paper_handlers(transport, async_transport=None):
+    metadata_cache = MetadataCache(
+        path=STATE_DB_PATH,
+        max_entries=METADATA_CACHE_SIZE,
+        ttl=METADATA_CACHE_TTL,
+        negative_ttl=METADATA_CACHE_NEGATIVE_TTL
+    )
+    metadata_cache.purge_expired()
+    return [
+        arxiveHandler(cache=metadata_cache, transport=transport, async_transport=async_transport),
+        openreviewHandler(cache=metadata_cache, transport=transport, async_transport=async_transport)
+    ]
+
 
-    database_handlers = [
+def create_repository_index(transport, start_thread=True):
+    if not REPOSITORY_INDEX:
+        return None
+    index = RepositoryIndex(path=STATE_DB_PATH, dump_url=REPOSITORY_INDEX_URL,
+                            refresh_interval=REPOSITORY_INDEX_REFRESH_INTERVAL, transport=transport)
+    if start_thread:
+        index.start()
+    return index
+
+
+def create_repository_lookup(transport, async_transport=None, start_thread=True):
+    index = create_repository_index(transport, start_thread)
+    cache = MetadataCache(
+        path=STATE_DB_PATH,
+        max_entries=METADATA_CACHE_SIZE,
+        ttl=METADATA_CACHE_TTL,
+        negative_ttl=METADATA_CACHE_NEGATIVE_TTL
+    )
+    return RepositoryLookup(transport=transport, async_transport=async_transport, index=index, cache=cache,
+                            api_fallback=REPOSITORY_API_FALLBACK, timeout=REPOSITORY_LOOKUP_TIMEOUT)
+
+
+def create_database_handlers(journal, start_thread=True, locks=None, lazy=False):
+    return [
         HandlerWrapper(
             notionHandler,
             init_kwargs={
                 'auth_token': NOTION_TOKEN,
-                'database_id': NOTION_DATABASE_ID
+                'database_id': NOTION_DATABASE_ID,
+                'index_path': STATE_DB_PATH,
+                'refresh_interval': NOTION_INDEX_REFRESH_INTERVAL
             },
-            retry_interval=300  # Retry every 5 minutes
+            breaker_config=CIRCUIT_BREAKER,
+            deadline=NOTION_WRITE_DEADLINE,
+            journal=journal,
+            merge=merge_infos,
+            locks=locks,
+            lazy=lazy,
+            start_thread=start_thread  # the asyncio runtime runs these loops as tasks
         ),
         HandlerWrapper(
             zoteroHandler,
             init_kwargs={
                 'group_id': ZOTERO_GROUP_ID,
-                'api_key': ZOTERO_API_KEY
+                'api_key': ZOTERO_API_KEY,
+                'index_path': STATE_DB_PATH,
+                'write_window': ZOTERO_WRITE_WINDOW,
+                'write_batch_size': ZOTERO_WRITE_BATCH_SIZE
             },
-            retry_interval=300  # Retry every 5 minutes
+            breaker_config=CIRCUIT_BREAKER,
+            deadline=ZOTERO_WRITE_DEADLINE,
+            journal=journal,
+            merge=merge_infos,
+            locks=locks,
+            lazy=lazy,
+            start_thread=start_thread
         ),
     ]
 
-    # Ensure that threads are stopped when the program exits
+
+def create_bot(shard_queue=None):
+    # Returns the bot and its cleanup. With a shard_queue, the bot is a worker process of the sharded mode
+    # and gets its messages from the coordinator, see sharding.py
+    configure_rate_limits(RATE_LIMITS)
+    if WORKERS > 1:
+        share_rate_limits(WORKERS)
+    transport = HttpTransport(host_settings=HTTP_HOST_SETTINGS, http2=HTTP2)
+    set_default_transport(transport)
+    use_asyncio = RUNTIME == 'asyncio'
+    async_transport = AsyncHttpTransport(host_settings=HTTP_HOST_SETTINGS, http2=HTTP2) if use_asyncio else None
+
+    paper_handlers = create_paper_handlers(transport, async_transport)
+    # In the sharded mode the coordinator keeps the repository index fresh
+    repositories = create_repository_lookup(transport, async_transport, start_thread=shard_queue is None)
+    metrics.startup.mark('paper handlers created')
+    journal = JobJournal(path=STATE_DB_PATH)
+    if shard_queue is None:
+        journal.purge_done()
+        journal.release_claims()
+    locks = SharedLocks(path=STATE_DB_PATH) if WORKERS > 1 else None
+    # With FAST_START, Notion and Zotero are set up in the background while the bot already listens
+    database_handlers = create_database_handlers(journal, start_thread=not use_asyncio, locks=locks, lazy=FAST_START)
+    metrics.startup.mark('database handlers created')
+
+    if use_asyncio:
+        from async_runtime import AsyncZulipHandler, AsyncZulipClient
+        client = None
+        if shard_queue is not None:
+            client = ShardClient(AsyncZulipClient(email=ZULIP_EMAIL, api_key=ZULIP_API_KEY, site=ZULIP_SITE), shard_queue)
+        zlp_handler = AsyncZulipHandler(
+            email=ZULIP_EMAIL,
+            api_key=ZULIP_API_KEY,
+            site=ZULIP_SITE,
+            paper_handlers=paper_handlers,
+            database_handlers=database_handlers,
+            pipeline_config=PIPELINE_CONFIG,
+            client=client,
+            async_config=ASYNC_CONFIG,
+            reply_config=REPLY_CONFIG,
+            repositories=repositories
+        )
+    else:
+        client = None
+        if shard_queue is not None:
+            import zulip
+            client = ShardClient(zulip.Client(email=ZULIP_EMAIL, api_key=ZULIP_API_KEY, site=ZULIP_SITE), shard_queue)
+        zlp_handler = zulipHandler(
+            email=ZULIP_EMAIL,
+            api_key=ZULIP_API_KEY,
+            site=ZULIP_SITE,
+            paper_handlers=paper_handlers,
+            database_handlers=database_handlers,
+            pipeline_config=PIPELINE_CONFIG,
+            client=client,
+            reply_config=REPLY_CONFIG,
+            repositories=repositories
+        )
+
+    metrics.startup.mark('bot created')
+
     def cleanup():
+        zlp_handler.stop()
+        transport.close()
         for handler in database_handlers:
             handler.stop_periodic_reinitialization()
-    atexit.register(cleanup)
-
-    zlp_handler = zulipHandler(
-        email=ZULIP_EMAIL,
-        api_key=ZULIP_API_KEY,
-        site=ZULIP_SITE,
-        paper_handlers=paper_handlers,
-        database_handlers=database_handlers
-    )
-    zlp_handler.run()
+    return zlp_handler, cleanup
+
+
+def start_observability(worker=None):
+    # Worker n of the sharded mode serves its metrics on METRICS_PORT + n + 1, the coordinator on METRICS_PORT
+    if METRICS_PORT is not None:
+        metrics.start_metrics_server(METRICS_PORT if worker is None else METRICS_PORT + worker + 1)
+    if TRACE_FILE is not None:
+        metrics.set_span_exporter(metrics.SpanExporter(TRACE_FILE))
+
+
+def run_worker(worker, shard_queue):
+    metrics.startup.mark('imports')
+    start_observability(worker)
+    zlp_handler, cleanup = create_bot(shard_queue)
+    try:
+        zlp_handler.run()
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    metrics.startup.mark('imports')
+    start_observability()
+    if WORKERS > 1:
+        import zulip
+        # The workers only share the state file, the coordinator does the housekeeping of the shared state
+        journal = JobJournal(path=STATE_DB_PATH)
+        journal.purge_done()
+        journal.release_claims()
+        configure_rate_limits(RATE_LIMITS)
+        create_repository_index(HttpTransport(host_settings=HTTP_HOST_SETTINGS, http2=HTTP2), start_thread=True)
+        coordinator = Coordinator(zulip.Client(email=ZULIP_EMAIL, api_key=ZULIP_API_KEY, site=ZULIP_SITE), WORKERS,
+                                  run_worker, ZULIP_EMAIL, queue_size=WORKER_QUEUE_SIZE)
+        atexit.register(coordinator.stop)
+        coordinator.run()
+    else:
+        zlp_handler, cleanup = create_bot()
+        # Ensure that threads are stopped when the program exits
+        atexit.register(cleanup)
+        zlp_handler.run()
@@ -0,0 +1,244 @@
+# metrics.py
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'paperbot_'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.descriptions = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def register_gauge(self, name, func, **labels):
+        # func is called at scrape time, e.g. to report a queue depth
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = func
+
+    def describe(self, name, text):
+        self.descriptions[name] = text
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.buckets, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        def header(name, kind):
+            if name in self.descriptions:
+                lines.append(f"# HELP {PREFIX}{name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for name in sorted({name for name, _ in counters}):
+            header(name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in gauges}):
+            header(name, 'gauge')
+            for (metric, labels), func in sorted(gauges.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                try:
+                    value = func()
+                except Exception:
+                    continue
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            header(name, 'histogram')
+            for (metric, labels), (buckets, counts, count, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class SpanExporter:
+    # Writes OpenTelemetry-style spans as JSON lines
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class StartupTimeline:
+    # Seconds from start to each startup step, printed and kept as startup_step_seconds{step=...} gauges.
+    # A step is recorded once, e.g. the first time a backend became ready.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def mark(self, step):
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            if step in self.steps:
+                return
+            self.steps[step] = elapsed
+        registry.register_gauge('startup_step_seconds', lambda: elapsed, step=step)
+        print(f"Startup: {step} after {elapsed:.2f}s.")
+
+
+registry = MetricsRegistry()
+startup = StartupTimeline()
+_exporter = None
+# Context variables instead of thread locals, so spans of concurrent asyncio tasks do not mix
+_trace_id = ContextVar('trace_id', default=None)
+_span_id = ContextVar('span_id', default=None)
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def register_gauge(name, func, **labels):
+    registry.register_gauge(name, func, **labels)
+
+
+def set_span_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+@contextmanager
+def trace(trace_id):
+    # Spans started in this thread or task belong to trace_id (the Zulip message id) until the block ends
+    trace_token = _trace_id.set(str(trace_id) if trace_id is not None else None)
+    span_token = _span_id.set(None)
+    try:
+        yield
+    finally:
+        _span_id.reset(span_token)
+        _trace_id.reset(trace_token)
+
+
+@contextmanager
+def timer(name, **labels):
+    # Observes the block's duration as <name>_seconds and emits a span when tracing is on
+    exporter = _exporter
+    parent_id = _span_id.get()
+    span_id = os.urandom(8).hex() if exporter is not None else None
+    span_token = _span_id.set(span_id) if span_id is not None else None
+    start_wall = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        registry.observe(f"{name}_seconds", duration, **labels)
+        if span_id is not None:
+            _span_id.reset(span_token)
+            exporter.export({
+                'trace_id': current_trace_id(),
+                'span_id': span_id,
+                'parent_span_id': parent_id,
+                'name': name,
+                'start_time': start_wall,
+                'end_time': start_wall + duration,
+                'attributes': labels,
+                'status': 'error' if error is not None else 'ok',
+                'error': str(error) if error is not None else None,
+            })
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            payload = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,21 @@
+# migrate_notion_comments.py
+#
+# Moves comments stored in the old Comments property of the Notion database into comment blocks on each page.
+# Run from the src folder: python migrate_notion_comments.py [--dry-run]
+
+import argparse
+from database_handlers import notionHandler
+from local_store import DEFAULT_STORE_PATH
+from config import NOTION_TOKEN, NOTION_DATABASE_ID
+import config
+
+STATE_DB_PATH = getattr(config, 'STATE_DB_PATH', DEFAULT_STORE_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move Notion Comments property contents into page blocks.")
+    parser.add_argument('--dry-run', action='store_true', help="only list the pages that would be migrated")
+    args = parser.parse_args()
+
+    handler = notionHandler(auth_token=NOTION_TOKEN, database_id=NOTION_DATABASE_ID, index_path=STATE_DB_PATH)
+    migrated = handler.migrate_comments(dry_run=args.dry_run)
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {migrated} page(s).")
@@ -1,10 +1,36 @@
 import re
-import requests
+import copy
+import asyncio
+import json
+import time
+import threading
 import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
 from datetime import datetime
+from local_store import get_store, DEFAULT_STORE_PATH
+from http_transport import get_default_transport
+from single_flight import SingleFlight, AsyncSingleFlight
+from link_extractor import LinkExtractor
+import metrics
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+ARXIV_API_URL = 'http://export.arxiv.org/api/query'
+OPENREVIEW_API2_URL = 'https://api2.openreview.net'
+OPENREVIEW_API_URL = 'https://api.openreview.net'
+ARXIV_MAX_IDS_PER_QUERY = 100
+FAILED_RESPONSE_LOG_SIZE = 100
+
+
+def strip_arxiv_version(arxiv_id):
+    return re.sub(r'v\d+$', '', arxiv_id)
 
 
 def paper_info_to_bibtex(paper_info, is_arxive=False):
+    with metrics.timer('bibtex'):
+        return _paper_info_to_bibtex(paper_info, is_arxive)
+
+
+def _paper_info_to_bibtex(paper_info, is_arxive=False):
     year = str(datetime.fromisoformat(paper_info['publish_date'].rstrip('Z')).year)
     bib_id = paper_info['authors'][0].split(' ')[1].lower() + year + re.sub(r'[^a-zA-Z]*$', '', paper_info['title'].split(' ')[0].lower())
     bib = (f"@misc{{{bib_id},\n"
@@ -22,106 +48,345 @@ def paper_info_to_bibtex(paper_info, is_arxive=False):
     return bib + add + "}" 
 
 
+class MetadataCache:
+    # In-memory LRU tier in front of a SQLite tier, keyed by (source, normalised id)
+
+    def __init__(self, path=DEFAULT_STORE_PATH, max_entries=1024, ttl=7 * 24 * 3600, negative_ttl=6 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.store = get_store(path) if path else None
+        if self.store is not None:
+            self.store.execute("CREATE TABLE IF NOT EXISTS paper_cache ("
+                               "source TEXT, paper_id TEXT, info TEXT, expires REAL, PRIMARY KEY (source, paper_id))")
+
+    def get(self, source, paper_id):
+        # Returns (hit, info); info is None for a cached negative result
+        key = (source, paper_id)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    metrics.inc('metadata_cache_hits_total', tier='memory', source=source)
+                    return True, copy.deepcopy(entry[1])
+                del self.memory[key]
+        if self.store is None:
+            metrics.inc('metadata_cache_misses_total', source=source)
+            return False, None
+        rows = self.store.execute("SELECT info, expires FROM paper_cache WHERE source = ? AND paper_id = ?", key)
+        if not rows or rows[0][1] <= now:
+            metrics.inc('metadata_cache_misses_total', source=source)
+            return False, None
+        metrics.inc('metadata_cache_hits_total', tier='disk', source=source)
+        info = json.loads(rows[0][0])
+        self._remember(key, rows[0][1], info)
+        return True, copy.deepcopy(info)
+
+    def put(self, source, paper_id, info):
+        key = (source, paper_id)
+        negative = info is None
+        expires = time.time() + (self.negative_ttl if negative else self.ttl)
+        self._remember(key, expires, copy.deepcopy(info))
+        if self.store is not None:
+            self.store.execute("INSERT OR REPLACE INTO paper_cache (source, paper_id, info, expires) VALUES (?, ?, ?, ?)",
+                               (source, paper_id, json.dumps(info), expires))
+
+    def _remember(self, key, expires, info):
+        with self.lock:
+            self.memory[key] = (expires, info)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def purge_expired(self):
+        with self.lock:
+            now = time.time()
+            for key in [key for key, entry in self.memory.items() if entry[0] <= now]:
+                del self.memory[key]
+        if self.store is not None:
+            self.store.execute("DELETE FROM paper_cache WHERE expires <= ?", (time.time(),))
+
+
 class paperHandler:
 
-    def __init__(self):
-        self.log = []
+    source = None
+    id_patterns = []  # regexes with one named group "id", see LinkExtractor
+    id_hint = None  # cheap regex found in every ID match, lets the extractor skip lines without one
+
+    def __init__(self, cache=None, transport=None, async_transport=None):
+        self.log = deque(maxlen=FAILED_RESPONSE_LOG_SIZE)  # the latest failed responses
+        self.cache = cache
+        self.http = transport if transport is not None else get_default_transport()
+        self.async_http = async_transport  # only set for the asyncio runtime
+        self.in_flight = SingleFlight()
+        self.async_in_flight = AsyncSingleFlight()
+        self.extractor = None
 
     def flush_log(self):
-        out = self.log
-        self.log = []
+        out = list(self.log)
+        self.log.clear()
         return out
 
+    def normalize_id(self, paper_id):
+        return paper_id
+
+    def extract_ids(self, message_content):
+        if self.extractor is None:
+            self.extractor = LinkExtractor.for_handlers([self])
+        return [paper_id for _, paper_id in self.extractor.extract(message_content, strip_quotes=False)]
+
+    def _from_cache(self, paper_ids):
+        infos = {}
+        missing = []
+        for paper_id in dict.fromkeys(paper_ids):
+            hit, info = self.cache.get(self.source, self.normalize_id(paper_id)) if self.cache else (False, None)
+            if not hit:
+                missing.append(paper_id)
+            elif info:
+                if 'id' in info:
+                    info['id'] = paper_id
+                infos[paper_id] = info
+        return infos, missing
+
+    def _claim(self, in_flight, paper_ids):
+        # Papers already being fetched by another caller are waited for instead of fetched again
+        leaders, followers = [], []
+        for paper_id in paper_ids:
+            key = (self.source, self.normalize_id(paper_id))
+            flight, leader = in_flight.claim(key)
+            (leaders if leader else followers).append((paper_id, key, flight))
+        if followers:
+            metrics.inc('metadata_fetch_shared_total', len(followers), source=self.source)
+        return leaders, followers
+
+    def _store_fetched(self, leaders, fetched, failed):
+        if self.cache:
+            # Only remember "not found" when the lookup itself did not fail
+            for paper_id, key, _ in leaders:
+                if paper_id in fetched or paper_id not in failed:
+                    self.cache.put(key[0], key[1], fetched.get(paper_id))
+        for paper_id, _, flight in leaders:
+            flight.resolve(fetched.get(paper_id))
+
+    def _followed(self, paper_id, info):
+        if info:
+            info = copy.deepcopy(info)
+            if 'id' in info:
+                info['id'] = paper_id
+        return info
+
+    def get_info_many(self, paper_ids, failed=None):
+        # IDs whose lookup failed, rather than found nothing, are added to the failed set if one is given
+        infos, missing = self._from_cache(paper_ids)
+        if not missing:
+            return infos
+        leaders, followers = self._claim(self.in_flight, missing)
+        try:
+            fetched, failed_ids = self.fetch_many([paper_id for paper_id, _, _ in leaders]) if leaders else ({}, set())
+            self._store_fetched(leaders, fetched, failed_ids)
+            if failed is not None:
+                failed.update(failed_ids)
+        except Exception as e:
+            for _, _, flight in leaders:
+                flight.fail(e)
+            raise
+        finally:
+            for _, key, _ in leaders:
+                self.in_flight.release(key)
+        infos.update(fetched)
+        for paper_id, _, flight in followers:
+            info = self._followed(paper_id, flight.wait())
+            if info:
+                infos[paper_id] = info
+        return infos
+
+    async def get_info_many_async(self, paper_ids, failed=None):
+        infos, missing = self._from_cache(paper_ids)
+        if not missing:
+            return infos
+        leaders, followers = self._claim(self.async_in_flight, missing)
+        try:
+            fetched, failed_ids = await self.fetch_many_async([paper_id for paper_id, _, _ in leaders]) if leaders else ({}, set())
+            self._store_fetched(leaders, fetched, failed_ids)
+            if failed is not None:
+                failed.update(failed_ids)
+        except Exception as e:
+            for _, _, flight in leaders:
+                flight.fail(e)
+            raise
+        finally:
+            for _, key, _ in leaders:
+                self.async_in_flight.release(key)
+        infos.update(fetched)
+        for paper_id, _, flight in followers:
+            info = self._followed(paper_id, await flight.wait())
+            if info:
+                infos[paper_id] = info
+        return infos
+
+    def fetch_many(self, paper_ids):
+        # Returns the infos found and the set of IDs whose lookup failed
+        infos, failed = {}, set()
+        for paper_id in paper_ids:
+            info, lookup_failed = self.fetch_one(paper_id)
+            if info:
+                infos[paper_id] = info
+            elif lookup_failed:
+                failed.add(paper_id)
+        return infos, failed
+
+    async def fetch_many_async(self, paper_ids):
+        results = await asyncio.gather(*(self.fetch_one_async(paper_id) for paper_id in paper_ids))
+        infos = {paper_id: info for paper_id, (info, _) in zip(paper_ids, results) if info}
+        return infos, {paper_id for paper_id, (info, lookup_failed) in zip(paper_ids, results) if lookup_failed}
+
+    def fetch_one(self, paper_id):
+        # Returns (info, failed); handlers that can tell a failed request from an unknown ID override this
+        return self.get_info(paper_id), False
+
+    async def fetch_one_async(self, paper_id):
+        # Handlers without a native async lookup run the blocking one in the executor
+        return await asyncio.to_thread(self.fetch_one, paper_id)
+
+    async def get_info_async(self, paper_id):
+        info, _ = await self.fetch_one_async(paper_id)
+        return info
+
 
 class arxiveHandler(paperHandler):
 
-    def extract_ids(self, message_content):
-        arxiv_regex = r'\b(?:arXiv:)?(\d{4}\.\d{5})\b|https?://arxiv\.org/abs/(\d{4}\.\d{5})'
-        matches = re.findall(arxiv_regex, message_content)
-        arxiv_ids = [arxiv_id for match in matches for arxiv_id in match if arxiv_id]
-        return arxiv_ids
+    source = 'arxiv'
+    id_hint = r'\.\d{5}'
+    id_patterns = [r'\b(?:arXiv:)?(?P<id>\d{4}\.\d{5})(?:v\d+)?\b', r'https?://arxiv\.org/abs/(?P<id>\d{4}\.\d{5})(?:v\d+)?']
+    api_url = ARXIV_API_URL
+
+    def normalize_id(self, arxiv_id):
+        return strip_arxiv_version(arxiv_id)
 
     def get_info(self, arxiv_id):
-        url = f'http://export.arxiv.org/api/query?id_list={arxiv_id}'
-        response = requests.get(url)
-        if response.status_code != 200:
-            self.log.append(response)
-            return
-        root = ET.fromstring(response.content)
-        entry = root.find('{http://www.w3.org/2005/Atom}entry')
-        if entry:
-            title = entry.find('{http://www.w3.org/2005/Atom}title').text.strip().replace("\n", " ")
-            authors = [author.find('{http://www.w3.org/2005/Atom}name').text for author in entry.findall('{http://www.w3.org/2005/Atom}author')]
-            abstract = entry.find('{http://www.w3.org/2005/Atom}summary').text.strip().replace("\n", " ")
-            link = entry.find('{http://www.w3.org/2005/Atom}id').text
-            publish_date = entry.find('{http://www.w3.org/2005/Atom}published').text
-            category_element = entry.find('{http://www.w3.org/2005/Atom}category')
-            if category_element is not None:
-                primary_category = category_element.attrib.get('term', '')
-            else:
-                primary_category = None
-            year = datetime.fromisoformat(publish_date.rstrip('Z')).year
-            info = {"title": title, "authors": authors, "abstract": abstract, "link": link, "publish_date": publish_date,
-                    "year": year, "id": arxiv_id, "category": primary_category, "github_repo": self.get_github_url(arxiv_id)}
-            bibtex = paper_info_to_bibtex(info, is_arxive=False)
-            info['bibtex'] = bibtex
-            return info
+        infos, _ = self.fetch_many([arxiv_id])
+        return infos.get(arxiv_id)
 
+    def _group_ids(self, arxiv_ids):
+        requested = {}
+        for arxiv_id in arxiv_ids:
+            requested.setdefault(strip_arxiv_version(arxiv_id), []).append(arxiv_id)
+        return requested
 
-    def get_all_repositories(self, paper_id):
-        base_url = f"https://paperswithcode.com/api/v1/papers/{paper_id}/repositories/"
-        repositories = []
-        while base_url:
-            response = requests.get(base_url)
-            if response.status_code == 200:
-                data = response.json()
-                repositories.extend(data.get('results', []))
-                base_url = data.get('next')
-            else:
-                break
-        return repositories
-
-    def get_official_repositories(self, paper_id):
-        all_repositories = self.get_all_repositories(paper_id)
-        official_repos = [repo for repo in all_repositories if repo.get('is_official') == True]
-        return official_repos
-
-    def get_github_url(self, arxiv_id):
-        arxiv_id = arxiv_id.split("v")[0]
-        url = f"https://paperswithcode.com/api/v1/papers/?arxiv_id={arxiv_id}"
-        response = requests.get(url)
-        papers = response.json()
-        if response.status_code != 200:
-            self.log.append(response)
-            return 
-        if papers['results']:
-            paper_id = papers['results'][0]['id']
-            official_repos = self.get_official_repositories(paper_id)
-            if official_repos:
-                github_url = official_repos[0]['url']
-                return github_url
+    def _query_chunks(self, requested):
+        query_ids = list(requested)
+        for start in range(0, len(query_ids), ARXIV_MAX_IDS_PER_QUERY):
+            chunk = query_ids[start:start + ARXIV_MAX_IDS_PER_QUERY]
+            yield chunk, f'{self.api_url}?id_list={",".join(chunk)}&max_results={len(chunk)}'
+
+    def _matched_entries(self, content, requested):
+        root = ET.fromstring(content)
+        for entry in root.findall(f'{ATOM}entry'):
+            entry_id = strip_arxiv_version(entry.find(f'{ATOM}id').text.split('/abs/')[-1])
+            for arxiv_id in requested.get(entry_id, []):
+                yield arxiv_id, entry
+
+    def fetch_many(self, arxiv_ids):
+        # Fold all requested IDs into comma-separated id_list queries and match entries back by ID
+        requested = self._group_ids(arxiv_ids)
+        infos, failed = {}, set()
+        for chunk, url in self._query_chunks(requested):
+            response = self.http.get(url)
+            if response.status_code != 200:
+                self.log.append(response)
+                # One malformed ID fails the whole id_list query with a 400, so fall back to single lookups.
+                # Other errors already went through the retries and fail the whole chunk.
+                if response.status_code == 400 and len(chunk) > 1:
+                    for query_id in chunk:
+                        single_infos, single_failed = self.fetch_many(requested[query_id])
+                        infos.update(single_infos)
+                        failed.update(single_failed)
+                else:
+                    failed.update(arxiv_id for query_id in chunk for arxiv_id in requested[query_id])
+                continue
+            for arxiv_id, entry in self._matched_entries(response.content, requested):
+                infos[arxiv_id] = self.entry_to_info(entry, arxiv_id)
+        return infos, failed
+
+    async def fetch_many_async(self, arxiv_ids):
+        requested = self._group_ids(arxiv_ids)
+        infos, failed = {}, set()
+        for chunk, url in self._query_chunks(requested):
+            response = await self.async_http.get(url)
+            if response.status_code != 200:
+                self.log.append(response)
+                if response.status_code == 400 and len(chunk) > 1:
+                    singles = await asyncio.gather(*(self.fetch_many_async(requested[query_id]) for query_id in chunk))
+                    for single_infos, single_failed in singles:
+                        infos.update(single_infos)
+                        failed.update(single_failed)
+                else:
+                    failed.update(arxiv_id for query_id in chunk for arxiv_id in requested[query_id])
+                continue
+            for arxiv_id, entry in self._matched_entries(response.content, requested):
+                infos[arxiv_id] = self.entry_to_info(entry, arxiv_id)
+        return infos, failed
+
+    def entry_to_info(self, entry, arxiv_id, github_repo=None):
+        title = entry.find(f'{ATOM}title').text.strip().replace("\n", " ")
+        authors = [author.find(f'{ATOM}name').text for author in entry.findall(f'{ATOM}author')]
+        abstract = entry.find(f'{ATOM}summary').text.strip().replace("\n", " ")
+        link = entry.find(f'{ATOM}id').text
+        publish_date = entry.find(f'{ATOM}published').text
+        category_element = entry.find(f'{ATOM}category')
+        if category_element is not None:
+            primary_category = category_element.attrib.get('term', '')
+        else:
+            primary_category = None
+        year = datetime.fromisoformat(publish_date.rstrip('Z')).year
+        info = {"title": title, "authors": authors, "abstract": abstract, "link": link, "publish_date": publish_date,
+                "year": year, "id": arxiv_id, "category": primary_category, "github_repo": github_repo}
+        bibtex = paper_info_to_bibtex(info, is_arxive=False)
+        info['bibtex'] = bibtex
+        return info
 
 
 class openreviewHandler(paperHandler):
 
-    def extract_ids(self, message_content):
-        openreview_regex = r'https?://openreview\.net/(forum|pdf)\?id=([A-Za-z0-9_]+)'
-        matches = re.findall(openreview_regex, message_content)
-        openreview_ids = [match[1] for match in matches]
-        return openreview_ids
+    source = 'openreview'
+    id_hint = r'openreview\.net/'
+    id_patterns = [r'https?://openreview\.net/(?:forum|pdf)\?id=(?P<id>[A-Za-z0-9_]+)']
+    api2_url = OPENREVIEW_API2_URL
+    api_url = OPENREVIEW_API_URL
 
     def get_info(self, openreview_id):
+        info, _ = self.fetch_one(openreview_id)
+        return info
+
+    def fetch_one(self, openreview_id):
         api2 = True
-        api_url = f"https://api2.openreview.net/notes?id={openreview_id}"
-        response = requests.get(api_url)
+        api_url = f"{self.api2_url}/notes?id={openreview_id}"
+        response = self.http.get(api_url)
         if response.status_code != 200:
             api2 = False
-            api_url = f"https://api.openreview.net/notes?id={openreview_id}"
-            response = requests.get(api_url)
+            api_url = f"{self.api_url}/notes?id={openreview_id}"
+            response = self.http.get(api_url)
             if response.status_code != 200:
                 self.log.append(response)
-                return
-        paper_data = response.json().get('notes', [])
+                return None, True
+        return self.notes_to_info(response.json().get('notes', []), openreview_id, api2), False
+
+    async def fetch_one_async(self, openreview_id):
+        api2 = True
+        response = await self.async_http.get(f"{self.api2_url}/notes?id={openreview_id}")
+        if response.status_code != 200:
+            api2 = False
+            response = await self.async_http.get(f"{self.api_url}/notes?id={openreview_id}")
+            if response.status_code != 200:
+                self.log.append(response)
+                return None, True
+        return self.notes_to_info(response.json().get('notes', []), openreview_id, api2), False
+
+    def notes_to_info(self, paper_data, openreview_id, api2):
         if paper_data:
             paper = paper_data[0]
             title = paper['content']['title']['value'] if api2 else paper['content']['title'].replace("\n" " ")
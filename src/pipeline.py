@@ -0,0 +1,94 @@
+# pipeline.py
+
+import queue
+import threading
+import time
+import metrics
+
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers=1, queue_size=100, batch_size=1, batch_window=0.0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self._threads = []
+        metrics.register_gauge('pipeline_queue_depth', self.depth, stage=name)
+
+    def put(self, item, timeout=None):
+        # Blocks while the stage is saturated, which pushes back on whoever feeds it
+        self.queue.put(item, timeout=timeout)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _take_batch(self, first):
+        # Collect more items for up to batch_window seconds, so one call can serve several jobs
+        items = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _work(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            if self.batch_size > 1:
+                item, stopping = self._take_batch(item)
+            try:
+                with metrics.timer('pipeline_stage', stage=self.name):
+                    outputs = self.func(item)
+            except Exception as e:
+                print(f"Warning: Stage {self.name} failed. Exception: {e}")
+                metrics.inc('pipeline_stage_failures_total', stage=self.name)
+                continue
+            if outputs and self.next_stage is not None:
+                for output in outputs:
+                    self.next_stage.put(output)
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def submit(self, item, timeout=None):
+        self.stages[0].put(item, timeout=timeout)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        # Stop front to back so every stage drains into a still running successor
+        for stage in self.stages:
+            stage.stop()
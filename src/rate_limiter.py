@@ -0,0 +1,170 @@
+# rate_limiter.py
+
+import sys
+import time
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+import metrics
+
+# (requests per second, burst) per remote service; hosts of the HTTP transport count as services too
+DEFAULT_RATE_LIMITS = {
+    'notion': (3, 3),
+    'zotero': (5, 5),
+    'export.arxiv.org': (1 / 3, 1),  # arXiv asks for one request every three seconds
+    'paperswithcode.com': (5, 5),
+    'api.openreview.net': (5, 5),
+    'api2.openreview.net': (5, 5),
+}
+
+RATE_LIMIT_STATUSES = (429, 503)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _try_take(self):
+        # Takes a token and returns 0, or returns how long to wait before trying again
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        while True:
+            wait = self._try_take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._try_take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def block_for(self, seconds):
+        # The server told us to back off; everyone using this service waits
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_buckets = {}
+_rate_limits = dict(DEFAULT_RATE_LIMITS)
+_buckets_lock = threading.Lock()
+
+
+def configure_rate_limits(rate_limits):
+    with _buckets_lock:
+        _rate_limits.update(rate_limits)
+        for service in rate_limits:
+            _buckets.pop(service, None)
+
+
+def share_rate_limits(processes):
+    # Every one of several bot processes gets its share of each limit, so together they stay within it
+    with _buckets_lock:
+        for service, (rate, capacity) in _rate_limits.items():
+            _rate_limits[service] = (rate / processes, max(capacity / processes, 1))
+        _buckets.clear()
+
+
+def get_bucket(service):
+    with _buckets_lock:
+        bucket = _buckets.get(service)
+        if bucket is None:
+            rate, capacity = _rate_limits.get(service, (10, 10))
+            bucket = TokenBucket(rate, capacity)
+            _buckets[service] = bucket
+        return bucket
+
+
+def retry_after_seconds(headers, default):
+    if not headers:
+        return default
+    for name in ('Retry-After', 'Backoff'):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+def zotero_rate_limit_errors():
+    # pyzotero is imported with the Zotero handler; before that no exception can be one of its errors
+    errors = sys.modules.get('pyzotero.zotero_errors')
+    if errors is None:
+        return ()
+    return tuple(getattr(errors, name) for name in ('TooManyRequestsError', 'TooManyRetriesError') if hasattr(errors, name))
+
+
+def error_status(exception):
+    # notion_client errors carry .status, pyzotero raises TooManyRequestsError/TooManyRetriesError without one
+    status = getattr(exception, 'status', None) or getattr(exception, 'status_code', None)
+    if status is None and isinstance(exception, zotero_rate_limit_errors()):
+        status = 429
+    if status is None and getattr(exception, 'code', None) == 'rate_limited':
+        status = 429
+    return status
+
+
+def is_rate_limit_error(exception):
+    return error_status(exception) in RATE_LIMIT_STATUSES
+
+
+def call_with_rate_limit(service, func, *args, max_retries=3, headers=None, **kwargs):
+    # headers: optional callable returning the last response headers when the exception has none
+    bucket = get_bucket(service)
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        try:
+            with metrics.timer('api_call', service=service):
+                return func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            response_headers = getattr(e, 'headers', None)
+            if response_headers is None and headers is not None:
+                response_headers = headers()
+            delay = retry_after_seconds(response_headers, default=2 ** attempt)
+            print(f"Warning: {service} rate limited us, retrying in {delay:.1f}s.")
+            metrics.inc('rate_limited_total', service=service)
+            metrics.inc('retries_total', service=service)
+            bucket.block_for(delay)
+
+
+async def call_with_rate_limit_async(service, func, *args, max_retries=3, **kwargs):
+    # Same as call_with_rate_limit for coroutine functions, waiting without blocking the event loop
+    bucket = get_bucket(service)
+    for attempt in range(max_retries + 1):
+        await bucket.acquire_async()
+        try:
+            with metrics.timer('api_call', service=service):
+                return await func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            delay = retry_after_seconds(getattr(e, 'headers', None), default=2 ** attempt)
+            print(f"Warning: {service} rate limited us, retrying in {delay:.1f}s.")
+            metrics.inc('rate_limited_total', service=service)
+            metrics.inc('retries_total', service=service)
+            bucket.block_for(delay)
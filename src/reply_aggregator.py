@@ -0,0 +1,349 @@
+# reply_aggregator.py
+
+import asyncio
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from link_index import normalize_link
+import metrics
+
+ZULIP_MAX_MESSAGE_LENGTH = 10000
+
+
+class Reply:
+    # One Zulip message with a section per paper: its card (or a placeholder/error) followed by the database results
+
+    def __init__(self, header, sections, interval, request):
+        self.header = header
+        self.sections = sections  # key -> {'card', 'databases', 'link', 'done', 'replayed'}, in message order
+        self.request = request  # content -> send_message request, also used to post the continuation
+        self.message_id = None
+        self.sent = None
+        self.due = None  # when the next edit is scheduled, None if there is nothing to send
+        self.interval = interval  # wait before the next edit while papers are still in progress
+        self.handle = None  # timer of the asyncio runtime
+        self.lock = threading.Lock()
+        self.continuation = None  # the reply that took over the sections that no longer fit into this message
+
+    def rendered(self, section):
+        databases = section['databases']
+        # Replays and late writes can finish before the line they replace was sent, so they are applied here
+        for pending, result in section['replayed']:
+            databases = databases.replace(pending, result, 1)
+        return section['card'] + databases
+
+    def overflow(self, limit=ZULIP_MAX_MESSAGE_LENGTH):
+        # Keys of the trailing sections that do not fit into one message; the first section always stays
+        length = len(self.header) if self.header else -2
+        keys = list(self.sections)
+        for index, key in enumerate(keys):
+            length += 2 + len(self.rendered(self.sections[key]))
+            if length > limit and index > 0:
+                return keys[index:]
+        return []
+
+    def content(self):
+        parts = [self.header] if self.header else []
+        parts.extend(self.rendered(section) for section in self.sections.values())
+        content = "\n\n".join(parts)
+        if len(content) > ZULIP_MAX_MESSAGE_LENGTH:
+            print(f"Warning: Reply {self.message_id} is longer than Zulip allows, shortening it.")
+            content = content[:ZULIP_MAX_MESSAGE_LENGTH - 20] + "\n*(shortened)*"
+        return content
+
+    def finished(self):
+        return all(section['done'] for section in self.sections.values())
+
+
+class ReplyAggregator:
+    # Posts one status message per source message and collects all later changes to it into debounced
+    # update_message calls. While a reply is in progress the wait doubles after every edit up to max_debounce;
+    # once all its papers are done it is sent after debounce seconds. When the cards grow past Zulip's message
+    # size limit, the sections that no longer fit move to a continuation message.
+    # dispatch(reply) runs the flush, e.g. on the notify stage; by default the timer thread flushes itself.
+
+    def __init__(self, client, debounce=1.0, max_debounce=8.0, dispatch=None, keep_closed=1000):
+        self.client = client
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.dispatch = dispatch if dispatch is not None else self.flush
+        self.replies = {}  # Zulip message id -> Reply
+        # Replies whose papers are all done, so late writes, replays and repository lines can still be merged into them
+        self.closed = OrderedDict()
+        self.keep_closed = keep_closed
+        self.lock = threading.Lock()
+        self.timers = []  # heap of (due, message id)
+        self.wakeup = threading.Condition(self.lock)
+        self._thread = None
+        metrics.register_gauge('open_replies', lambda: len(self.replies))
+
+    def _new_reply(self, message, keys, request_for, placeholder):
+        sections = {key: {'card': placeholder(key), 'databases': '', 'link': None, 'done': False, 'replayed': []}
+                    for key in keys}
+        return Reply(f"{message['sender_full_name']} shared:", sections, self.debounce,
+                     lambda content: request_for(message, content))
+
+    def _opened(self, reply, response, content):
+        with self.lock:
+            reply.message_id = response.get('id')
+            reply.sent = content
+            if reply.message_id is not None:
+                self.replies[reply.message_id] = reply
+                # Changes made while the message was being sent get their own edit
+                if reply.content() != content:
+                    self._schedule(reply)
+        return {key: reply.message_id for key in reply.sections}
+
+    def open(self, message, keys, request_for, placeholder):
+        # Sends the initial reply; returns the reply message id for every key
+        reply = self._new_reply(message, keys, request_for, placeholder)
+        content = reply.content()
+        return self._opened(reply, self.client.send_message(reply.request(content)), content)
+
+    def _holding(self, message_id, key=None, link=None):
+        # The reply of this message, or its continuation, with the section of the key or link
+        reply = self.replies.get(message_id) or self.closed.get(message_id)
+        while reply is not None:
+            if key in reply.sections if key is not None else any(section['link'] == link
+                                                                 for section in reply.sections.values()):
+                return reply
+            reply = reply.continuation
+        return None
+
+    def _split(self, reply):
+        # Called with self.lock held. Moves the sections that outgrew the reply to its continuation and
+        # returns the continuation if it still has to be posted
+        keys = reply.overflow()
+        if not keys:
+            return None
+        moved = {key: reply.sections.pop(key) for key in keys}
+        if reply.continuation is None:
+            metrics.inc('reply_continuations_total')
+            reply.continuation = Reply("*(continued)*", moved, self.debounce, reply.request)
+            return reply.continuation
+        reply.continuation.sections = dict(moved, **reply.continuation.sections)
+        self._schedule(reply.continuation)
+        return None
+
+    def _unsplit(self, reply):
+        # The continuation could not be posted, its sections go back to the reply and are tried again with its next edit
+        with self.lock:
+            reply.sections.update(reply.continuation.sections)
+            reply.continuation = None
+            self._schedule(reply)
+
+    def update(self, message_id, key, card=None, databases=None, link=None, done=False):
+        with self.lock:
+            reply = self._holding(message_id, key=key)
+            if reply is None:
+                return False
+            if reply.message_id in self.closed:
+                self.replies[reply.message_id] = self.closed.pop(reply.message_id)
+            # A continuation that is still being posted (no id yet) picks the change up once it is sent
+            if reply.message_id is not None and reply.message_id not in self.replies:
+                return False
+            section = reply.sections[key]
+            if card is not None:
+                section['card'] = card
+            if databases is not None:
+                section['databases'] = databases
+            if link is not None:
+                section['link'] = normalize_link(link)
+            section['done'] = section['done'] or done
+            self._schedule(reply)
+        return True
+
+    def replace(self, message_id, link, pending, result):
+        # Puts a replayed result in place of the pending line of the paper with this link, if the reply is still open
+        link = normalize_link(link) if link else None
+        with self.lock:
+            reply = self._holding(message_id, link=link)
+            if reply is None:
+                return False
+            if reply.message_id in self.closed:
+                self.replies[reply.message_id] = self.closed.pop(reply.message_id)
+            sections = [section for section in reply.sections.values() if section['link'] == link]
+            sections[0]['replayed'].append((pending, result))
+            self._schedule(reply)
+        return True
+
+    def _next_due(self, reply, now):
+        # Changes arriving before the due time ride along with the scheduled edit; None keeps the current one
+        due = now + (self.debounce if reply.finished() else reply.interval)
+        if reply.due is not None and reply.due <= due:
+            return None
+        reply.due = due
+        return due
+
+    def _schedule(self, reply):
+        # Called with self.lock held. A continuation is scheduled once it has been posted
+        if reply.message_id is None:
+            return
+        due = self._next_due(reply, time.monotonic())
+        if due is None:
+            return
+        heapq.heappush(self.timers, (due, reply.message_id))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='reply-timer', daemon=True)
+            self._thread.start()
+        self.wakeup.notify()
+
+    def _take_due(self):
+        # Called with self.lock held
+        due = []
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            due_time, message_id = heapq.heappop(self.timers)
+            reply = self.replies.get(message_id)
+            # Entries of an edit that was moved forward are left in the heap and skipped here
+            if reply is not None and reply.due == due_time:
+                reply.due = None
+                due.append(reply)
+        return due
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.wakeup.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                due = self._take_due()
+            for reply in due:
+                try:
+                    self.dispatch(reply)
+                except Exception as e:
+                    print(f"Warning: Failed to update reply {reply.message_id}. Exception: {e}")
+
+    def _sent(self, reply, content):
+        reply.sent = content
+        reply.interval = min(reply.interval * 2, self.max_debounce)
+        metrics.inc('reply_edits_total')
+
+    def _close_if_finished(self, reply):
+        # Replays of replies that dropped out of self.closed go straight to the Zulip message,
+        # see zulipHandler.replay_finished
+        with self.lock:
+            if reply.due is None and reply.finished() and self.replies.pop(reply.message_id, None) is not None:
+                self.closed[reply.message_id] = reply
+                while len(self.closed) > self.keep_closed:
+                    self.closed.popitem(last=False)
+
+    def flush_all(self):
+        # On shutdown, sends the edits still waiting for their debounce
+        with self.lock:
+            due = [reply for reply in self.replies.values() if reply.due is not None]
+            for reply in due:
+                reply.due = None
+        for reply in due:
+            self.flush(reply)
+
+    def flush(self, reply):
+        # The reply lock keeps edits of one message in order when several notify workers flush
+        with reply.lock:
+            with self.lock:
+                continuation = self._split(reply)
+            content = reply.content()
+            if content != reply.sent:
+                self.client.update_message({"message_id": reply.message_id, "content": content})
+                self._sent(reply, content)
+            self._post_continuations(reply, continuation)
+        self._close_if_finished(reply)
+
+    def _post_continuations(self, reply, continuation):
+        # A long overflow can take several messages
+        while continuation is not None:
+            with self.lock:
+                following = self._split(continuation)
+            content = continuation.content()
+            try:
+                response = self.client.send_message(continuation.request(content))
+            except Exception:
+                if following is not None:
+                    self._unsplit(continuation)
+                self._unsplit(reply)
+                raise
+            self._opened(continuation, response, content)
+            reply, continuation = continuation, following
+
+
+class AsyncReplyAggregator(ReplyAggregator):
+    # Same replies on the event loop: edits are timer callbacks of the loop instead of a timer thread
+
+    def __init__(self, client, debounce=1.0, max_debounce=8.0):
+        super().__init__(client, debounce=debounce, max_debounce=max_debounce)
+        self.loop = None
+        self.tasks = set()
+        self.flush_locks = {}  # message id -> asyncio.Lock
+
+    async def open(self, message, keys, request_for, placeholder):
+        self.loop = asyncio.get_running_loop()
+        reply = self._new_reply(message, keys, request_for, placeholder)
+        content = reply.content()
+        return self._opened(reply, await self.client.send_message(reply.request(content)), content)
+
+    def _schedule(self, reply):
+        if reply.message_id is None:
+            return
+        due = self._next_due(reply, self.loop.time())
+        if due is None:
+            return
+        if reply.handle is not None:
+            reply.handle.cancel()
+        reply.handle = self.loop.call_at(due, self._flush_due, reply)
+
+    def _flush_due(self, reply):
+        reply.due = None
+        reply.handle = None
+        task = self.loop.create_task(self.flush_async(reply))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush_all(self):
+        due = [reply for reply in list(self.replies.values()) if reply.due is not None]
+        for reply in due:
+            if reply.handle is not None:
+                reply.handle.cancel()
+                reply.handle = None
+            reply.due = None
+        await asyncio.gather(*self.tasks, *(self.flush_async(reply) for reply in due), return_exceptions=True)
+
+    async def _post_continuations_async(self, reply, continuation):
+        while continuation is not None:
+            with self.lock:
+                following = self._split(continuation)
+            content = continuation.content()
+            try:
+                response = await self.client.send_message(continuation.request(content))
+            except Exception:
+                if following is not None:
+                    self._unsplit(continuation)
+                self._unsplit(reply)
+                raise
+            self._opened(continuation, response, content)
+            reply, continuation = continuation, following
+
+    async def drain(self):
+        while self.tasks or any(reply.due is not None for reply in list(self.replies.values())):
+            await asyncio.sleep(0.1)
+
+    async def flush_async(self, reply):
+        lock = self.flush_locks.setdefault(reply.message_id, asyncio.Lock())
+        async with lock:
+            with self.lock:
+                continuation = self._split(reply)
+            content = reply.content()
+            if content != reply.sent:
+                try:
+                    await self.client.update_message({"message_id": reply.message_id, "content": content})
+                except Exception as e:
+                    print(f"Warning: Failed to update reply {reply.message_id}. Exception: {e}")
+                    return
+                self._sent(reply, content)
+            try:
+                await self._post_continuations_async(reply, continuation)
+            except Exception as e:
+                print(f"Warning: Failed to continue reply {reply.message_id}. Exception: {e}")
+                return
+        self._close_if_finished(reply)
+        if reply.message_id not in self.replies:
+            self.flush_locks.pop(reply.message_id, None)
@@ -0,0 +1,282 @@
+# repository_lookup.py
+#
+# Official code repositories of papers. They are looked up next to the metadata fetch instead of inside it,
+# from a local copy of the paperswithcode links dump where possible and from the paperswithcode API otherwise.
+
+import codecs
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+from local_store import get_store, DEFAULT_STORE_PATH
+from link_index import normalize_link
+from http_transport import get_default_transport
+from single_flight import SingleFlight, AsyncSingleFlight
+import metrics
+
+PAPERSWITHCODE_API_URL = 'https://paperswithcode.com/api/v1'
+PAPERSWITHCODE_LINKS_DUMP_URL = 'https://production-media.paperswithcode.com/about/links-between-papers-and-code.json.gz'
+REPOSITORY_CACHE_SOURCE = 'repository'  # MetadataCache source of API lookup results
+INDEX_INSERT_BATCH = 5000
+LOADED_CHECK_INTERVAL = 10  # seconds between checks whether another process has loaded the index
+
+
+def gunzip_text(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        yield decoder.decode(decompressor.decompress(chunk))
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def iter_json_array(chunks):
+    # Items of a large JSON array, decoded while its text streams in, so the dump never has to fit in memory
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in '[,] \n\r\t':
+                position += 1
+            if position >= len(buffer):
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # the item continues in the next chunk
+            yield item
+        buffer = buffer[position:]
+    if buffer.strip():
+        raise ValueError("The JSON array ended in the middle of an item.")
+
+
+class RepositoryIndex:
+    # Normalised paper link -> official repository from the paperswithcode links dump, kept in the local store
+
+    def __init__(self, path=DEFAULT_STORE_PATH, dump_url=PAPERSWITHCODE_LINKS_DUMP_URL, refresh_interval=7 * 24 * 3600,
+                 transport=None):
+        self.store = get_store(path)
+        self.http = transport if transport is not None else get_default_transport()
+        self.dump_url = dump_url
+        self.refresh_interval = refresh_interval  # in seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self.store.execute("CREATE TABLE IF NOT EXISTS repository_index (link TEXT PRIMARY KEY, repository TEXT)")
+        self.store.execute("CREATE TABLE IF NOT EXISTS repository_index_meta ("
+                           "dump_url TEXT PRIMARY KEY, refreshed REAL, entries INTEGER)")
+        self.loaded = self.refreshed() is not None
+        self._next_loaded_check = time.monotonic() + LOADED_CHECK_INTERVAL
+
+    def refreshed(self):
+        rows = self.store.execute("SELECT refreshed FROM repository_index_meta WHERE dump_url = ?", (self.dump_url,))
+        return rows[0][0] if rows else None
+
+    def is_loaded(self):
+        # In the sharded mode the coordinator downloads the dump, so the workers look for it in the store
+        if not self.loaded and time.monotonic() >= self._next_loaded_check:
+            self._next_loaded_check = time.monotonic() + LOADED_CHECK_INTERVAL
+            self.loaded = self.refreshed() is not None
+        return self.loaded
+
+    def get(self, link):
+        # Returns (loaded, repository); repository is None for papers without an official one in the dump
+        if not self.is_loaded():
+            return False, None
+        rows = self.store.execute("SELECT repository FROM repository_index WHERE link = ?", (normalize_link(link),))
+        return True, rows[0][0] if rows else None
+
+    def entries(self, papers):
+        for paper in papers:
+            if not paper.get('is_official') or not paper.get('repo_url'):
+                continue
+            urls = [paper.get('paper_url_abs')]
+            if paper.get('paper_arxiv_id'):
+                urls.append(f"https://arxiv.org/abs/{paper['paper_arxiv_id']}")
+            for url in urls:
+                link = normalize_link(url)
+                if link and link.startswith(('arxiv:', 'openreview:')):
+                    yield link, paper['repo_url']
+
+    def refresh(self):
+        start = time.time()
+        with metrics.timer('repository_index_refresh'):
+            with self.http.stream(self.dump_url) as (response, chunks):
+                response.raise_for_status()
+                papers = iter_json_array(gunzip_text(chunks))
+                # Filled in batches next to the live table, so lookups only wait for the final swap
+                self.store.execute("DROP TABLE IF EXISTS repository_index_new")
+                self.store.execute("CREATE TABLE repository_index_new (link TEXT PRIMARY KEY, repository TEXT)")
+                batch = []
+                count = 0
+                for entry in self.entries(papers):
+                    batch.append(entry)
+                    if len(batch) >= INDEX_INSERT_BATCH:
+                        self.store.executemany("INSERT OR IGNORE INTO repository_index_new VALUES (?, ?)", batch)
+                        count += len(batch)
+                        batch = []
+                self.store.executemany("INSERT OR IGNORE INTO repository_index_new VALUES (?, ?)", batch)
+                count += len(batch)
+            with self.store.transaction() as conn:
+                conn.execute("DROP TABLE repository_index")
+                conn.execute("ALTER TABLE repository_index_new RENAME TO repository_index")
+                conn.execute("INSERT OR REPLACE INTO repository_index_meta (dump_url, refreshed, entries) "
+                             "VALUES (?, ?, ?)", (self.dump_url, time.time(), count))
+        self.loaded = True
+        print(f"Repository index refreshed with {count} paper links in {time.time() - start:.0f}s.")
+
+    def refresh_if_stale(self):
+        refreshed = self.refreshed()
+        if refreshed is not None and time.time() - refreshed < self.refresh_interval:
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Warning: Failed to refresh the repository index. Exception: {e}")
+
+    def start(self, check_interval=3600):
+        def refresh_loop():
+            while not self._stop.is_set():
+                self.refresh_if_stale()
+                self._stop.wait(min(check_interval, self.refresh_interval))
+        self._thread = threading.Thread(target=refresh_loop, name='repository-index', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class RepositoryLookup:
+    # Finds the official repository of a paper by its normalised link ("arxiv:2301.00001", "openreview:abc").
+    # The index and the cache answer without a request; the API is asked in the background when they do not.
+    # With api_fallback off, papers missing from the index count as having no repository, so lookups stay offline.
+
+    def __init__(self, transport=None, async_transport=None, index=None, cache=None, api_url=PAPERSWITHCODE_API_URL,
+                 api_fallback=True, workers=8, timeout=10):
+        self.http = transport if transport is not None else get_default_transport()
+        self.async_http = async_transport  # only set for the asyncio runtime
+        self.index = index
+        self.cache = cache
+        self.api_url = api_url
+        self.api_fallback = api_fallback
+        self.timeout = timeout  # seconds a database write waits for the repository
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='repository')
+        self.in_flight = SingleFlight()
+        self.async_in_flight = AsyncSingleFlight()
+
+    def known(self, link):
+        # Returns (known, repository) without sending a request
+        if self.index is not None:
+            with metrics.timer('repository_lookup', tier='index'):
+                loaded, repository = self.index.get(link)
+            if loaded and (repository is not None or not self.api_fallback):
+                return True, repository
+        if self.cache is not None:
+            hit, info = self.cache.get(REPOSITORY_CACHE_SOURCE, link)
+            if hit:
+                return True, info['repository'] if info else None
+        if not self.api_fallback:
+            return True, None
+        return False, None
+
+    def submit(self, link):
+        # Future of the repository, already done when the index or the cache knows it
+        link = normalize_link(link)
+        known, repository = self.known(link)
+        if not known:
+            return self.executor.submit(self.lookup, link)
+        future = Future()
+        future.set_result(repository)
+        return future
+
+    def lookup(self, link):
+        link = normalize_link(link)
+        known, repository = self.known(link)
+        if known:
+            return repository
+        return self.in_flight.do(link, self._fetch, link)
+
+    async def lookup_async(self, link):
+        link = normalize_link(link)
+        known, repository = self.known(link)
+        if known:
+            return repository
+        return await self.async_in_flight.do(link, self._fetch_async, link)
+
+    def search_url(self, link):
+        source, _, paper_id = link.partition(':')
+        if source == 'arxiv':
+            return f"{self.api_url}/papers/?arxiv_id={paper_id}"
+        if source == 'openreview':
+            return f"{self.api_url}/papers/?url_abs={quote(f'https://openreview.net/forum?id={paper_id}', safe='')}"
+
+    def _store(self, link, repository, failed):
+        # A failed lookup is not remembered as "no repository"
+        if self.cache is not None and not failed:
+            self.cache.put(REPOSITORY_CACHE_SOURCE, link, {'repository': repository} if repository else None)
+        return repository
+
+    def _fetch(self, link):
+        with metrics.timer('repository_lookup', tier='api'):
+            repository, failed = self._find(link)
+        return self._store(link, repository, failed)
+
+    async def _fetch_async(self, link):
+        with metrics.timer('repository_lookup', tier='api'):
+            repository, failed = await self._find_async(link)
+        return self._store(link, repository, failed)
+
+    def _find(self, link):
+        # Returns (repository, failed); repository pages are only followed until the first official one
+        url = self.search_url(link)
+        if url is None:
+            return None, False
+        try:
+            response = self.http.get(url)
+            if response.status_code != 200:
+                return None, True
+            results = response.json().get('results', [])
+            url = f"{self.api_url}/papers/{results[0]['id']}/repositories/" if results else None
+            while url:
+                response = self.http.get(url)
+                if response.status_code != 200:
+                    return None, True
+                data = response.json()
+                official = [repo['url'] for repo in data.get('results', []) if repo.get('is_official')]
+                if official:
+                    return official[0], False
+                url = data.get('next')
+        except Exception as e:
+            # A hanging paperswithcode must not cost us the paper
+            print(f"Warning: Repository lookup for {link} failed. Exception: {e}")
+            return None, True
+        return None, False
+
+    async def _find_async(self, link):
+        url = self.search_url(link)
+        if url is None:
+            return None, False
+        try:
+            response = await self.async_http.get(url)
+            if response.status_code != 200:
+                return None, True
+            results = response.json().get('results', [])
+            url = f"{self.api_url}/papers/{results[0]['id']}/repositories/" if results else None
+            while url:
+                response = await self.async_http.get(url)
+                if response.status_code != 200:
+                    return None, True
+                data = response.json()
+                official = [repo['url'] for repo in data.get('results', []) if repo.get('is_official')]
+                if official:
+                    return official[0], False
+                url = data.get('next')
+        except Exception as e:
+            print(f"Warning: Repository lookup for {link} failed. Exception: {e}")
+            return None, True
+        return None, False
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,101 @@
+# sharding.py
+#
+# Runs the bot as several processes. The coordinator reads the one Zulip event queue and hands each message to the
+# worker process that owns its stream, so a stream's messages stay in order within one process. Every worker has its
+# own paper and database handlers; the state file (journal, metadata cache, Notion and Zotero indexes) is shared.
+
+import asyncio
+import multiprocessing
+import signal
+import zlib
+import metrics
+
+
+def shard_of(message, workers):
+    # crc32 instead of hash(), which differs between processes
+    key = message['display_recipient'] if message['type'] == 'stream' else message['sender_email']
+    return zlib.crc32(str(key).encode()) % workers
+
+
+class ShardClient:
+    # The Zulip client of a worker: requests go through the wrapped client, messages come from the coordinator.
+    # Covers both runtimes, call_on_each_message for zulipHandler and message_events for AsyncZulipHandler.
+
+    def __init__(self, client, queue):
+        self.client = client
+        self.queue = queue
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def call_on_each_message(self, callback):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            callback(message)
+
+    async def message_events(self):
+        while True:
+            message = await asyncio.to_thread(self.queue.get)
+            if message is None:
+                return
+            yield message
+
+
+def worker_main(target, worker, queue):
+    # Workers are stopped through their queue, so Ctrl-C only goes to the coordinator
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(worker, queue)
+
+
+class Coordinator:
+    # target(worker, queue) runs one worker; it must be a module level function, workers are spawned, not forked
+
+    def __init__(self, client, workers, target, email, queue_size=1000):
+        self.client = client
+        self.workers = workers
+        self.target = target
+        self.email = email
+        # Forking a process that already runs threads can leave locks held in the child
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def start_worker(self, worker):
+        process = self.context.Process(target=worker_main, args=(self.target, worker, self.queues[worker]),
+                                       name=f"paperbot-worker-{worker}")
+        process.start()
+        self.processes[worker] = process
+
+    def dispatch(self, message):
+        if message['sender_email'] == self.email:
+            return
+        worker = shard_of(message, self.workers)
+        process = self.processes[worker]
+        if not process.is_alive():
+            # Its journaled writes are replayed by the new process; messages it had not started on are lost
+            print(f"Warning: Worker {worker} exited with code {process.exitcode}, restarting it.")
+            metrics.inc('worker_restarts_total', worker=str(worker))
+            self.start_worker(worker)
+        metrics.inc('dispatched_messages_total', worker=str(worker))
+        # Blocks while the worker's queue is full, so a backlog waits in Zulip's event queue
+        self.queues[worker].put(message)
+
+    def run(self):
+        for worker in range(self.workers):
+            self.start_worker(worker)
+        metrics.startup.mark('listening')
+        self.client.call_on_each_message(self.dispatch)
+
+    def stop(self, timeout=30):
+        for queue, process in zip(self.queues, self.processes):
+            if process is not None and process.is_alive():
+                queue.put(None)
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                print(f"Warning: {process.name} did not stop within {timeout}s, terminating it.")
+                process.terminate()
@@ -0,0 +1,228 @@
+# single_flight.py
+
+import asyncio
+import threading
+
+
+class Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def resolve(self, result):
+        self.result = result
+        self.event.set()
+
+    def fail(self, exception):
+        self.exception = exception
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError("In-flight call did not finish in time.")
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class SingleFlight:
+    # Concurrent callers for the same key share the leader's call
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def claim(self, key):
+        # Returns (flight, leader); the leader must resolve or fail the flight, then release it
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = Flight()
+            self.flights[key] = flight
+            return flight, True
+
+    def release(self, key):
+        with self.lock:
+            self.flights.pop(key, None)
+
+    def do(self, key, func, *args, **kwargs):
+        flight, leader = self.claim(key)
+        if not leader:
+            return flight.wait()
+        try:
+            flight.resolve(func(*args, **kwargs))
+        except Exception as e:
+            flight.fail(e)
+        finally:
+            self.release(key)
+        return flight.wait()
+
+
+class WriteCoalescer:
+    # One write per key at a time; writes arriving meanwhile are merged into a single follow-up write
+
+    def __init__(self, merge):
+        self.merge = merge
+        self.lock = threading.Lock()
+        self.queued = {}  # key -> (infos, flight) of the next write, None while nothing is queued
+
+    def submit(self, key, info, write):
+        with self.lock:
+            if key in self.queued:
+                if self.queued[key] is None:
+                    self.queued[key] = ([], Flight())
+                infos, flight = self.queued[key]
+                infos.append(info)
+                leader = False
+            else:
+                self.queued[key] = None
+                infos, flight = [info], Flight()
+                leader = True
+        if not leader:
+            return flight.wait()
+
+        # The leader keeps writing until no merged follow-up is waiting any more
+        own_flight = flight
+        while True:
+            try:
+                flight.resolve(write(self.merge(infos)))
+            except Exception as e:
+                flight.fail(e)
+            with self.lock:
+                if self.queued[key] is None:
+                    del self.queued[key]
+                    break
+                infos, flight = self.queued[key]
+                self.queued[key] = None
+        return own_flight.wait()
+
+
+
+class WriteBuffer:
+    # Write-behind buffer: writes arriving within window seconds (at most max_items) are flushed as one batch.
+    # flush(items) returns one result per item; an Exception instance fails only that item's caller.
+
+    def __init__(self, flush, window=0.2, max_items=20):
+        self.flush = flush
+        self.window = window
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.open = None  # (entries, full event) of the batch still taking writes
+
+    def submit(self, item):
+        flight = Flight()
+        with self.lock:
+            leader = self.open is None
+            if leader:
+                self.open = ([], threading.Event())
+            entries, full = self.open
+            entries.append((item, flight))
+            if len(entries) >= self.max_items:
+                self.open = None
+                full.set()
+        if not leader:
+            return flight.wait()
+
+        # Keep the batch open for the window and while an earlier batch is still being flushed
+        full.wait(self.window)
+        with self.flush_lock:
+            with self.lock:
+                if self.open is not None and self.open[0] is entries:
+                    self.open = None
+            self._flush(entries)
+        return flight.wait()
+
+    def _flush(self, entries):
+        try:
+            results = self.flush([item for item, _ in entries])
+        except Exception as e:
+            for _, flight in entries:
+                flight.fail(e)
+            return
+        for (_, flight), result in zip(entries, results):
+            if isinstance(result, Exception):
+                flight.fail(result)
+            else:
+                flight.resolve(result)
+
+class AsyncFlight:
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+
+    def resolve(self, result):
+        self.future.set_result(result)
+
+    def fail(self, exception):
+        self.future.set_exception(exception)
+        # Mark the exception as seen, followers still get it from wait()
+        self.future.exception()
+
+    async def wait(self, timeout=None):
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("In-flight call did not finish in time.")
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines sharing one event loop, so no lock is needed
+
+    def __init__(self):
+        self.flights = {}
+
+    def claim(self, key):
+        flight = self.flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = AsyncFlight()
+        self.flights[key] = flight
+        return flight, True
+
+    def release(self, key):
+        self.flights.pop(key, None)
+
+    async def do(self, key, func, *args, **kwargs):
+        flight, leader = self.claim(key)
+        if not leader:
+            return await flight.wait()
+        try:
+            flight.resolve(await func(*args, **kwargs))
+        except Exception as e:
+            flight.fail(e)
+        finally:
+            self.release(key)
+        return await flight.wait()
+
+
+class AsyncWriteCoalescer:
+    # WriteCoalescer for coroutine writes
+
+    def __init__(self, merge):
+        self.merge = merge
+        self.queued = {}
+
+    async def submit(self, key, info, write):
+        if key in self.queued:
+            if self.queued[key] is None:
+                self.queued[key] = ([], AsyncFlight())
+            infos, flight = self.queued[key]
+            infos.append(info)
+            return await flight.wait()
+
+        self.queued[key] = None
+        infos, flight = [info], AsyncFlight()
+        own_flight = flight
+        while True:
+            try:
+                flight.resolve(await write(self.merge(infos)))
+            except Exception as e:
+                flight.fail(e)
+            if self.queued[key] is None:
+                del self.queued[key]
+                break
+            infos, flight = self.queued[key]
+            self.queued[key] = None
+        return await own_flight.wait()
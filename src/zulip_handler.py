@@ -1,7 +1,26 @@
-import zulip
-from datetime import datetime
 import re
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from pipeline import Pipeline, Stage
+from link_index import normalize_link
+from link_extractor import LinkExtractor
+from reply_aggregator import ReplyAggregator
+
+DEFAULT_PIPELINE_CONFIG = {
+    'extract': {'workers': 1, 'queue_size': 100},
+    'fetch': {'workers': 2, 'queue_size': 200, 'batch_size': 50, 'batch_window': 0.5},
+    'write': {'workers': 4, 'queue_size': 200},
+    'notify': {'workers': 2, 'queue_size': 500},
+}
+
+DEFAULT_REPLY_CONFIG = {
+    'debounce': 1.0,  # seconds a reply collects changes before it is edited
+    'max_debounce': 8.0,  # longest wait between edits of a reply whose papers are still in progress
+}
+
+SINGLE_DOLLAR_REGEX = re.compile(r'(?<!\$)\$(?!\$)')
 
 def replace_single_dollar(s):
     def repl(match):
@@ -12,14 +31,17 @@ def replace_single_dollar(s):
             return '$$&#x200B;'
     repl.counter = 0
 
-    pattern = r'(?<!\$)\$(?!\$)'
-    return re.sub(pattern, repl, s)
+    return SINGLE_DOLLAR_REGEX.sub(repl, s)
 
 
 class zulipHandler:
 
-    def __init__(self, email, api_key, site, paper_handlers = None, database_handlers = None):
-        self.client = zulip.Client(email=email, api_key=api_key, site=site)
+    def __init__(self, email, api_key, site, paper_handlers = None, database_handlers = None, pipeline_config = None, client = None,
+                 reply_config = None, repositories = None):
+        if client is None:
+            import zulip
+            client = zulip.Client(email=email, api_key=api_key, site=site)
+        self.client = client
         self.email = email
         self.paper_handlers = paper_handlers
         if self.paper_handlers is None:
@@ -29,6 +51,35 @@ class zulipHandler:
         if self.database_handlers is None:
             self.database_handlers = []
 
+        self.extractor = LinkExtractor.for_handlers(self.paper_handlers)
+        self.handlers_by_source = {paper_handler.source: paper_handler for paper_handler in self.paper_handlers}
+        # Official code repositories are looked up next to the metadata fetch, see repository_lookup.py
+        self.repositories = repositories
+
+        stage_config = {stage: dict(config) for stage, config in DEFAULT_PIPELINE_CONFIG.items()}
+        for stage, config in (pipeline_config or {}).items():
+            stage_config[stage].update(config)
+        self.reply_config = dict(DEFAULT_REPLY_CONFIG, **(reply_config or {}))
+        self.build_runtime(stage_config)
+
+    def build_runtime(self, stage_config):
+        # extract -> fetch metadata -> write databases -> notify, each with its own bounded workers and queue
+        self.pipeline = Pipeline([
+            Stage('extract', self.extract_stage, **stage_config['extract']),
+            Stage('fetch', self.fetch_stage, **stage_config['fetch']),
+            Stage('write', self.write_stage, **stage_config['write']),
+            Stage('notify', self.notify_stage, **stage_config['notify']),
+        ])
+        # One reply per message; its debounced edits are sent by the notify stage
+        self.replies = ReplyAggregator(self.client, dispatch=self.pipeline.stages[3].put, **self.reply_config)
+        # Every write stage worker can have all backends in flight at once. Each backend has its own threads,
+        # so writes that run past their deadline on a slow backend cannot hold up the others
+        self.write_executors = {
+            handler_wrapper: ThreadPoolExecutor(max_workers=stage_config['write']['workers'],
+                                                thread_name_prefix=f'{handler_wrapper.name}-write')
+            for handler_wrapper in self.database_handlers
+        }
+
     def info_to_message(self, title, authors, abstract, link, github=None):
         message = f"``` spoiler {replace_single_dollar(title)}\n- **Authors**: {', '.join(authors)}\n- **Abstract**: {replace_single_dollar(abstract)}\n- **Link**: {link}\n"
         if github is not None:
@@ -36,96 +87,228 @@ class zulipHandler:
         message += "```"
         return message
 
-    def try_update_databases(self, paper_info):
-        response_msg = ""
-        for handler_wrapper in self.database_handlers:
-            try:
-                update_result = handler_wrapper.update_db(paper_info)
-                response_msg += "\n" + update_result
-            except Exception as e:
-                print(f"Warning: Failed to update database {handler_wrapper.handler_class.__name__}. Exception: {e}")
-                response_msg += f"\nFailed to update {handler_wrapper.handler_class.__name__}."
-                continue
-        return response_msg
+    def database_status(self, results):
+        # One line per database, in a fixed order, for the ones still running as well
+        return "".join("\n" + results.get(handler_wrapper, f"*Updating {handler_wrapper.name}...*")
+                       for handler_wrapper in self.database_handlers)
+
+    def write_result(self, handler_wrapper, future):
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Warning: Failed to update database {handler_wrapper.handler_class.__name__}. Exception: {e}")
+            return f"Failed to update {handler_wrapper.handler_class.__name__}."
+
+    def try_update_databases(self, paper_info, job_key=None, status_message_id=None, on_progress=None):
+        # All databases are written at the same time. Each has its own deadline, after which its line says pending
+        # and the write goes on in the background; on_progress gets the status text whenever a database finished.
+        start = time.monotonic()
+        pending = {self.write_executors[handler_wrapper].submit(handler_wrapper.update_db, paper_info, job_key=job_key,
+                                                                status_message_id=status_message_id): handler_wrapper
+                   for handler_wrapper in self.database_handlers}
+        results = {}
+        while pending:
+            timeout = min(start + handler_wrapper.deadline for handler_wrapper in pending.values()) - time.monotonic()
+            done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                handler_wrapper = pending.pop(future)
+                results[handler_wrapper] = self.write_result(handler_wrapper, future)
+            for future, handler_wrapper in list(pending.items()):
+                if time.monotonic() - start >= handler_wrapper.deadline:
+                    del pending[future]
+                    results[handler_wrapper] = self.deadline_exceeded(handler_wrapper, job_key)
+                    future.add_done_callback(lambda future, handler_wrapper=handler_wrapper: self.finished_late(
+                        handler_wrapper, paper_info, status_message_id, future))
+            if pending and on_progress is not None:
+                on_progress(self.database_status(results))
+        return self.database_status(results)
+
+    def deadline_exceeded(self, handler_wrapper, job_key):
+        print(f"Warning: {handler_wrapper.name} did not finish within {handler_wrapper.deadline}s.")
+        metrics.inc('database_deadline_exceeded_total', handler=handler_wrapper.name)
+        if job_key is not None and handler_wrapper.journal is not None:
+            return handler_wrapper.pending_text()
+        return f"{handler_wrapper.name} is taking longer than {handler_wrapper.deadline}s."
+
+    def finished_late(self, handler_wrapper, paper_info, status_message_id, future):
+        result = self.write_result(handler_wrapper, future)
+        if status_message_id is None or result == handler_wrapper.pending_text():
+            return
+        try:
+            self.replay_finished(handler_wrapper, {'status_message_id': status_message_id, 'info': paper_info}, result)
+        except Exception as e:
+            print(f"Warning: Failed to report the late {handler_wrapper.name} result. Exception: {e}")
 
     def handle_message(self, message):
         if message['sender_email'] == self.email:
             return
+        # Only hand the message over; all HTTP work happens in the pipeline stages.
+        self.pipeline.submit(message)
 
-        message_filtered = self.filter_zulip_quotes(message['content'])
+    def extract_stage(self, message):
+        with metrics.trace(message.get('id')):
+            return self._extract(message)
 
-        # Extract paper IDs from all paper handlers.
-        all_paper_ids = []
-        for paper_handler in self.paper_handlers:
-            ids = paper_handler.extract_ids(message_filtered)
-            all_paper_ids.extend(ids)
+    def _extract(self, message):
+        fetch_jobs = self.extract_jobs(message)
+        if fetch_jobs:
+            # One reply for all papers of the message, edited as their cards and database results come in
+            reply_ids = self.replies.open(message, [self.reply_key(job) for job in fetch_jobs], self.reply_request,
+                                          self.placeholder)
+            for job in fetch_jobs:
+                job['status_message_id'] = reply_ids[self.reply_key(job)]
+        return fetch_jobs
 
-        if not all_paper_ids:
-            return
+    def reply_key(self, job):
+        return f"{job['paper_handler'].source}:{job['paper_id']}"
 
-        # Process each paper id separately.
-        for paper_handler in self.paper_handlers:
-            paper_ids = paper_handler.extract_ids(message_filtered)
-            for paper_id in paper_ids:
-                # Send an initial message for this paper ID.
-                initial_feedback = (
-                    f"*Retrieving paper information...*"
-                )
-                request = {
-                    "type": message['type'],
-                    "to": message['sender_email'] if message['type'] == 'private' else message['display_recipient'],
-                    "subject": message.get('subject', ''),
-                    "content": initial_feedback
-                }
-                response = self.client.send_message(request)
-                initial_message_id = response.get('id')
-
-                try:
-                    paper_info = paper_handler.get_info(paper_id)
-                except Exception as e:
-                    error_feedback = f"Failed to retrieve info for paper ID {paper_id}. Error: {e}"
-                    self.client.update_message({"message_id": initial_message_id, "content": error_feedback})
-                    continue
+    def placeholder(self, reply_key):
+        return f"*Retrieving paper information for {reply_key}...*"
+
+    def extract_jobs(self, message):
+        metrics.inc('messages_total')
+        with metrics.timer('extract'):
+            # One pass over the message finds the IDs of all paper handlers and skips quoted text
+            fetch_jobs = [{"message": message, "paper_handler": self.handlers_by_source[source], "paper_id": paper_id}
+                          for source, paper_id in self.extractor.extract(message['content'])]
+        metrics.inc('papers_total', len(fetch_jobs))
+        return fetch_jobs
+
+    def reply_request(self, message, content):
+        return {
+            "type": message['type'],
+            "to": message['sender_email'] if message['type'] == 'private' else message['display_recipient'],
+            "subject": message.get('subject', ''),
+            "content": content
+        }
+
+    def fetch_stage(self, fetch_jobs):
+        # Jobs from several messages arrive together, so each handler does one batched lookup.
+        jobs_by_handler = {}
+        for job in fetch_jobs:
+            jobs_by_handler.setdefault(job['paper_handler'], []).append(job)
 
+        if self.repositories is not None:
+            for job in fetch_jobs:
+                job['repository'] = self.repositories.submit(self.reply_key(job))
+
+        write_jobs = []
+        for paper_handler, jobs in jobs_by_handler.items():
+            try:
+                # A batch can span several messages, so its spans are only tied to a trace if it does not
+                trace_ids = {job['message'].get('id') for job in jobs}
+                with metrics.trace(trace_ids.pop() if len(trace_ids) == 1 else None), \
+                        metrics.timer('metadata_fetch', source=paper_handler.source):
+                    paper_infos = paper_handler.get_info_many([job['paper_id'] for job in jobs])
+            except Exception as e:
+                for job in jobs:
+                    error_feedback = f"Failed to retrieve info for paper ID {job['paper_id']}. Error: {e}"
+                    self.replies.update(job['status_message_id'], self.reply_key(job), card=error_feedback, done=True)
+                continue
+
+            for job in jobs:
+                paper_info = paper_infos.get(job['paper_id'])
                 if not paper_info:
-                    no_info_feedback = f"No info returned for ID {paper_id}."
-                    self.client.update_message({"message_id": initial_message_id, "content": no_info_feedback})
+                    no_info_feedback = f"No info returned for ID {job['paper_id']}."
+                    self.replies.update(job['status_message_id'], self.reply_key(job), card=no_info_feedback, done=True)
                     continue
 
-                detailed_info = self.info_to_message(
-                    paper_info['title'],
-                    paper_info['authors'],
-                    paper_info['abstract'],
-                    paper_info['link'],
-                    paper_info.get('github')
-                )
-                detailed_message = f"{message['sender_full_name']} shared:\n{detailed_info}"
-                self.client.update_message({"message_id": initial_message_id, "content": detailed_message})
-
-                def update_and_notify(info, orig_message):
-                    info['sender'] = orig_message['sender_full_name']
-                    info['stream'] = (orig_message['display_recipient']
-                                      if orig_message['type'] == 'stream' else None)
-                    info['message_content'] = orig_message['content']
-
-                    db_initial_feedback = "*Updating databases...*"
-                    db_request = {
-                        "type": orig_message['type'],
-                        "to": orig_message['sender_email'] if orig_message['type'] == 'private' else orig_message['display_recipient'],
-                        "subject": orig_message.get('subject', ''),
-                        "content": db_initial_feedback
-                    }
-                    db_response = self.client.send_message(db_request)
-                    db_message_id = db_response.get('id')
-
-                    update_result = self.try_update_databases(info)
-                    self.client.update_message({
-                        "message_id": db_message_id,
-                        "content": update_result
-                    })
-
-                threading.Thread(target=update_and_notify, args=(paper_info, message)).start()
+                self.show_card(job, paper_info)
+                write_jobs.append({"message": job['message'], "info": dict(paper_info),
+                                   "status_message_id": job['status_message_id'], "reply_key": self.reply_key(job),
+                                   "repository": job.get('repository')})
+        return write_jobs
+
+    def paper_repository(self, job, timeout=0):
+        # The official repository if its lookup finished within timeout seconds, otherwise None
+        future = job.get('repository')
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
+
+    def card(self, paper_info, repository=None):
+        return self.info_to_message(
+            paper_info['title'],
+            paper_info['authors'],
+            paper_info['abstract'],
+            paper_info['link'],
+            repository or paper_info.get('github_repo')
+        )
+
+    def show_card(self, job, paper_info):
+        card = self.card(paper_info, self.paper_repository(job))
+        self.replies.update(job['status_message_id'], self.reply_key(job), card=card, link=paper_info['link'],
+                            databases="\n*Updating databases...*")
+        future = job.get('repository')
+        if future is not None and not future.done():
+            # The card is shown right away and gets its repository line with a later edit of the reply
+            future.add_done_callback(lambda future: self.show_repository(job, paper_info))
+
+    def show_repository(self, job, paper_info):
+        card = self.card(paper_info, self.paper_repository(job))
+        if not self.replies.update(job['status_message_id'], self.reply_key(job), card=card):
+            print(f"Warning: Reply {job['status_message_id']} is gone, dropped the repository line of {paper_info['link']}.")
+
+    def paper_card(self, message, paper_info):
+        return f"{message['sender_full_name']} shared:\n{self.card(paper_info)}"
 
+    def write_stage(self, job):
+        with metrics.trace(job['message'].get('id')):
+            return self._write(job)
+
+    def prepare_write(self, job):
+        info, orig_message = job['info'], job['message']
+        info['sender'] = orig_message['sender_full_name']
+        info['stream'] = (orig_message['display_recipient']
+                          if orig_message['type'] == 'stream' else None)
+        info['message_content'] = orig_message['content']
+        # Same message and paper always give the same key, so journal replays stay idempotent
+        return info, f"{orig_message.get('id')}:{normalize_link(info['link'])}"
+
+    def _write(self, job):
+        info, job_key = self.prepare_write(job)
+        if self.repositories is not None:
+            # The databases store the repository as well, so a slow lookup holds the write back up to its timeout
+            info['github_repo'] = self.paper_repository(job, timeout=self.repositories.timeout)
+        reply_id, reply_key = job['status_message_id'], job['reply_key']
+        update_result = self.try_update_databases(
+            info, job_key=job_key, status_message_id=reply_id,
+            on_progress=lambda content: self.replies.update(reply_id, reply_key, databases=content)
+        )
+        self.replies.update(reply_id, reply_key, databases=update_result, done=True)
+
+    def replay_finished(self, handler_wrapper, job, result):
+        # Swap the "pending" line of the original status message for the replayed result
+        if job['status_message_id'] is None:
+            return
+        link = job.get('info', {}).get('link')
+        # A reply that is still being edited takes the result with its next edit
+        if self.replies.replace(job['status_message_id'], link, handler_wrapper.pending_text(), result):
+            return
+        response = self.client.get_raw_message(job['status_message_id'])
+        content = self.replayed_content(response, handler_wrapper, result, link)
+        if content is not None:
+            self.client.update_message({"message_id": job['status_message_id'], "content": content})
+
+    def replayed_content(self, response, handler_wrapper, result, link=None):
+        content = response.get('raw_content')
+        if content is None:
+            return
+        pending = handler_wrapper.pending_text()
+        # A reply covers several papers, the pending line to replace is the first one after the paper's link
+        start = content.find(link) if link else -1
+        position = content.find(pending, max(start, 0))
+        if position < 0:
+            position = content.find(pending)
+        if position >= 0:
+            return content[:position] + result + content[position + len(pending):]
+        return content + "\n" + result
+
+    def notify_stage(self, reply):
+        self.replies.flush(reply)
 
     def send_message_to_zulip(self, response_message, message_data):
         request = {
@@ -137,43 +320,17 @@ class zulipHandler:
 
 
     def run(self):
+        self.pipeline.start()
+        for handler_wrapper in self.database_handlers:
+            handler_wrapper.on_replay = self.replay_finished
+            threading.Thread(target=handler_wrapper.replay_pending, daemon=True).start()
+        metrics.startup.mark('listening')
         self.client.call_on_each_message(lambda message: self.handle_message(message))
 
-    def count_backticks_in_quote(self, line):
-        match = re.match(r'^(`+)(quote)', line)
-        return len(match.group(1)) if match else 0
-
-    def filter_zulip_quotes(self, content):
-        lines = content.split('\n')
-        out = []
-        n_lines = len(lines)
-        i = 0
-        while i < n_lines:
-            ticks = self.count_backticks_in_quote(lines[i])
-            if ticks:
-                if out:
-                    out.pop(-1)
-                i += 1
-                while i < n_lines and '`'*ticks not in lines[i]:
-                    i += 1
-            else:
-                out.append(lines[i])
-            i += 1
-        return "\n".join(out)
-
-    def paper_info_to_bibtex(self, paper_info):
-        year = str(datetime.fromisoformat(paper_info['publish_date'].rstrip('Z')).year)
-        bib_id = paper_info['authors'][0].split(' ')[1].lower() + year + re.sub(r'[^a-zA-Z]*$', '', paper_info['title'].split(' ')[0].lower())
-        bib = (f"@misc{{{bib_id},\n"
-               f"      title = {{{paper_info['title']}}},\n"
-               f"      author = {{{' and '.join(', '.join([a.split()[-1], ' '.join(a.split()[:-1])]) for a in paper_info['authors'])}}},\n"
-               f"      year = {{{year}}},\n"
-               f"      url = {{{paper_info['link']}}}")
-        if paper_info['type'] == 'arxiv':
-            add = (",\n"
-                   f"      eprint = {{{paper_info['id']}}},\n"
-                   f"      archivePrefix = {{arXiv}},\n"
-                   f"      primaryClass = {{{paper_info['category']}}}\n")
-        else:
-            add = "\n"
-        return bib + add + "}" 
+    def stop(self):
+        self.pipeline.stop()
+        self.replies.flush_all()
+        for executor in self.write_executors.values():
+            executor.shutdown(wait=False)
+        if self.repositories is not None:
+            self.repositories.close()
@@ -0,0 +1,7 @@
+# conftest.py
+
+import os
+import sys
+
+# The bot's modules are flat files in src, imported the same way main.py imports them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,119 @@
+# test_circuit_breaker.py
+
+import time
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+def make_breaker(**config):
+    settings = dict(failure_rate=0.5, min_calls=4, window=120, base_delay=5, max_delay=300, jitter=0)
+    settings.update(config)
+    return CircuitBreaker('test', **settings)
+
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure(RuntimeError('timeout'))
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_opens_at_failure_rate():
+    breaker = make_breaker()
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure(RuntimeError('timeout'))
+    assert breaker.state == CLOSED
+    breaker.record_failure(RuntimeError('timeout'))
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert 4.9 < breaker.seconds_until_probe() <= 5
+
+
+def test_same_exception_counts_once():
+    breaker = make_breaker()
+    error = RuntimeError('batch failed')
+    for _ in range(10):
+        breaker.record_failure(error)
+    assert breaker.state == CLOSED
+
+
+def test_old_outcomes_leave_the_window(monkeypatch):
+    breaker = make_breaker()
+    now = time.time()
+    monkeypatch.setattr(circuit_breaker.time, 'time', lambda: now)
+    for _ in range(3):
+        breaker.record_failure(RuntimeError('timeout'))
+    now += 121
+    for _ in range(3):
+        breaker.record_success()
+    breaker.record_failure(RuntimeError('timeout'))
+    assert breaker.state == CLOSED
+
+
+def test_trip_opens_right_away():
+    breaker = make_breaker()
+    breaker.trip()
+    assert breaker.state == OPEN
+    assert breaker.seconds_until_probe() is not None
+
+
+def test_probe_waits_for_backoff(monkeypatch):
+    breaker = make_breaker()
+    now = time.time()
+    monkeypatch.setattr(circuit_breaker.time, 'time', lambda: now)
+    breaker.trip()
+    assert not breaker.start_probe()
+    now += 5
+    assert breaker.start_probe()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    # Only one caller gets to run the probe
+    assert not breaker.start_probe()
+
+
+def test_probe_success_closes():
+    breaker = make_breaker(base_delay=0)
+    breaker.trip()
+    assert breaker.start_probe()
+    breaker.probe_succeeded()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    assert breaker.seconds_until_probe() is None
+
+
+def test_failed_probes_double_the_backoff_up_to_max(monkeypatch):
+    breaker = make_breaker(base_delay=5, max_delay=30)
+    now = time.time()
+    monkeypatch.setattr(circuit_breaker.time, 'time', lambda: now)
+    breaker.trip()
+    delays = []
+    for _ in range(5):
+        now += breaker.seconds_until_probe()
+        assert breaker.start_probe()
+        breaker.probe_failed()
+        assert breaker.state == OPEN
+        delays.append(breaker.seconds_until_probe())
+    assert delays == [10, 20, 30, 30, 30]
+    now += 30
+    assert breaker.start_probe()
+    breaker.probe_succeeded()
+    breaker.trip()
+    assert breaker.seconds_until_probe() == 5
+
+
+def test_jitter_only_shortens_the_wait():
+    for _ in range(20):
+        breaker = make_breaker(jitter=0.3)
+        breaker.trip()
+        assert 5 * 0.7 - 0.1 <= breaker.seconds_until_probe() <= 5
+
+
+def test_failures_while_open_are_ignored():
+    breaker = make_breaker()
+    breaker.trip()
+    breaker.record_failure(RuntimeError('late'))
+    breaker.record_success()
+    assert breaker.state == OPEN
+    assert len(breaker.outcomes) == 0
@@ -0,0 +1,96 @@
+# test_job_journal.py
+
+import time
+import pytest
+from job_journal import JobJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    # No lease, so added jobs are due and claimable right away
+    return JobJournal(str(tmp_path / 'journal.sqlite'), retry_base=30, retry_max=120, lease=0)
+
+
+def test_add_is_idempotent(journal):
+    assert journal.add('key', 'notion', {'title': 'Paper'}, 7)
+    assert not journal.add('key', 'notion', {'title': 'Other'}, 8)
+    jobs = journal.due('notion')
+    assert [(job['key'], job['info'], job['status_message_id']) for job in jobs] == [('key', {'title': 'Paper'}, 7)]
+
+
+def test_due_is_per_handler(journal):
+    journal.add('a', 'notion', {})
+    journal.add('b', 'zotero', {})
+    assert [job['key'] for job in journal.due('notion')] == ['a']
+    assert [job['key'] for job in journal.due('zotero')] == ['b']
+
+
+def test_complete_removes_job_from_due(journal):
+    journal.add('key', 'notion', {})
+    journal.complete('key')
+    assert journal.due('notion') == []
+    assert journal.due('notion', ignore_schedule=True) == []
+
+
+def test_fail_backs_off_exponentially(journal):
+    journal.add('key', 'notion', {})
+    journal.fail('key', RuntimeError('down'))
+    assert journal.due('notion') == []
+    job, = journal.due('notion', ignore_schedule=True)
+    assert job['attempts'] == 1
+    (next_attempt, last_error), = journal.store.execute("SELECT next_attempt, last_error FROM jobs WHERE key = 'key'")
+    assert last_error == 'down'
+    assert 25 < next_attempt - time.time() <= 30
+
+    journal.fail('key', RuntimeError('down'))
+    (next_attempt,), = journal.store.execute("SELECT next_attempt FROM jobs WHERE key = 'key'")
+    assert 55 < next_attempt - time.time() <= 60
+
+    for _ in range(5):
+        journal.fail('key', RuntimeError('down'))
+    (next_attempt,), = journal.store.execute("SELECT next_attempt FROM jobs WHERE key = 'key'")
+    assert next_attempt - time.time() <= 120
+
+
+def test_defer_makes_job_due_again(journal):
+    journal.add('key', 'notion', {})
+    journal.fail('key', RuntimeError('down'))
+    assert journal.due('notion') == []
+    journal.defer('key')
+    job, = journal.due('notion')
+    assert job['attempts'] == 1
+
+
+def test_claim_is_exclusive_until_released(journal):
+    journal.lease = 600
+    journal.add('key', 'notion', {})
+    # A freshly added job belongs to the writer that added it
+    assert not journal.claim('key')
+    journal.release_claims()
+    assert journal.claim('key')
+    assert not journal.claim('key')
+
+
+def test_fail_and_defer_release_the_claim(journal):
+    journal.lease = 600
+    journal.add('key', 'notion', {})
+    journal.fail('key', RuntimeError('down'))
+    assert journal.claim('key')
+    journal.defer('key')
+    assert journal.claim('key')
+
+
+def test_claim_skips_done_jobs(journal):
+    journal.add('key', 'notion', {})
+    journal.complete('key')
+    assert not journal.claim('key')
+
+
+def test_journal_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'journal.sqlite')
+    first = JobJournal(path, lease=600)
+    second = JobJournal(path, lease=600)
+    first.add('key', 'notion', {})
+    first.release_claims()
+    assert second.claim('key')
+    assert not first.claim('key')
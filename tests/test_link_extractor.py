@@ -0,0 +1,61 @@
+# test_link_extractor.py
+
+import random
+import pytest
+from link_extractor import LinkExtractor
+from paper_handlers import arxiveHandler, openreviewHandler
+from benchmark.extraction import legacy_extract, synthetic_message
+
+
+@pytest.fixture(scope='module')
+def extractor():
+    return LinkExtractor.for_handlers([arxiveHandler(), openreviewHandler()])
+
+
+def test_finds_ids_in_order_without_duplicates(extractor):
+    content = ("look at https://arxiv.org/abs/2301.12345v2 and arXiv:2301.12345\n"
+               "reviews: https://openreview.net/forum?id=abc_123 and 2205.54321")
+    assert extractor.extract(content) == [('arxiv', '2301.12345'), ('openreview', 'abc_123'), ('arxiv', '2205.54321')]
+
+
+def test_skips_quotes_and_their_header(extractor):
+    content = ("before 2301.11111\n"
+               "@_**Someone|1** [said](https://zulip.example/#narrow/near/1): 2301.22222\n"
+               "````quote\n"
+               "2301.33333\n"
+               "```\n"
+               "2301.44444\n"
+               "````\n"
+               "after https://openreview.net/pdf?id=xyz")
+    assert extractor.extract(content) == [('arxiv', '2301.11111'), ('openreview', 'xyz')]
+    assert ('arxiv', '2301.33333') in extractor.extract(content, strip_quotes=False)
+
+
+def test_unterminated_quote_hides_the_rest(extractor):
+    content = "2301.11111\nsaid:\n```quote\n2301.22222\n2301.33333"
+    assert extractor.extract(content) == [('arxiv', '2301.11111')] == legacy_extract(content)
+
+
+def test_rejects_patterns_without_id_group():
+    with pytest.raises(ValueError):
+        LinkExtractor().register('bad', r'(\d+)')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_legacy_extraction(extractor, seed):
+    rng = random.Random(seed)
+    for _ in range(20):
+        content = synthetic_message(200, link_share=0.1, quote_share=0.05, rng=rng)
+        assert sorted(extractor.extract(content)) == sorted(legacy_extract(content))
+
+
+@pytest.mark.parametrize('content', [
+    "",
+    "no links at all",
+    "```quote\n2301.11111\n```",
+    "2301.11111\n```quote\n2301.22222\n```\n2301.33333",
+    "arXiv:2301.12345v3 https://arxiv.org/abs/2301.12345",
+    "12.50000 and 1234.567890 are not ids",
+])
+def test_matches_legacy_extraction_on_edge_cases(extractor, content):
+    assert sorted(extractor.extract(content)) == sorted(legacy_extract(content))
@@ -0,0 +1,165 @@
+# test_reply_aggregator.py
+
+import asyncio
+import time
+from benchmark.fake_services import FakeZulipClient, FakeAsyncZulipClient
+from reply_aggregator import ReplyAggregator, AsyncReplyAggregator, ZULIP_MAX_MESSAGE_LENGTH
+
+MESSAGE = {'sender_full_name': 'Ada', 'stream_id': 1, 'subject': 'papers'}
+
+
+def request_for(message, content):
+    return {'type': 'stream', 'to': message['stream_id'], 'topic': message['subject'], 'content': content}
+
+
+def placeholder(key):
+    return f"Looking up {key}..."
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def content_of(client, message_id):
+    with client.lock:
+        return client.messages[message_id]['content']
+
+
+def test_open_posts_one_reply_for_all_keys():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client)
+    ids = replies.open(MESSAGE, ['a', 'b', 'c'], request_for, placeholder)
+    assert len(client.sent) == 1
+    assert set(ids.values()) == {client.sent[0][1]['id']}
+    assert content_of(client, ids['a']) == "Ada shared:\n\nLooking up a...\n\nLooking up b...\n\nLooking up c..."
+
+
+def test_updates_within_debounce_are_coalesced_into_one_edit():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=0.2, max_debounce=1.0)
+    ids = replies.open(MESSAGE, ['a', 'b', 'c'], request_for, placeholder)
+    for key in ids:
+        replies.update(ids[key], key, card=f"Card {key}")
+        replies.update(ids[key], key, databases=f"\nNotion: saved {key}")
+    wait_for(lambda: client.updated)
+    time.sleep(0.3)
+    assert len(client.updated) == 1
+    assert content_of(client, ids['a']) == ("Ada shared:\n\nCard a\nNotion: saved a\n\nCard b\nNotion: saved b"
+                                            "\n\nCard c\nNotion: saved c")
+
+
+def test_wait_grows_while_reply_is_in_progress():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=0.1, max_debounce=0.4)
+    ids = replies.open(MESSAGE, ['a', 'b'], request_for, placeholder)
+    reply = replies.replies[ids['a']]
+    for interval in [0.2, 0.4, 0.4]:
+        edits = len(client.updated)
+        replies.update(ids['a'], 'a', card=f"Card after {edits} edits")
+        wait_for(lambda: len(client.updated) > edits)
+        assert reply.interval == interval
+
+
+def test_unchanged_content_is_not_sent():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=10)
+    ids = replies.open(MESSAGE, ['a'], request_for, placeholder)
+    replies.update(ids['a'], 'a', card=placeholder('a'))
+    replies.flush_all()
+    assert client.updated == []
+
+
+def test_flush_all_sends_pending_edits():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=10, max_debounce=10)
+    ids = replies.open(MESSAGE, ['a', 'b'], request_for, placeholder)
+    replies.update(ids['a'], 'a', card="Card a", done=True)
+    replies.flush_all()
+    assert len(client.updated) == 1
+    assert "Card a" in content_of(client, ids['a'])
+
+
+def test_finished_reply_is_closed_and_reopened_by_late_updates():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=10, keep_closed=1)
+    ids = replies.open(MESSAGE, ['a'], request_for, placeholder)
+    replies.update(ids['a'], 'a', card="Card a", done=True)
+    replies.flush_all()
+    assert ids['a'] in replies.closed and ids['a'] not in replies.replies
+
+    assert replies.update(ids['a'], 'a', databases="\nRepository: github.com/x/y")
+    replies.flush_all()
+    assert content_of(client, ids['a']).endswith("Card a\nRepository: github.com/x/y")
+
+    # Once evicted from the closed replies, late updates are reported as lost
+    other = replies.open(MESSAGE, ['b'], request_for, placeholder)
+    replies.update(other['b'], 'b', card="Card b", done=True)
+    replies.flush_all()
+    assert not replies.update(ids['a'], 'a', databases="\ntoo late")
+
+
+def test_replace_swaps_pending_line():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=10)
+    ids = replies.open(MESSAGE, ['a'], request_for, placeholder)
+    replies.update(ids['a'], 'a', card="Card a", databases="\nNotion: pending", link='https://arxiv.org/abs/2301.12345')
+    assert replies.replace(ids['a'], 'https://arxiv.org/abs/2301.12345', "Notion: pending", "Notion: saved")
+    assert not replies.replace(ids['a'], 'https://arxiv.org/abs/2301.99999', "Notion: pending", "Notion: saved")
+    replies.flush_all()
+    assert content_of(client, ids['a']).endswith("Card a\nNotion: saved")
+
+
+def test_long_reply_moves_papers_to_continuation():
+    client = FakeZulipClient()
+    replies = ReplyAggregator(client, debounce=10)
+    keys = [f"paper{index}" for index in range(20)]
+    ids = replies.open(MESSAGE, keys, request_for, placeholder)
+    for key in keys:
+        replies.update(ids[key], key, card=f"{key}\n" + "x" * 1500, done=True)
+    replies.flush_all()
+
+    assert len(client.sent) == 4
+    contents = [content_of(client, request['id']) for _, request in client.sent]
+    assert all(len(content) <= ZULIP_MAX_MESSAGE_LENGTH for content in contents)
+    assert all(content.startswith("*(continued)*") for content in contents[1:])
+    assert "*(shortened)*" not in "".join(contents)
+    assert [key for key in keys if any(f"{key}\n" in content for content in contents)] == keys
+
+    # A late update of a moved paper edits the continuation that holds it
+    last_id = client.sent[-1][1]['id']
+    assert replies.update(ids['paper19'], 'paper19', databases="\nRepository: github.com/x/y")
+    replies.flush_all()
+    assert content_of(client, last_id).endswith("Repository: github.com/x/y")
+
+
+def test_async_updates_are_coalesced():
+    async def scenario():
+        client = FakeAsyncZulipClient()
+        replies = AsyncReplyAggregator(client, debounce=0.1, max_debounce=1.0)
+        ids = await replies.open(MESSAGE, ['a', 'b'], request_for, placeholder)
+        for key in ids:
+            replies.update(ids[key], key, card=f"Card {key}", done=True)
+        await asyncio.sleep(0.3)
+        await replies.drain()
+        return client, ids
+
+    client, ids = asyncio.run(scenario())
+    assert len(client.updated) == 1
+    assert content_of(client, ids['a']) == "Ada shared:\n\nCard a\n\nCard b"
+
+
+def test_async_flush_all_sends_pending_edits():
+    async def scenario():
+        client = FakeAsyncZulipClient()
+        replies = AsyncReplyAggregator(client, debounce=10, max_debounce=10)
+        ids = await replies.open(MESSAGE, ['a'], request_for, placeholder)
+        replies.update(ids['a'], 'a', card="Card a")
+        await replies.flush_all()
+        return client, ids
+
+    client, ids = asyncio.run(scenario())
+    assert len(client.updated) == 1
+    assert content_of(client, ids['a']) == "Ada shared:\n\nCard a"